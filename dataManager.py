@@ -1,43 +1,359 @@
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+import numpy as np
 import pandas as pd
+import itertools
+import hashlib
+import os
+import threading
+import time
+import Queue
+import weakref
 from collections import defaultdict
+from contextlib import contextmanager
+from io import BytesIO
+import instrumentation
+from linkIndex import BoxRainfall, OverlappingPeriods, DEPTH_SCALE, expand_boxes
+
+DEFAULT_CHUNK_SIZE = 50000
+
+# Column types of compact results
+COMPACT_DTYPES = {
+    'speed': np.float32, 'depth': np.float32, 'hour': np.int8, 'dow': np.int8,
+    'nature': 'category', 'identifier': 'category'
+}
+COMPACT_COLUMNS = ['speed', 'depth', 'nature', 'identifier', 'hour', 'dow']
+
+# Road partitions of a bulk extraction, (itn_link column, extra condition). Motorway roads are the classifications
+# of motorway links, and every link of such a classification belongs to its road as when roads are queried one by one
+ROAD_PARTITIONS = [("street", "TRUE"),
+                   ("classification", "itn_link.classification IN "
+                                      "(SELECT classification FROM itn_link WHERE description = 'Motorway')")]
+
+# Length of the traffic periods, every traffic period starts on a multiple of it within the hour
+TRAFFIC_PERIOD_MINUTES = 15
+
+# Materialized rainfall of a rainfall table is held in the table named with this suffix, and the
+# state of every materialization in MATERIALIZATION_TABLE
+MATERIALIZED_SUFFIX = "_by_period"
+MATERIALIZATION_TABLE = "rainfall_materializations"
+
+# Environment variable opting the GUI into materialized rainfall, which creates tables in the database
+MATERIALIZE_RAINFALL_ENV = "TFL_MATERIALIZE_RAINFALL"
+
+# Names of the statements prepared on every open connection, prepared statements last as long as their session
+_prepared_statements = weakref.WeakKeyDictionary()
+_prepared_lock = threading.Lock()
+
+def get_db_config():
+    """
+    :return: dictionary of psycopg2.connect arguments, read from TFL_DB_* environment variables
+    """
+    return {
+        "database": os.environ.get("TFL_DB_NAME", "tfl"),
+        "user": os.environ.get("TFL_DB_USER", "tfl"),
+        "password": os.environ.get("TFL_DB_PASSWORD", "tfl"),
+        "host": os.environ.get("TFL_DB_HOST", "127.0.0.1"),
+        "port": int(os.environ.get("TFL_DB_PORT", 9999))
+    }
+
+class PoolTimeout(psycopg2.pool.PoolError):
+    pass
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of at most max_size connections, opened lazily. Idle
+    connections are health checked before reuse and the pool is reset after
+    a fork so worker processes never share a parent's socket, the connections
+    inherited from the parent are kept open and never used
+    """
+
+    def __init__(self, max_size=None, timeout=None, health_check_interval=30, **connect_kwargs):
+        """
+        :param max_size: maximum number of open connections, TFL_DB_POOL_SIZE or 8
+        :param timeout: seconds to wait for a free connection, TFL_DB_POOL_TIMEOUT or 30
+        :param health_check_interval: seconds a connection may idle before it is checked with SELECT 1
+        :param connect_kwargs: psycopg2.connect arguments, get_db_config() if not given
+        """
+        self.max_size = max_size or int(os.environ.get("TFL_DB_POOL_SIZE", 8))
+        self.timeout = timeout if timeout is not None else float(os.environ.get("TFL_DB_POOL_TIMEOUT", 30))
+        self.health_check_interval = health_check_interval
+        self.__connect_kwargs = connect_kwargs or get_db_config()
+        self.__lock = threading.Lock()
+        # Connections opened by a parent process, kept referenced so they are never closed in this one
+        self.__inherited = []
+        self.__reset()
+
+    def __reset(self):
+        # Each slot holds an idle (connection, last used time) or None if not yet opened
+        self.__pid = os.getpid()
+        self.__slots = Queue.LifoQueue()
+        for _ in range(self.max_size):
+            self.__slots.put(None)
+
+    def __check_pid(self):
+        if self.__pid != os.getpid():
+            with self.__lock:
+                if self.__pid != os.getpid():
+                    # Closing, or garbage collecting, an inherited connection would end the
+                    # session of the parent sharing its socket
+                    self.__inherited.append(self.__slots)
+                    self.__reset()
+
+    def __is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+
+        if time.time() - last_used < self.health_check_interval:
+            return True
+
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+
+    def acquire(self, timeout=None):
+        """
+        :param timeout: seconds to wait for a free connection, pool timeout if None
+        :return: open connection, must be given back with release
+        """
+        self.__check_pid()
+
+        try:
+            slot = self.__slots.get(timeout=self.timeout if timeout is None else timeout)
+        except Queue.Empty:
+            raise PoolTimeout("No connection available after %s seconds" % (self.timeout if timeout is None else timeout))
+
+        try:
+            if slot is not None:
+                conn, last_used = slot
+                if self.__is_healthy(conn, last_used):
+                    return conn
+                if not conn.closed:
+                    conn.close()
+
+            return psycopg2.connect(**self.__connect_kwargs)
+        except:
+            self.__slots.put(None)
+            raise
+
+    def release(self, conn):
+        """
+        :param conn: connection returned by acquire
+        """
+        if self.__pid != os.getpid():
+            # Acquired before a fork, the parent still uses it
+            self.__inherited.append(conn)
+            return
+
+        if not conn.closed:
+            try:
+                # Never hand out a connection in the middle of a transaction
+                if conn.status != psycopg2.extensions.STATUS_READY:
+                    conn.rollback()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                conn.close()
+
+        self.__slots.put(None if conn.closed else (conn, time.time()))
+
+    @contextmanager
+    def connection(self, timeout=None):
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+__default_pool = None
+__default_pool_lock = threading.Lock()
+
+def get_default_pool():
+    """
+    :return: process-wide ConnectionPool configured from the environment
+    """
+    global __default_pool
+
+    with __default_pool_lock:
+        if __default_pool is None:
+            __default_pool = ConnectionPool()
+
+    return __default_pool
 
 class DataManager(object):
 
-    def __init__(self):
-        self.__conn = psycopg2.connect(database="tfl", user="tfl", password="tfl", host="127.0.0.1", port=9999)
-        self.__cur = self.__conn.cursor()
+    def __init__(self, pool=None, cache=None, link_index=None, materialized_rainfall=False):
+        """
+        :param pool: ConnectionPool to draw connections from, process-wide default pool if None
+        :param cache: ExtractCache serving repeated get_data selections from local disk, no caching if None
+        :param link_index: LinkIndex the toids and grid boxes of get_data and iter_data selections are read from,
+            so traffic and rainfall are queried without joining itn_link and link_grid, None to join them in every query
+        :param materialized_rainfall: read rainfall from its materialization per traffic period (see
+            materialize_rainfall), refreshed on first use of each rainfall table, instead of range joining it
+        """
+        self.__pool = pool or get_default_pool()
+        self.__cache = cache
+        self.__link_index = link_index
+        self.__materialized_rainfall = materialized_rainfall
+        # rainfall table -> table its rainfall is read from
+        self.__rainfall_sources = {}
+        self.__materialized_tables = set()
+        self.__rainfall_lock = threading.Lock()
+        self.__cursor_ids = itertools.count()
 
-    def __get_toids(self, filters, natures):
+    def __get_link_condition(self, filters, natures):
+        """
+        :param filters: list of (column, column_value) eg (street, "OXFORD STREET")
+        :param natures: list of natures
+        :return: (condition on itn_link columns, list of its parameters)
+        """
 
         column_values = defaultdict(list)
         for k,v in filters:
             column_values[k].append(v)
 
-        filter_condition = " OR ".join([column + " " + self.__get_condition(values) for column, values in column_values.iteritems()])
-        conditions = filter_condition + " AND nature %s" % self.__get_condition(natures)
+        columns = list(column_values)
+
+        filter_condition = " OR ".join([column + " " + self.__get_condition() for column in columns])
+        conditions = filter_condition + " AND nature %s" % self.__get_condition()
+
+        return conditions, [self.__get_array(column_values[column]) for column in columns] + [self.__get_array(natures)]
+
+    def __get_toids(self, cur, filters, natures):
+
+        conditions, params = self.__get_link_condition(filters, natures)
 
         query = "SELECT toid, length, nature, street, classification " \
                 "FROM itn_link WHERE %s" % conditions
 
-        self.__cur.execute(query)
-        result = self.__cur.fetchall()
+        with instrumentation.timer("db.toid_lookup"):
+            self.__execute(cur, query, params)
+            result = cur.fetchall()
+
+        instrumentation.count("db.toids", len(result))
 
         toid_info = {row[0]:(row[1], row[2], row[3] if row[3] else row[4]) for row in result}
 
         return toid_info
 
-    def __get_time_depth(self, traffic_table, rainfall_table, toids, hours, days):
+    def __get_rainfall_join(self, rainfall_table):
         """
-        :param toids: list of toids
-        :param hours: list of hours
-        :param weekdays: list of days
-        :return: list of tuples -> (toid, journey_time, depth)
+        :param rainfall_table: rainfall table or its materialization from __get_rainfall_source
+        :return: join of the rainfall of every grid box of link_grid within each traffic period, by period
+            equality on a materialization, the range join otherwise
         """
+        if rainfall_table in self.__materialized_tables:
+            return """LEFT JOIN %s as rainfall ON rainfall.os_grid = link_grid.box
+                   AND rainfall.period = traffic.period""" % rainfall_table
 
-        hours_condition = self.__get_condition(hours)
-        days_condition = self.__get_condition(days)
-        toid_condition = self.__get_condition(toids)
+        return """LEFT JOIN %s as rainfall ON rainfall.os_grid = link_grid.box
+                   AND traffic.period @> rainfall.period""" % rainfall_table
+
+    def __get_slot_expression(self, column):
+        """
+        :return: sql expression of the start of the traffic period containing the start of a period column
+        """
+        return "date_trunc('hour', lower(%s)) + FLOOR(EXTRACT(MINUTE FROM lower(%s)) / %i) * interval '%i minutes'" % (
+            column, column, TRAFFIC_PERIOD_MINUTES, TRAFFIC_PERIOD_MINUTES)
+
+    def __get_materialize_query(self, rainfall_table, incremental):
+        """
+        :param incremental: only the traffic periods from the watermark bound as the query parameter
+        :return: query of the summed depth of every grid box and traffic period with rain, counting the rainfall
+            periods contained in the traffic period as the range join does
+        """
+        slot = self.__get_slot_expression("rainfall.period")
+
+        query = """
+            SELECT rainfall.os_grid, tsrange(slot, slot + interval '%i minutes') as period, SUM(depth) as depth
+            FROM
+                   (SELECT rainfall.os_grid, COALESCE(rainfall.depth, 0) as depth, upper(rainfall.period) as upper,
+                           %s as slot
+                    FROM %s as rainfall
+                    WHERE NOT isempty(rainfall.period)%s) as rainfall
+                   WHERE rainfall.upper <= rainfall.slot + interval '%i minutes'
+                   GROUP BY rainfall.os_grid, rainfall.slot
+                   HAVING SUM(depth) <> 0
+        """ % (TRAFFIC_PERIOD_MINUTES, slot, rainfall_table, " AND lower(rainfall.period) >= %s" if incremental else "",
+               TRAFFIC_PERIOD_MINUTES)
+
+        return query
+
+    def __refresh_materialized_rainfall(self, cur, rainfall_table, materialized_table):
+        """
+        Sum the rainfall of the traffic periods from the last one materialized, or of every period
+        when rows were added or removed before it since or the materialization has other traffic periods
+        """
+        # Serialise refreshes of the same table across processes
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (materialized_table,))
+        cur.execute("CREATE TABLE IF NOT EXISTS %s (rainfall_table VARCHAR(63) PRIMARY KEY, watermark TIMESTAMP, "
+                    "rows_before BIGINT, period_minutes INTEGER)" % MATERIALIZATION_TABLE)
+
+        cur.execute("SELECT watermark, rows_before, period_minutes FROM %s WHERE rainfall_table = %%s"
+                    % MATERIALIZATION_TABLE, (rainfall_table,))
+        state = cur.fetchone()
+        cur.execute("SELECT to_regclass(%s)", (materialized_table,))
+        incremental = (state is not None and state[0] is not None and state[2] == TRAFFIC_PERIOD_MINUTES
+                       and cur.fetchone()[0] is not None)
+
+        if incremental:
+            cur.execute("SELECT COUNT(*) FROM %s WHERE lower(period) < %%s" % rainfall_table, (state[0],))
+            incremental = cur.fetchone()[0] == state[1]
+
+        if incremental:
+            cur.execute("DELETE FROM %s WHERE lower(period) >= %%s" % materialized_table, (state[0],))
+            cur.execute("INSERT INTO %s %s" % (materialized_table, self.__get_materialize_query(rainfall_table, True)),
+                        (state[0],))
+        else:
+            cur.execute("DROP TABLE IF EXISTS %s" % materialized_table)
+            cur.execute("CREATE TABLE %s AS %s" % (materialized_table, self.__get_materialize_query(rainfall_table, False)))
+            cur.execute("CREATE INDEX ON %s (os_grid, period)" % materialized_table)
+
+        # The last traffic period may still receive rainfall, it is summed again by the next refresh
+        cur.execute("SELECT MAX(%s) FROM %s WHERE NOT isempty(period)" % (self.__get_slot_expression("period"),
+                                                                           rainfall_table))
+        watermark = cur.fetchone()[0]
+        cur.execute("SELECT COUNT(*) FROM %s WHERE lower(period) < %%s" % rainfall_table, (watermark,))
+        rows_before = cur.fetchone()[0]
+
+        cur.execute("DELETE FROM %s WHERE rainfall_table = %%s" % MATERIALIZATION_TABLE, (rainfall_table,))
+        cur.execute("INSERT INTO %s VALUES (%%s, %%s, %%s, %%s)" % MATERIALIZATION_TABLE,
+                    (rainfall_table, watermark, rows_before, TRAFFIC_PERIOD_MINUTES))
+
+        if not incremental:
+            cur.execute("ANALYZE %s" % materialized_table)
+
+    def __get_rainfall_source(self, rainfall_table):
+        """
+        :return: table the rainfall of rainfall_table is read from, its materialization refreshed on first use
+            when materialized rainfall is enabled, the table itself otherwise or if it can not be materialized
+        """
+        if not self.__materialized_rainfall:
+            return rainfall_table
+
+        with self.__rainfall_lock:
+            if rainfall_table not in self.__rainfall_sources:
+                try:
+                    source = self.materialize_rainfall(rainfall_table)
+                    self.__materialized_tables.add(source)
+                except psycopg2.Error:
+                    # Eg no privilege to create tables, range join the rainfall table instead
+                    instrumentation.count("db.materialization_failures")
+                    source = rainfall_table
+
+                self.__rainfall_sources[rainfall_table] = source
+
+            return self.__rainfall_sources[rainfall_table]
+
+    def __get_time_depth_query(self, traffic_table, rainfall_table, toids, hours, days):
+        """
+        :return: (query, list of its parameters)
+        """
+
+        condition = self.__get_condition()
 
         query = """
             SELECT traffic.toid, traffic.journey_time, SUM(COALESCE(rainfall.depth, 0)) as depth,
@@ -45,38 +361,388 @@ class DataManager(object):
                    EXTRACT(DOW FROM lower(traffic.period)) as dow
             FROM
                    %s as traffic JOIN link_grid ON traffic.toid = link_grid.toid
-                   LEFT JOIN %s as rainfall ON rainfall.os_grid = link_grid.box
-                   AND traffic.period @> rainfall.period
+                   %s
                    WHERE traffic.toid %s
                    AND EXTRACT(HOUR FROM lower(traffic.period)) %s
                    AND EXTRACT(DOW FROM lower(traffic.period)) %s
                    GROUP BY traffic.toid, traffic.period, traffic.journey_time;
-        """ % (traffic_table, rainfall_table, toid_condition, hours_condition, days_condition)
+        """ % (traffic_table, self.__get_rainfall_join(rainfall_table), condition, condition, condition)
+
+        return query, [self.__get_array(toids), self.__get_hours_array(hours), self.__get_hours_array(days)]
 
-        self.__cur.execute(query)
-        toid_time_depth = self.__cur.fetchall()
+    def __get_time_depth(self, cur, traffic_table, rainfall_table, toids, hours, days):
+        """
+        :param toids: list of toids
+        :param hours: list of hours
+        :param weekdays: list of days
+        :return: list of tuples -> (toid, journey_time, depth)
+        """
+
+        with instrumentation.timer("db.time_depth_query"):
+            self.__execute(cur, *self.__get_time_depth_query(traffic_table, rainfall_table, toids, hours, days))
+            toid_time_depth = cur.fetchall()
+
+        instrumentation.count("db.rows_fetched", len(toid_time_depth))
 
         return toid_time_depth
 
-    def __get_condition(self, values):
+    def __get_traffic_query(self, traffic_table, toids, hours, days):
+        """
+        :return: (query of the distinct traffic rows of toids, returning columns toid, journey_time,
+            lower and upper period bounds in seconds, hour, dow and the number of repeats of the row,
+            list of its parameters)
+        """
 
-        if len(values) == 1:
-            v = values[0]
+        condition = self.__get_condition()
 
-            if type(v) == str:
-                return "= '%s'" % v
-            else:
-                return "= %s" % v
+        query = """
+            SELECT traffic.toid, traffic.journey_time,
+                   EXTRACT(EPOCH FROM lower(traffic.period))::bigint as lower,
+                   EXTRACT(EPOCH FROM upper(traffic.period))::bigint as upper,
+                   EXTRACT(HOUR FROM lower(traffic.period)) as hour,
+                   EXTRACT(DOW FROM lower(traffic.period)) as dow,
+                   COUNT(*) as repeats
+            FROM
+                   %s as traffic
+                   WHERE traffic.toid %s
+                   AND EXTRACT(HOUR FROM lower(traffic.period)) %s
+                   AND EXTRACT(DOW FROM lower(traffic.period)) %s
+                   GROUP BY traffic.toid, traffic.period, traffic.journey_time;
+        """ % (traffic_table, condition, condition, condition)
 
-        if type(values[0]) == int:
-            minimum = min(values)
-            maximum = max(values)
-            compare_tuple = tuple(range(minimum, maximum + 1))
+        return query, [self.__get_array(toids), self.__get_hours_array(hours), self.__get_hours_array(days)]
 
-            if compare_tuple == values:
-                return "BETWEEN %s AND %s" % (minimum, maximum)
+    def __get_box_rainfall_query(self, rainfall_table, boxes, hours, days):
+        """
+        :param hours: hours of the traffic periods selected
+        :param days: days of the traffic periods selected
+        :return: (query of the rainfall of every period with rain in boxes that can be within a selected traffic
+            period, returning columns os_grid, lower and upper period bounds in seconds, depth in 1 / DEPTH_SCALE
+            millimeters, list of its parameters)
+        """
+
+        condition = self.__get_condition()
+
+        # A rainfall period within a traffic period starts in it, and traffic periods (TRAFFIC_PERIOD_MINUTES
+        # long from a multiple of it within the hour) lie within the hour and day they start in
+        query = """
+            SELECT rainfall.os_grid,
+                   EXTRACT(EPOCH FROM lower(rainfall.period))::bigint as lower,
+                   EXTRACT(EPOCH FROM upper(rainfall.period))::bigint as upper,
+                   ROUND(SUM(COALESCE(rainfall.depth, 0)) * %i)::bigint as depth
+            FROM
+                   %s as rainfall
+                   WHERE rainfall.os_grid %s
+                   AND EXTRACT(HOUR FROM lower(rainfall.period)) %s
+                   AND EXTRACT(DOW FROM lower(rainfall.period)) %s
+                   GROUP BY rainfall.os_grid, rainfall.period
+                   HAVING SUM(COALESCE(rainfall.depth, 0)) <> 0;
+        """ % (DEPTH_SCALE, rainfall_table, condition, condition, condition)
+
+        return query, [self.__get_array(boxes), self.__get_hours_array(hours), self.__get_hours_array(days)]
 
-        return "IN %s" % str(tuple(values))
+    def __get_compact_query(self, traffic_table, rainfall_table, roads, natures, hours, days):
+        """
+        :return: (query joining the toid metadata and computing speed in the database,
+            returning columns speed, depth, nature, identifier, hour, dow, list of its parameters)
+        """
+
+        link_condition, params = self.__get_link_condition(roads, natures)
+        condition = self.__get_condition()
+
+        query = """
+            SELECT (2.23694 * itn_link.length / (traffic.journey_time / 100.0))::real as speed,
+                   SUM(COALESCE(rainfall.depth, 0))::real as depth,
+                   itn_link.nature as nature,
+                   COALESCE(NULLIF(itn_link.street, ''), itn_link.classification) as identifier,
+                   EXTRACT(HOUR FROM lower(traffic.period))::smallint as hour,
+                   EXTRACT(DOW FROM lower(traffic.period))::smallint as dow
+            FROM
+                   %s as traffic JOIN itn_link ON traffic.toid = itn_link.toid
+                   JOIN link_grid ON traffic.toid = link_grid.toid
+                   %s
+                   WHERE (%s)
+                   AND EXTRACT(HOUR FROM lower(traffic.period)) %s
+                   AND EXTRACT(DOW FROM lower(traffic.period)) %s
+                   GROUP BY traffic.toid, traffic.period, traffic.journey_time,
+                            itn_link.length, itn_link.nature, itn_link.street, itn_link.classification
+        """ % (traffic_table, self.__get_rainfall_join(rainfall_table), link_condition, condition, condition)
+
+        return query, params + [self.__get_hours_array(hours), self.__get_hours_array(days)]
+
+    def __get_road_partition_query(self, traffic_table, rainfall_table, column, partition_condition, natures, hours, days,
+                                   roads=None):
+        """
+        :param column: itn_link column identifying a road, street or classification
+        :param partition_condition: condition on itn_link restricting the partition
+        :param roads: list of roads to restrict the partition to, every road if None
+        :return: (query of every road in the partition, ordered by road so rows of a road are consecutive,
+            list of its parameters)
+        """
+
+        condition = self.__get_condition()
+
+        query = """
+            SELECT itn_link.%s as road, traffic.toid, traffic.journey_time, SUM(COALESCE(rainfall.depth, 0)) as depth,
+                   EXTRACT(HOUR FROM lower(traffic.period)) as hour,
+                   EXTRACT(DOW FROM lower(traffic.period)) as dow,
+                   itn_link.length, itn_link.nature, itn_link.street, itn_link.classification
+            FROM
+                   %s as traffic JOIN itn_link ON traffic.toid = itn_link.toid
+                   JOIN link_grid ON traffic.toid = link_grid.toid
+                   %s
+                   WHERE itn_link.%s IS NOT NULL AND %s%s
+                   AND itn_link.nature %s
+                   AND EXTRACT(HOUR FROM lower(traffic.period)) %s
+                   AND EXTRACT(DOW FROM lower(traffic.period)) %s
+                   GROUP BY itn_link.%s, traffic.toid, traffic.period, traffic.journey_time,
+                            itn_link.length, itn_link.nature, itn_link.street, itn_link.classification
+                   ORDER BY itn_link.%s COLLATE "C"
+        """ % (column, traffic_table, self.__get_rainfall_join(rainfall_table), column, partition_condition,
+               " AND itn_link.%s %s" % (column, condition) if roads is not None else "", condition,
+               condition, condition, column, column)
+
+        params = [self.__get_array(natures), self.__get_hours_array(hours), self.__get_hours_array(days)]
+
+        return query, params if roads is None else [self.__get_array(roads)] + params
+
+    def __get_watermark_query(self, traffic_table, column, partition_condition, natures):
+        """
+        :return: (query of the row count and latest period end of every road in the partition, list of its parameters)
+        """
+
+        query = """
+            SELECT itn_link.%s as road, COUNT(*), MAX(upper(traffic.period))::text
+            FROM
+                   %s as traffic JOIN itn_link ON traffic.toid = itn_link.toid
+                   WHERE itn_link.%s IS NOT NULL AND %s
+                   AND itn_link.nature %s
+                   GROUP BY itn_link.%s
+        """ % (column, traffic_table, column, partition_condition, self.__get_condition(), column)
+
+        return query, [self.__get_array(natures)]
+
+    def __iter_query(self, conn, query, chunk_size, params=None):
+        """
+        :param chunk_size: number of rows fetched per round trip
+        :param params: query parameters, the query is sent as is if None
+        :return: generator of lists of row tuples, read through a named (server-side)
+            cursor so only one chunk is held in memory
+        """
+
+        cursor = conn.cursor(name="chunked_%i" % next(self.__cursor_ids))
+        cursor.itersize = chunk_size
+
+        try:
+            cursor.execute(query, params)
+
+            while True:
+                with instrumentation.timer("db.fetch_chunk"):
+                    rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                instrumentation.count("db.rows_fetched", len(rows))
+                yield rows
+        finally:
+            cursor.close()
+
+    def __get_compact_dtypes(self, cur, roads, natures):
+        """
+        :return: COMPACT_DTYPES with the categories of nature and identifier set to every value the selection
+            can hold, so the chunks of a selection share them and concatenate to categorical columns
+        """
+        link_condition, params = self.__get_link_condition(roads, natures)
+
+        self.__execute(cur, "SELECT DISTINCT nature, COALESCE(NULLIF(street, ''), classification) "
+                            "FROM itn_link WHERE %s" % link_condition, params)
+        rows = cur.fetchall()
+
+        dtypes = dict(COMPACT_DTYPES)
+        for column, values in zip(['nature', 'identifier'], zip(*rows) or [(), ()]):
+            dtypes[column] = pd.api.types.CategoricalDtype(sorted(set(value for value in values if value is not None)))
+
+        return dtypes
+
+    @instrumentation.timed("db.to_data_frame")
+    def __to_compact_data_frame(self, rows, dtypes):
+        """
+        :param rows: list of tuples -> (speed, depth, nature, identifier, hour, dow)
+        :param dtypes: column types from __get_compact_dtypes
+        :return: dataframe with COMPACT_DTYPES columns
+        """
+        return pd.DataFrame.from_records(rows, columns=COMPACT_COLUMNS).astype(dtypes)
+
+    @instrumentation.timed("db.to_data_frame")
+    def __to_road_data_frame(self, rows):
+        """
+        :param rows: list of tuples from __get_road_partition_query
+        :return: dataframe with columns road, depth, speed, nature, identifier, hour, dow
+        """
+        rows = pd.DataFrame.from_records(rows, columns=['road', 'toid', 'time', 'depth', 'hour', 'dow',
+                                                         'length', 'nature', 'street', 'classification'])
+
+        speed = 2.23694 * rows.length.values.astype(float) / (rows.time.values.astype(float) / 100)
+        identifier = np.where(rows.street.fillna('').values.astype(bool), rows.street.values, rows.classification.values)
+
+        return pd.DataFrame({'road':rows.road.values, 'depth':rows.depth.values.astype(float), 'speed':speed,
+                             'nature':rows.nature.values, 'identifier':identifier,
+                             'hour':rows.hour.values.astype(float), 'dow':rows.dow.values.astype(float)})
+
+    def __iter_road_frames(self, conn, query, params, chunk_size):
+        """
+        :param query: query returning rows ordered by road
+        :return: generator of (road, dataframe of every row of the road)
+        """
+        current_road = None
+        pending = []
+
+        for rows in self.__iter_query(conn, query, chunk_size, params):
+            frame = self.__to_road_data_frame(rows)
+            roads = frame.road.values
+
+            # Split the chunk where the road changes
+            boundaries = list(np.flatnonzero(roads[1:] != roads[:-1]) + 1)
+
+            for start, end in zip([0] + boundaries, boundaries + [len(frame)]):
+                road = roads[start]
+
+                if road != current_road and pending:
+                    yield current_road, pd.concat(pending, ignore_index=True).drop('road', axis=1)
+                    pending = []
+
+                current_road = road
+                pending.append(frame.iloc[start:end])
+
+        if pending:
+            yield current_road, pd.concat(pending, ignore_index=True).drop('road', axis=1)
+
+    def __iter_road_data(self, table_pairs, natures, hours, days, chunk_size, roads):
+        """
+        :param roads: list of roads to extract, every road if None
+        :return: generator of (column, road, list of dataframes, one per table pair)
+        """
+        empty = self.__to_road_data_frame([]).drop('road', axis=1)
+
+        with self.__pool.connection() as conn:
+            for column, partition_condition in ROAD_PARTITIONS:
+                streams = [self.__iter_road_frames(conn, *(self.__get_road_partition_query(
+                               traffic_table, rainfall_table, column, partition_condition, natures, hours, days,
+                               roads) + (chunk_size,)))
+                           for traffic_table, rainfall_table in table_pairs]
+                heads = [next(stream, None) for stream in streams]
+
+                # Every stream is ordered by road, merge them on road
+                while any(head is not None for head in heads):
+                    road = min(head[0] for head in heads if head is not None)
+                    frames = []
+
+                    for i, head in enumerate(heads):
+                        if head is not None and head[0] == road:
+                            frames.append(head[1])
+                            heads[i] = next(streams[i], None)
+                        else:
+                            frames.append(empty.copy())
+
+                    yield column, road, frames
+
+    def __get_condition(self):
+        """
+        :return: condition matching any value of an array parameter, so the query text and its plan
+            are the same whatever and however many values are selected
+        """
+        return "= ANY(%s)"
+
+    def __get_array(self, values):
+        """
+        :return: list of values, bound as an array parameter
+        """
+        return list(values)
+
+    def __get_hours_array(self, values):
+        """
+        :param values: hours or days, of any integer type
+        :return: list of ints, bound as an array parameter
+        """
+        return [int(value) for value in values]
+
+    def __execute(self, cur, query, params):
+        """
+        Execute query as a statement prepared once per connection, so repeated selections reuse
+        its parsed query and cached plan instead of planning a new query text every time
+
+        :param query: query with a %s placeholder per parameter
+        :param params: list of parameters
+        """
+        name = "tfl_%s" % hashlib.md5(query).hexdigest()
+
+        with _prepared_lock:
+            prepared = _prepared_statements.setdefault(cur.connection, set())
+
+        if name not in prepared:
+            instrumentation.count("db.statements_prepared")
+            cur.execute("PREPARE %s AS %s" % (name, query % tuple("$%i" % (i + 1) for i in range(len(params)))))
+            # Prepared statements outlive a rollback of the transaction preparing them
+            prepared.add(name)
+
+        cur.execute("EXECUTE %s (%s)" % (name, ", ".join(["%s"] * len(params))), params)
+
+    def __get_toid_frame(self, toid_info):
+        """
+        :param toid_info: dictionary of toid -> (length, nature, identifier)
+        :return: dataframe indexed by toid with columns length, nature, identifier
+        """
+        return pd.DataFrame(list(toid_info.values()), index=list(toid_info.keys()),
+                            columns=['length', 'nature', 'identifier'])
+
+    @instrumentation.timed("db.to_data_frame")
+    def __to_data_frame(self, toid_time_depth, toid_frame):
+        """
+        :param toid_time_depth: list of tuples -> (toid, journey_time, depth, hour, dow)
+        :param toid_frame: dataframe from __get_toid_frame
+        :return: dataframe with columns depth, speed, nature, identifier, hour, dow
+        """
+        rows = pd.DataFrame.from_records(toid_time_depth, columns=['toid', 'time', 'depth', 'hour', 'dow'])
+
+        return self.__rows_to_data_frame(rows, toid_frame)
+
+    @instrumentation.timed("db.rainfall_merge")
+    def __to_indexed_data_frame(self, traffic_rows, selection, rainfall):
+        """
+        :param traffic_rows: list of tuples from __get_traffic_query
+        :param selection: LinkSelection of the toids queried
+        :param rainfall: BoxRainfall of the boxes of selection
+        :return: dataframe as __to_data_frame, the depth of each row summed over the rainfall periods
+            its period contains in every box of its toid
+        """
+        rows = pd.DataFrame.from_records(traffic_rows, columns=['toid', 'time', 'lower', 'upper', 'hour', 'dow', 'repeats'])
+        links = selection.frame.index.get_indexer(rows.toid)
+
+        # Traffic of toids without a grid box is dropped, as by the link_grid join
+        with_boxes = selection.box_counts[links] > 0
+        rows = rows[with_boxes].reset_index(drop=True)
+        links = links[with_boxes]
+
+        pair_rows, pair_boxes = expand_boxes(selection.box_starts[links], selection.box_counts[links], selection.box_codes)
+        lowers = rows.lower.values.astype(np.int64)
+        uppers = rows.upper.values.astype(np.int64)
+
+        # Repeated traffic rows are grouped in the database after the join, so their rainfall is summed once per repeat
+        rows['depth'] = rainfall.get_depths(pair_rows, len(rows), pair_boxes, lowers[pair_rows], uppers[pair_rows],
+                                            rows.repeats.values[pair_rows])
+
+        return self.__rows_to_data_frame(rows, selection.frame)
+
+    def __rows_to_data_frame(self, rows, toid_frame):
+        """
+        :param rows: dataframe with columns toid, time, depth, hour, dow
+        """
+        toid_columns = toid_frame.reindex(rows.toid)
+
+        speed = 2.23694 * toid_columns.length.values / (rows.time.values.astype(float) / 100)
+
+        return pd.DataFrame({'depth':rows.depth.values.astype(float), 'speed':speed,
+                             'nature':toid_columns.nature.values, 'identifier':toid_columns.identifier.values,
+                             'hour':rows.hour.values.astype(float), 'dow':rows.dow.values.astype(float)})
 
     def __get_data(self, traffic_table, rainfall_table, roads, natures, hours, days):
         """
@@ -86,24 +752,254 @@ class DataManager(object):
         :param weekdays: tuple of weekdays
         :return: dataframe with columns depth, speed, nature, identifier
         """
-        toid_info = self.__get_toids(roads, natures)
-        toid_time_depth = self.__get_time_depth(traffic_table, rainfall_table, toid_info.keys(), hours, days)
+        with self.__pool.connection() as conn:
+            with conn.cursor() as cur:
+                toid_info = self.__get_toids(cur, roads, natures)
+                toid_time_depth = self.__get_time_depth(cur, traffic_table, rainfall_table, toid_info.keys(), hours, days)
+
+        return self.__to_data_frame(toid_time_depth, self.__get_toid_frame(toid_info))
+
+    def __get_indexed_selection(self, cur, rainfall_table, roads, natures, hours, days):
+        """
+        :return: (LinkSelection, BoxRainfall of its boxes), None if the selection or its rainfall
+            can not be served from the link index and needs the joins in the database
+        """
+        selection = self.__link_index.select(cur, roads, natures)
+
+        if selection is None:
+            return None
+
+        _, selection_boxes = expand_boxes(selection.box_starts, selection.box_counts, selection.box_codes)
+        box_codes = np.unique(selection_boxes)
+
+        if not len(box_codes):
+            return selection, BoxRainfall([], [], [], [])
+
+        with instrumentation.timer("db.rainfall_query"):
+            self.__execute(cur, *self.__get_box_rainfall_query(rainfall_table, selection.boxes[box_codes].tolist(),
+                                                                  hours, days))
+            rainfall = pd.DataFrame.from_records(cur.fetchall(), columns=['box', 'lower', 'upper', 'depth'])
+
+        try:
+            return selection, BoxRainfall(np.searchsorted(selection.boxes, rainfall.box.values.astype(np.str_)),
+                                          rainfall.lower.values, rainfall.upper.values, rainfall.depth.values)
+        except OverlappingPeriods:
+            return None
+
+    def __get_indexed_data(self, traffic_table, rainfall_table, roads, natures, hours, days):
+        """
+        :return: dataframe as __get_data, None if the selection needs the joins in the database
+        """
+        with self.__pool.connection() as conn:
+            with conn.cursor() as cur:
+                indexed = self.__get_indexed_selection(cur, rainfall_table, roads, natures, hours, days)
+
+                if indexed is None:
+                    return None
+
+                selection, rainfall = indexed
+                traffic_rows = []
+
+                if len(selection.frame):
+                    with instrumentation.timer("db.traffic_query"):
+                        self.__execute(cur, *self.__get_traffic_query(traffic_table, list(selection.frame.index), hours, days))
+                        traffic_rows = cur.fetchall()
+
+                    instrumentation.count("db.rows_fetched", len(traffic_rows))
+
+        return self.__to_indexed_data_frame(traffic_rows, selection, rainfall)
+
+    def __iter_data(self, traffic_table, rainfall_table, roads, natures, hours, days, chunk_size):
+        """
+        :param chunk_size: maximum number of rows per dataframe
+        :return: generator of dataframes with columns depth, speed, nature, identifier
+        """
+        with self.__pool.connection() as conn:
+            if self.__link_index is not None:
+                with conn.cursor() as cur:
+                    indexed = self.__get_indexed_selection(cur, rainfall_table, roads, natures, hours, days)
+
+                if indexed is not None:
+                    selection, rainfall = indexed
+
+                    if len(selection.frame):
+                        query, params = self.__get_traffic_query(traffic_table, list(selection.frame.index), hours, days)
+
+                        for traffic_rows in self.__iter_query(conn, query, chunk_size, params):
+                            yield self.__to_indexed_data_frame(traffic_rows, selection, rainfall)
+                    return
+
+            with conn.cursor() as cur:
+                toid_info = self.__get_toids(cur, roads, natures)
 
-        pd_data = []
+            toid_frame = self.__get_toid_frame(toid_info)
+            query, params = self.__get_time_depth_query(traffic_table, rainfall_table, toid_info.keys(), hours, days)
 
-        for toid, time, depth, hour, dow in toid_time_depth:
-            length, nature, identifier = toid_info[toid]
-            pd_data.append(((2.23694 * (length) / (float(time) / 100)), float(depth), nature, identifier, hour, dow))
+            for toid_time_depth in self.__iter_query(conn, query, chunk_size, params):
+                yield self.__to_data_frame(toid_time_depth, toid_frame)
 
-        if not len(pd_data):
-            speed, depth, natures, identifiers, hours, dows = [], [], [], [], [], []
+    def __get_compact_data(self, traffic_table, rainfall_table, roads, natures, hours, days):
+        """
+        :return: dataframe with COMPACT_DTYPES columns, copied out of the database as csv
+            and parsed straight into typed columns
+        """
+        query, params = self.__get_compact_query(traffic_table, rainfall_table, roads, natures, hours, days)
+        buf = BytesIO()
+
+        with self.__pool.connection() as conn:
+            with conn.cursor() as cur:
+                dtypes = self.__get_compact_dtypes(cur, roads, natures)
+
+                # COPY takes no parameters, they are bound client side
+                with instrumentation.timer("db.copy_compact"):
+                    cur.copy_expert("COPY (%s) TO STDOUT WITH CSV HEADER" % cur.mogrify(query, params), buf)
+
+        buf.seek(0)
+
+        with instrumentation.timer("db.to_data_frame"):
+            data = pd.read_csv(buf, dtype=dtypes, keep_default_na=False, na_values=[''])[COMPACT_COLUMNS]
+
+        instrumentation.count("db.rows_fetched", len(data))
+
+        return data
+
+    def __iter_compact_data(self, traffic_table, rainfall_table, roads, natures, hours, days, chunk_size):
+        """
+        :return: generator of dataframes with COMPACT_DTYPES columns, every one with the same categories
+        """
+        query, params = self.__get_compact_query(traffic_table, rainfall_table, roads, natures, hours, days)
+
+        with self.__pool.connection() as conn:
+            with conn.cursor() as cur:
+                dtypes = self.__get_compact_dtypes(cur, roads, natures)
+
+            for rows in self.__iter_query(conn, query, chunk_size, params):
+                yield self.__to_compact_data_frame(rows, dtypes)
+
+    def __get_distinct(self, query):
+        with self.__pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(query)
+                return [row[0] for row in cur.fetchall()]
+
+    def get_streets(self):
+        """
+        :return: list of every distinct street name in itn_link
+        """
+        return self.__get_distinct("SELECT DISTINCT street FROM itn_link;")
+
+    def get_motorways(self):
+        """
+        :return: list of every distinct motorway classification in itn_link
+        """
+        return self.__get_distinct("SELECT DISTINCT classification FROM itn_link WHERE description = 'Motorway';")
+
+    def get_road_watermarks(self, traffic_tables, natures):
+        """
+        :param traffic_tables: list of traffic tables
+        :return: dictionary of road -> [row count, latest period end] over every traffic table,
+            every street then every motorway classification as in iter_road_data
+        """
+        watermarks = {}
+
+        with self.__pool.connection() as conn:
+            with conn.cursor() as cur:
+                for column, partition_condition in ROAD_PARTITIONS:
+                    for traffic_table in traffic_tables:
+                        self.__execute(cur, *self.__get_watermark_query(traffic_table, column, partition_condition, natures))
+
+                        for road, count, latest in cur.fetchall():
+                            watermark = watermarks.setdefault(road, [0, None])
+                            watermark[0] += count
+                            watermark[1] = max(watermark[1], latest)
+
+        return watermarks
+
+    def materialize_rainfall(self, rainfall_table):
+        """
+        Create or refresh the materialization of a rainfall table: the depth of every grid box summed
+        over each traffic period, so extractions join rainfall on period equality instead of range joining
+        and aggregating the rainfall periods within every traffic period. Refreshes are incremental, only
+        traffic periods from the last one materialized are summed again unless rows were added to or removed
+        from earlier periods. Traffic periods must be the TRAFFIC_PERIOD_MINUTES periods of the traffic tables
+
+        :return: name of the materialized table
+        """
+        materialized_table = rainfall_table + MATERIALIZED_SUFFIX
+
+        with instrumentation.timer("db.materialize_rainfall"):
+            with self.__pool.connection() as conn:
+                try:
+                    with conn.cursor() as cur:
+                        self.__refresh_materialized_rainfall(cur, rainfall_table, materialized_table)
+                    conn.commit()
+                except:
+                    conn.rollback()
+                    raise
+
+        return materialized_table
+
+    def get_data(self, traffic_table, rainfall_table,  roads, natures, hours, days, compact=False):
+        """
+        Repeated selections are served from the extract cache when one is configured.
+        With a link index, toids and grid boxes are read from it and rainfall is summed over
+        traffic periods locally instead of joining itn_link, link_grid and rainfall in the database.
+        With compact, the toid metadata join and speed calculation run in the database
+        and columns are typed: float32 speed and depth, int8 hour and dow,
+        categorical nature and identifier
+        """
+
+        tables = (traffic_table, rainfall_table)
+
+        if self.__cache is not None:
+            data = self.__cache.get(tables, roads, natures, hours, days, compact)
+            if data is not None:
+                instrumentation.count("db.cache_hits")
+                return data
+
+            instrumentation.count("db.cache_misses")
+
+        rainfall_table = self.__get_rainfall_source(rainfall_table)
+
+        if compact:
+            data = self.__get_compact_data(traffic_table, rainfall_table, roads, natures, hours, days)
         else:
-            speed, depth, natures, identifiers, hours, dows = zip(*pd_data)
+            data = None
+
+            if self.__link_index is not None:
+                data = self.__get_indexed_data(traffic_table, rainfall_table, roads, natures, hours, days)
+
+            if data is None:
+                data = self.__get_data(traffic_table, rainfall_table, roads, natures, hours, days)
+
+        if self.__cache is not None:
+            self.__cache.put(tables, roads, natures, hours, days, data, compact)
 
-        df = pd.DataFrame({'depth':depth, 'speed':speed, 'nature':natures, 'identifier':identifiers, 'hour':hours, 'dow':dows})
+        return data
+
+    def iter_road_data(self, table_pairs, natures, hours, days, chunk_size=DEFAULT_CHUNK_SIZE, roads=None):
+        """
+        Extract every street, then every motorway classification, in one streamed pass
+        per table pair instead of one get_data call per road.
+        Yields (column, road, [dataframe per table pair]) with the same columns as get_data,
+        a dataframe is empty when the road has no rows in that table pair.
+        With roads, only the streets and motorway classifications named in it are extracted
+        """
+
+        table_pairs = [(traffic_table, self.__get_rainfall_source(rainfall_table)) for traffic_table, rainfall_table in table_pairs]
+
+        return self.__iter_road_data(table_pairs, natures, hours, days, chunk_size, roads)
+
+    def iter_data(self, traffic_table, rainfall_table, roads, natures, hours, days, chunk_size=DEFAULT_CHUNK_SIZE,
+                  compact=False):
+        """
+        Same selection as get_data, streamed from a server-side cursor as dataframes
+        of at most chunk_size rows so memory stays flat for large selections
+        """
 
-        return df
+        rainfall_table = self.__get_rainfall_source(rainfall_table)
 
-    def get_data(self, traffic_table, rainfall_table,  roads, natures, hours, days):
+        if compact:
+            return self.__iter_compact_data(traffic_table, rainfall_table, roads, natures, hours, days, chunk_size)
 
-        return self.__get_data(traffic_table, rainfall_table, roads, natures, hours, days)
+        return self.__iter_data(traffic_table, rainfall_table, roads, natures, hours, days, chunk_size)
@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+_META_FILE = "meta.json"
+
+class ExtractCache(object):
+    """
+    Disk cache of DataManager extracts. Every extract is stored as one .npy file
+    per column (string columns as integer codes plus their categories) so columns
+    are read back without parsing. Least recently used extracts are evicted once
+    the cache grows past max_bytes
+    """
+
+    def __init__(self, directory=None, max_bytes=None):
+        """
+        :param directory: cache directory, TFL_EXTRACT_CACHE_DIR or extract_cache next to this file
+        :param max_bytes: maximum total size of cached extracts, TFL_EXTRACT_CACHE_BYTES or 2GB
+        """
+        self.directory = directory or os.environ.get(
+            "TFL_EXTRACT_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'extract_cache'))
+        self.max_bytes = max_bytes or int(os.environ.get("TFL_EXTRACT_CACHE_BYTES", 2 * 1024 ** 3))
+        self.__lock = threading.Lock()
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def __get_key(self, tables, roads, natures, hours, days, compact):
+        description = repr((sorted(tables), sorted(tuple(r) for r in roads), sorted(natures),
+                            sorted(int(h) for h in hours), sorted(int(d) for d in days), bool(compact)))
+        return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+    def __entry_directory(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, tables, roads, natures, hours, days, compact=False):
+        """
+        :param tables: (traffic_table, rainfall_table)
+        :return: cached dataframe, None on a miss. Column files are memory mapped while read,
+            but the dataframe holds its own copy of them, the mapping does not survive building it
+        """
+        entry_directory = self.__entry_directory(self.__get_key(tables, roads, natures, hours, days, compact))
+        meta_file = os.path.join(entry_directory, _META_FILE)
+
+        try:
+            with open(meta_file) as f:
+                meta = json.load(f)
+
+            columns = {}
+            for column in meta["columns"]:
+                values = np.load(os.path.join(entry_directory, column["name"] + ".npy"), mmap_mode='r')
+
+                if "categories" in column:
+                    if column["categorical"]:
+                        values = pd.Categorical.from_codes(values, column["categories"])
+                    else:
+                        categories = np.array(column["categories"] + [None], dtype=object)
+                        values = categories[values]
+
+                columns[str(column["name"])] = values
+
+            # Mark as recently used for eviction
+            os.utime(meta_file, None)
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+        return pd.DataFrame(columns, columns=[str(column["name"]) for column in meta["columns"]])
+
+    def put(self, tables, roads, natures, hours, days, data, compact=False):
+        """
+        :param tables: (traffic_table, rainfall_table)
+        :param data: dataframe extracted for this selection
+        """
+        key = self.__get_key(tables, roads, natures, hours, days, compact)
+        temp_directory = None
+
+        try:
+            temp_directory = tempfile.mkdtemp(prefix='.' + key, dir=self.directory)
+            columns = []
+
+            for name in data.columns:
+                values = data[name]
+                column = {"name": name}
+
+                if values.dtype.name == 'category':
+                    column["categorical"] = True
+                    column["categories"] = [c for c in values.cat.categories]
+                    array = values.cat.codes.values
+                elif values.dtype == object:
+                    # Missing values take the code after the last category
+                    column["categorical"] = False
+                    codes, categories = pd.factorize(values)
+                    column["categories"] = list(categories)
+                    array = np.where(codes < 0, len(categories), codes).astype(np.int32)
+                else:
+                    array = values.values
+
+                np.save(os.path.join(temp_directory, name + ".npy"), array)
+                columns.append(column)
+
+            with open(os.path.join(temp_directory, _META_FILE), "w") as f:
+                json.dump({"tables": list(tables), "columns": columns, "created": time.time()}, f)
+
+            # Publish atomically, a concurrent writer of the same extract wins
+            os.rename(temp_directory, self.__entry_directory(key))
+        except (EnvironmentError, TypeError, ValueError):
+            # Failing to cache an extract, eg on a full disk or read-only directory, is never fatal.
+            # EnvironmentError covers the IOError of file writes, not an OSError subclass on python 2
+            pass
+        finally:
+            if temp_directory is not None and os.path.isdir(temp_directory):
+                shutil.rmtree(temp_directory, ignore_errors=True)
+
+        self.__evict()
+
+    def __entries(self):
+        """
+        :return: list of (last used time, size in bytes, entry directory, meta)
+        """
+        entries = []
+
+        for key in os.listdir(self.directory):
+            if key.startswith('.'):
+                continue
+
+            entry_directory = self.__entry_directory(key)
+            meta_file = os.path.join(entry_directory, _META_FILE)
+
+            try:
+                with open(meta_file) as f:
+                    meta = json.load(f)
+                size = sum(os.path.getsize(os.path.join(entry_directory, name)) for name in os.listdir(entry_directory))
+                entries.append((os.path.getmtime(meta_file), size, entry_directory, meta))
+            except (IOError, OSError, ValueError):
+                continue
+
+        return entries
+
+    def __evict(self):
+        with self.__lock:
+            entries = sorted(self.__entries(), key=lambda entry: entry[0])
+            total_size = sum(entry[1] for entry in entries)
+
+            for _, size, entry_directory, _ in entries:
+                if total_size <= self.max_bytes:
+                    break
+                shutil.rmtree(entry_directory, ignore_errors=True)
+                total_size -= size
+
+    def invalidate(self, table=None):
+        """
+        :param table: drop extracts read from this table, every extract if None
+        """
+        with self.__lock:
+            for _, _, entry_directory, meta in self.__entries():
+                if table is None or table in meta["tables"]:
+                    shutil.rmtree(entry_directory, ignore_errors=True)
+
+    def size(self):
+        """
+        :return: total size in bytes of cached extracts
+        """
+        return sum(entry[1] for entry in self.__entries())
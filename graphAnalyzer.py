@@ -1,21 +1,59 @@
-from Tkinter import Tk, Label, Button, Frame, Listbox, MULTIPLE, END, IntVar, Entry, Checkbutton, NE, CENTER, Text
+from Tkinter import Tk, Label, Button, Frame, Listbox, MULTIPLE, END, IntVar, Entry, Checkbutton, NE, CENTER, Text, \
+    NORMAL, DISABLED
 from collections import namedtuple
+from Queue import Queue, Empty
+import itertools
+import os
+import threading
 from scipy.optimize import curve_fit
 import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm
 import numpy as np
 import seaborn as sns
 import pandas as pd
 
-from dataManager import DataManager
+from dataManager import DataManager, MATERIALIZE_RAINFALL_ENV
+from extractCache import ExtractCache
+from linkIndex import LinkIndex
+import instrumentation
+
+# How often the Tk main loop collects the results of the background worker
+POLL_INTERVAL_MS = 100
+
+# Rendering limits so draw time does not grow with the selection: fitted curves are evaluated on
+# CURVE_POINTS depths, raw scatter plots draw at most MAX_SCATTER_POINTS observations and aggregated
+# plots draw observations as a DEPTH_BINS x SPEED_BINS histogram
+CURVE_POINTS = 500
+MAX_SCATTER_POINTS = 20000
+DEPTH_BINS = 100
+SPEED_BINS = 120
+
+# points: dataframe to scatter, None when aggregated. histogram: (counts, depth edges, speed edges)
+# of the observations when aggregated, None otherwise. curves: list of fitted curve dataframes
+PlotData = namedtuple('PlotData', 'points histogram curves xlim ylim')
+
+class RequestCancelled(Exception):
+    """
+    Raised in a worker whose request was cancelled or superseded by a newer selection
+    """
+    pass
 
 class GraphAnalyzer(Frame):
 
     def __init__(self, root):
         Frame.__init__(self, root)
         self.__root = root
-        self.__data_manager = DataManager()
+        self.__cache = ExtractCache()
+        self.__data_manager = DataManager(cache=self.__cache, link_index=LinkIndex(),
+                                          materialized_rainfall=bool(os.environ.get(MATERIALIZE_RAINFALL_ENV)))
         self.__check_button_type = namedtuple('CheckButtonType', 'widget var')
 
+        # Data loading and fitting run on worker threads which only report through this queue,
+        # a request is current until a newer one or a cancel supersedes it
+        self.__results = Queue()
+        self.__request_ids = itertools.count(1)
+        self.__current_request = None
+
         self.__natures = [
             "Single Carriageway", "Traffic Island Link", "Dual Carriageway",
             "Roundabout", "Traffic Island Link At Junction", "Slip Road"
@@ -34,6 +72,8 @@ class GraphAnalyzer(Frame):
         self.__init_grid()
         self.__draw_grid()
 
+        self.__root.after(POLL_INTERVAL_MS, self.__poll_results)
+
     def __init_grid(self):
 
         # Road list
@@ -73,6 +113,14 @@ class GraphAnalyzer(Frame):
                         variable = self.__draw_nature_var, onvalue = 1,
                         offvalue = 0, height=2, width = 20)
 
+        # Check button aggregate data
+        self.__aggregate_var = IntVar()
+        self.__aggregate_var.set(1)
+        self.__aggregate_check_box = \
+            Checkbutton(self.__root, text = "Aggregate data?",
+                        variable = self.__aggregate_var, onvalue = 1,
+                        offvalue = 0, height=2, width = 20)
+
         # Check button show data
         self.__show_data_var = IntVar()
         self.__show_data_var.set(1)
@@ -84,6 +132,10 @@ class GraphAnalyzer(Frame):
         # Go button
         self.__go_button = Button(self.__root, text='GO', command = lambda: self.__generate_graph())
 
+        # Cancel button and progress of the current request
+        self.__cancel_button = Button(self.__root, text='Cancel', state=DISABLED, command = lambda: self.__cancel_request())
+        self.__status_label = Label(self.__root, text="", width=20, justify=CENTER)
+
         # Errors text box
         self.__error_text_box = Text(self.__root, height=28, width=18, fg="red")
         self.__error_text_box.tag_config('justified', justify=CENTER)
@@ -111,9 +163,12 @@ class GraphAnalyzer(Frame):
         self.__draw_overall_check_box.grid(row=1, column=4, rowspan=2)
         self.__draw_nature_check_box.grid(row=3, column=4, rowspan=2)
         self.__show_data_check_box.grid(row=5, column=4, rowspan=2)
+        self.__aggregate_check_box.grid(row=7, column=4, rowspan=2)
 
         # Go button
         self.__go_button.grid(row=10, column=4)
+        self.__cancel_button.grid(row=11, column=4)
+        self.__status_label.grid(row=12, column=4)
 
         # Error Column
         Label(self.__root, text="Error Report", height=1, width=18, justify=CENTER).grid(row=0, column=5)
@@ -138,8 +193,106 @@ class GraphAnalyzer(Frame):
             for e in errors:
                 self.__error_text_box.insert(END, e + '\n', 'justified')
         else:
-            data = self.__data_manager.get_data("traffic", "rainfall", roads, natures, hours, days)
-            self.__plot_data(data)
+            options = (self.__show_data_var.get(), self.__draw_overall_var.get(), self.__draw_nature_var.get(),
+                       self.__aggregate_var.get())
+            self.__start_request(roads, natures, hours, days, options)
+
+    def __start_request(self, roads, natures, hours, days, options):
+        """
+        Load and fit the selection on a worker thread, superseding any request still in flight
+        """
+        request_id = next(self.__request_ids)
+        self.__current_request = request_id
+
+        worker = threading.Thread(target=self.__run_request, args=(request_id, roads, natures, hours, days, options))
+        worker.daemon = True
+        worker.start()
+
+        self.__cancel_button.config(state=NORMAL)
+        self.__status_label.config(text="Loading data")
+
+    def __cancel_request(self):
+        self.__current_request = None
+        self.__cancel_button.config(state=DISABLED)
+        self.__status_label.config(text="Cancelled")
+
+    def __check_request(self, request_id):
+        if request_id != self.__current_request:
+            raise RequestCancelled()
+
+    def __report(self, request_id, message):
+        self.__check_request(request_id)
+        self.__results.put(("progress", request_id, message))
+
+    def __run_request(self, request_id, roads, natures, hours, days, options):
+        """
+        Worker thread body, must not touch any Tk widget or variable
+        """
+        try:
+            data = self.__load_data(request_id, roads, natures, hours, days)
+            plot_data = self.__get_plot_data(request_id, data, options)
+            self.__results.put(("done", request_id, plot_data))
+        except RequestCancelled:
+            pass
+        except Exception, e:
+            self.__results.put(("error", request_id, str(e)))
+
+    @instrumentation.timed("gui.load_data")
+    def __load_data(self, request_id, roads, natures, hours, days):
+        """
+        :return: same dataframe as DataManager.get_data, streamed in chunks so loading reports progress
+            and stops soon after the request is superseded
+        """
+        data = self.__cache.get(("traffic", "rainfall"), roads, natures, hours, days)
+
+        if data is not None:
+            return data
+
+        chunks = []
+        rows = 0
+
+        for chunk in self.__data_manager.iter_data("traffic", "rainfall", roads, natures, hours, days):
+            chunks.append(chunk)
+            rows += len(chunk)
+            self.__report(request_id, "Loaded %i rows" % rows)
+
+        if not chunks:
+            raise ValueError("No data for selection")
+
+        data = pd.concat(chunks, ignore_index=True)
+        self.__cache.put(("traffic", "rainfall"), roads, natures, hours, days, data)
+
+        return data
+
+    def __poll_results(self):
+        """
+        Apply the messages of the current request on the Tk main thread, those of superseded requests are dropped
+        """
+        try:
+            while True:
+                kind, request_id, value = self.__results.get_nowait()
+
+                if request_id != self.__current_request:
+                    continue
+
+                if kind == "progress":
+                    self.__status_label.config(text=value)
+                    continue
+
+                self.__current_request = None
+                self.__cancel_button.config(state=DISABLED)
+
+                if kind == "error":
+                    self.__status_label.config(text="Failed")
+                    self.__error_text_box.delete("1.0",END)
+                    self.__error_text_box.insert(END, value + '\n', 'justified')
+                else:
+                    self.__status_label.config(text="Done")
+                    self.__plot_data(value)
+        except Empty:
+            pass
+
+        self.__root.after(POLL_INTERVAL_MS, self.__poll_results)
 
     def __error_check(self, roads, natures, hours, days):
 
@@ -161,36 +314,81 @@ class GraphAnalyzer(Frame):
         return errors
 
 
-    def __plot_data(self, data):
+    @instrumentation.timed("gui.plot_data")
+    def __get_plot_data(self, request_id, data, options):
+        """
+        :param options: (show data, draw overall curve, draw curve per nature, aggregate data)
+        :return: PlotData, binned or capped so that drawing it takes bounded time
+        """
+        show_data, draw_overall, draw_nature, aggregate = options
 
         max_depth = data.depth.max()
         max_speed = data.speed.max()
 
+        ylim = 120 if max_speed > 200 else max_speed
+        xlim = 1.0 if max_depth < 1.0 else 2.0
+
+        curves = []
+
+        if draw_overall:
+            self.__report(request_id, "Fitting overall curve")
+            curves.append(self.__get_best_fit_curve(data, max_depth, max_speed, "Best fit curve"))
+
+        if draw_nature:
+            for nature, nature_df in data.groupby(['nature']):
+                self.__report(request_id, "Fitting %s" % nature)
+                curves.append(self.__get_best_fit_curve(nature_df, max_depth, max_speed, nature))
+
+        if aggregate:
+            histogram = None
+
+            if show_data:
+                self.__report(request_id, "Binning %i rows" % len(data))
+                histogram = np.histogram2d(data.depth.values, data.speed.values, bins=(DEPTH_BINS, SPEED_BINS),
+                                           range=[[0, xlim], [0, ylim]])
+
+            return PlotData(None, histogram, curves, xlim, ylim)
+
         dfs_to_plot = []
 
-        if self.__show_data_var.get():
+        if show_data:
+            if len(data) > MAX_SCATTER_POINTS:
+                data = data.sample(MAX_SCATTER_POINTS, random_state=0)
             dfs_to_plot.append(data)
 
-        if self.__draw_overall_var.get():
-            dfs_to_plot.append(self.__get_best_fit_curve(data, max_depth, max_speed, "Best fit curve"))
+        return PlotData(pd.concat(dfs_to_plot + curves, ignore_index=True), None, curves, xlim, ylim)
 
-        if self.__draw_nature_var.get():
-            for nature, nature_df in data.groupby(['nature']):
-                dfs_to_plot.append(self.__get_best_fit_curve(nature_df, max_depth, max_speed, nature))
+    @instrumentation.timed("gui.draw")
+    def __plot_data(self, plot_data):
+
+        if plot_data.points is not None:
+            fg = sns.FacetGrid(data=plot_data.points, hue='nature', aspect=1.9, legend_out=False, size=8)
 
-        data = pd.concat(dfs_to_plot, ignore_index=True)
+            fg.map(plt.scatter, 'depth', 'speed', s=20).add_legend(None, "Legend")
+            axes = fg.axes
 
-        fg = sns.FacetGrid(data=data, hue='nature', aspect=1.9, legend_out=False, size=8)
+            axes[0,0].set_ylim(0,plot_data.ylim)
+            axes[0,0].set_xlim(0,plot_data.xlim)
+        else:
+            figure, axis = plt.subplots(figsize=(15.2, 8))
 
-        fg.map(plt.scatter, 'depth', 'speed', s=20).add_legend(None, "Legend")
-        axes = fg.axes
+            if plot_data.histogram is not None:
+                counts, depth_edges, speed_edges = plot_data.histogram
+                mesh = axis.pcolormesh(depth_edges, speed_edges, np.ma.masked_equal(counts.T, 0),
+                                       cmap='Greys', norm=LogNorm())
+                figure.colorbar(mesh, ax=axis, label="Observations")
 
+            for curve in plot_data.curves:
+                if len(curve):
+                    axis.plot(curve.depth.values, curve.speed.values, label=curve.nature.iloc[0])
 
-        ylim = 120 if max_speed > 200 else max_speed
-        xlim = 1.0 if max_depth < 1.0 else 2.0
+            if any(len(curve) for curve in plot_data.curves):
+                axis.legend(title="Legend")
 
-        axes[0,0].set_ylim(0,ylim)
-        axes[0,0].set_xlim(0,xlim)
+            axis.set_xlabel('depth')
+            axis.set_ylabel('speed')
+            axis.set_ylim(0,plot_data.ylim)
+            axis.set_xlim(0,plot_data.xlim)
 
         sns.plt.show()
 
@@ -202,16 +400,13 @@ class GraphAnalyzer(Frame):
         except RuntimeError:
             return pd.DataFrame({'depth':[], 'speed':[], 'nature':[], 'identifier':[]})
 
-        a = popt[0]
-        b = popt[1]
-        c = popt[2]
-
-        depths = list(np.arange(0, max_depth, max_depth/10000.0))
-        speeds = map(lambda x: self.curve_func(x, a, b, c), depths)
+        depths = np.linspace(0, max_depth, CURVE_POINTS, endpoint=False)
+        speeds = self.curve_func(depths, *popt)
 
-        if max(speeds) > max_speed:
-            speeds = [s for s in speeds if s <= max_speed]
-            depths = depths[0:len(speeds)]
+        # Drop the part of the curve above the observed speeds
+        within = speeds <= max_speed
+        depths = depths[within]
+        speeds = speeds[within]
 
         natures = [nature_str] * len(depths)
         identifiers = [''] * len(depths)
@@ -0,0 +1,333 @@
+"""
+Lightweight timers and counters for the extraction, fitting and prediction pipeline.
+
+Instrumentation is off by default: timer returns a shared no-op context manager, count
+returns at once and counted returns the function unchanged, so instrumented code pays
+for little more than a global lookup. Once enabled, every timer accumulates its call
+count, total and maximum duration, counters accumulate their values and cProfile can
+optionally capture the whole run. get_report and write_report produce a json report.
+
+Setting the TFL_METRICS environment variable to a file name enables instrumentation
+when this module is first imported and writes the report there when the process exits,
+TFL_PROFILE=1 also profiles the run.
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import timeit
+import threading
+import cProfile
+import pstats
+from functools import wraps
+
+METRICS_ENV = "TFL_METRICS"
+PROFILE_ENV = "TFL_PROFILE"
+
+# Number of functions, by cumulative time, in the profile section of the report
+PROFILE_TOP = 40
+
+_clock = timeit.default_timer
+
+_enabled = False
+_lock = threading.Lock()
+_pid = os.getpid()
+_started = None
+_start_clock = None
+
+# name -> [calls, total seconds, maximum seconds]
+_timers = {}
+# name -> value
+_counters = {}
+
+_profiler = None
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+class _Timer(object):
+
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = _clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        add_time(self.name, _clock() - self.start)
+        return False
+
+def enable(profile=False):
+    """
+    Start recording, keeping anything recorded so far
+
+    :param profile: also capture a cProfile profile of this process
+    """
+    global _enabled, _started, _start_clock, _profiler
+
+    with _lock:
+        if _started is None:
+            _started = time.strftime("%Y-%m-%dT%H:%M:%S")
+            _start_clock = _clock()
+
+        if profile and _profiler is None:
+            _profiler = cProfile.Profile()
+            _profiler.enable()
+
+        _enabled = True
+
+def disable():
+    """
+    Stop recording and profiling, recorded metrics are kept for the report
+    """
+    global _enabled
+
+    with _lock:
+        _enabled = False
+
+        if _profiler is not None:
+            _profiler.disable()
+
+def is_enabled():
+    return _enabled
+
+def reset():
+    """
+    Discard every recorded timer, counter and profile
+    """
+    global _started, _start_clock, _profiler
+
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+
+        if _profiler is not None:
+            _profiler.disable()
+            _profiler = None
+
+        _started = time.strftime("%Y-%m-%dT%H:%M:%S") if _enabled else None
+        _start_clock = _clock() if _enabled else None
+
+def add_time(name, seconds):
+    with _lock:
+        timer = _timers.get(name)
+
+        if timer is None:
+            _timers[name] = [1, seconds, seconds]
+        else:
+            timer[0] += 1
+            timer[1] += seconds
+            if seconds > timer[2]:
+                timer[2] = seconds
+
+def timer(name):
+    """
+    :return: context manager adding the duration of its block to the timer name, a no-op while disabled
+    """
+    if not _enabled:
+        return _NULL_TIMER
+
+    return _Timer(name)
+
+def timed(name):
+    """
+    :return: decorator timing every call of a function under name while enabled
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+
+            start = _clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                add_time(name, _clock() - start)
+
+        return wrapper
+
+    return decorator
+
+def count(name, value=1):
+    """
+    Add value to the counter name while enabled
+    """
+    if not _enabled:
+        return
+
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+def counted(name, function):
+    """
+    :return: function counting its calls under name while enabled, function itself while disabled
+    """
+    if not _enabled:
+        return function
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        count(name)
+        return function(*args, **kwargs)
+
+    return wrapper
+
+def __check_pid():
+    """
+    Discard the metrics and profiler a forked process inherited from its parent, they are reported by the parent
+    """
+    global _pid, _profiler
+
+    if _pid == os.getpid():
+        return
+
+    with _lock:
+        _pid = os.getpid()
+        _timers.clear()
+        _counters.clear()
+
+        if _profiler is not None:
+            _profiler.disable()
+            _profiler = None
+
+def collect():
+    """
+    :return: (timers, counters) recorded by this process since the last collect, which are then cleared
+    """
+    __check_pid()
+
+    with _lock:
+        metrics = (dict((name, list(timer)) for name, timer in _timers.iteritems()), dict(_counters))
+        _timers.clear()
+        _counters.clear()
+
+    return metrics
+
+def merge(metrics):
+    """
+    :param metrics: (timers, counters) from collect, typically returned by a worker process
+    """
+    timers, counters = metrics
+
+    with _lock:
+        for name, (calls, seconds, maximum) in timers.iteritems():
+            timer = _timers.setdefault(name, [0, 0.0, 0.0])
+            timer[0] += calls
+            timer[1] += seconds
+            timer[2] = max(timer[2], maximum)
+
+        for name, value in counters.iteritems():
+            _counters[name] = _counters.get(name, 0) + value
+
+def _run_collected(function, args):
+    __check_pid()
+    return function(*args), collect()
+
+def _run_collected_item(function_item):
+    function, item = function_item
+    return _run_collected(function, (item,))
+
+class _CollectedResult(object):
+
+    def __init__(self, async_result):
+        self.__async_result = async_result
+
+    def get(self, timeout=None):
+        result, metrics = self.__async_result.get(timeout)
+        merge(metrics)
+        return result
+
+def apply_async(pool, function, args=()):
+    """
+    pool.apply_async, except that while enabled the metrics the worker records during the call
+    are merged into this process when the result is got
+    """
+    if not _enabled:
+        return pool.apply_async(function, args)
+
+    return _CollectedResult(pool.apply_async(_run_collected, (function, args)))
+
+def pool_map(pool, function, iterable, chunksize=None):
+    """
+    pool.map, except that while enabled the metrics the workers record are merged into this process
+    """
+    if not _enabled:
+        return pool.map(function, iterable, chunksize)
+
+    results = []
+
+    for result, metrics in pool.map(_run_collected_item, [(function, item) for item in iterable], chunksize):
+        merge(metrics)
+        results.append(result)
+
+    return results
+
+def __get_profile_report():
+    """
+    :return: list of the PROFILE_TOP functions with the largest cumulative time
+    """
+    _profiler.disable()
+    try:
+        stats = pstats.Stats(_profiler).stats
+    finally:
+        if _enabled:
+            _profiler.enable()
+
+    rows = sorted(stats.iteritems(), key=lambda item: item[1][3], reverse=True)[:PROFILE_TOP]
+
+    return [{"function": "%s:%s(%s)" % key, "calls": calls, "primitive_calls": primitive_calls,
+             "total_seconds": total, "cumulative_seconds": cumulative}
+            for key, (primitive_calls, calls, total, cumulative, callers) in rows]
+
+def get_report():
+    """
+    :return: dictionary of the run (start, wall time, process, command line), every timer with its calls,
+        total seconds, mean and maximum milliseconds, every counter and, when profiling, the top functions
+    """
+    with _lock:
+        timers = dict((name, list(timer)) for name, timer in _timers.iteritems())
+        counters = dict(_counters)
+
+    report = {
+        "started": _started,
+        "wall_seconds": _clock() - _start_clock if _start_clock is not None else None,
+        "pid": os.getpid(),
+        "argv": sys.argv,
+        "timers": dict((name, {"calls": calls, "seconds": seconds, "mean_ms": seconds * 1e3 / calls,
+                               "max_ms": maximum * 1e3})
+                       for name, (calls, seconds, maximum) in timers.iteritems()),
+        "counters": counters
+    }
+
+    if _profiler is not None:
+        report["profile"] = __get_profile_report()
+
+    return report
+
+def write_report(file_name):
+    """
+    Write the json report to file_name and, when profiling, the raw profile to file_name.prof
+    """
+    with open(file_name + ".tmp", "wb") as f:
+        json.dump(get_report(), f, indent=2, sort_keys=True)
+
+    os.rename(file_name + ".tmp", file_name)
+
+    if _profiler is not None:
+        _profiler.dump_stats(file_name + ".prof")
+
+if os.environ.get(METRICS_ENV):
+    enable(profile=bool(os.environ.get(PROFILE_ENV)))
+    atexit.register(write_report, os.environ[METRICS_ENV])
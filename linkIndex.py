@@ -0,0 +1,230 @@
+import os
+import threading
+import numpy as np
+import pandas as pd
+from collections import namedtuple
+
+# Columns a selection can filter on, as in DataManager.get_data
+INDEX_COLUMNS = ('toid', 'street', 'classification', 'nature')
+
+# Rainfall depths are summed as integers of this many units per millimeter, so sums are exact
+# like the numeric sums of the database
+DEPTH_SCALE = 1000000
+
+# Links selected from the index: frame indexed by toid with columns length, nature and identifier,
+# and the first and number of entries of box_codes holding the grid boxes of every row of frame
+LinkSelection = namedtuple('LinkSelection', 'frame box_starts box_counts box_codes boxes')
+
+class OverlappingPeriods(ValueError):
+    pass
+
+class LinkIndex(object):
+    """
+    Local index of every itn_link toid with its length, nature, street and classification, and the
+    rainfall grid boxes of link_grid it intersects. It is persisted to disk so extractions select
+    toids and their boxes without querying itn_link and link_grid, and is rebuilt when the row count
+    of either table changes
+    """
+
+    def __init__(self, file_name=None):
+        """
+        :param file_name: index file, TFL_LINK_INDEX or link_index.npz next to this file
+        """
+        self.file_name = file_name or os.environ.get(
+            "TFL_LINK_INDEX", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'link_index.npz'))
+        self.__lock = threading.Lock()
+        self.__index = None
+
+    def __get_signature(self, cur):
+        cur.execute("SELECT (SELECT COUNT(*) FROM itn_link), (SELECT COUNT(*) FROM link_grid)")
+        return np.array(cur.fetchone(), dtype=np.int64)
+
+    def __build(self, cur, signature):
+        """
+        :return: dictionary of index arrays, links sorted by toid with the boxes of link i
+            in boxes[box_codes[box_offsets[i]:box_offsets[i + 1]]]
+        """
+        cur.execute("SELECT toid, length, nature, street, classification FROM itn_link")
+        links = pd.DataFrame.from_records(cur.fetchall(), columns=['toid', 'length', 'nature', 'street', 'classification'])
+
+        # Sorted here, the database collation may order toids differently
+        links = links.iloc[np.argsort(links.toid.values.astype(np.str_), kind='mergesort')]
+
+        cur.execute("SELECT toid, box FROM link_grid")
+        grid = pd.DataFrame.from_records(cur.fetchall(), columns=['toid', 'box'])
+
+        toids = links.toid.values.astype(np.str_)
+        grid_toids = grid.toid.values.astype(np.str_)
+
+        # Grid rows of toids missing from itn_link are never selected, duplicate rows are kept
+        # since the database join counts their rainfall once per row
+        positions = np.searchsorted(toids, grid_toids)
+        known = positions < len(toids)
+        known[known] = toids[positions[known]] == grid_toids[known]
+        positions = positions[known]
+        grid_boxes = grid.box.values[known]
+
+        order = np.argsort(positions, kind='mergesort')
+        boxes, box_codes = np.unique(grid_boxes[order].astype(np.str_), return_inverse=True)
+
+        return {
+            "signature": signature,
+            "toid": toids,
+            "length": links.length.values.astype(np.float64),
+            "nature": links.nature.fillna('').values.astype(np.str_),
+            "street": links.street.fillna('').values.astype(np.str_),
+            "classification": links.classification.fillna('').values.astype(np.str_),
+            "box_offsets": np.concatenate(([0], np.cumsum(np.bincount(positions, minlength=len(toids))))).astype(np.int64),
+            "box_codes": box_codes.astype(np.int32),
+            "boxes": boxes
+        }
+
+    def __load_file(self, signature):
+        """
+        :return: dictionary of index arrays, None if there is no index file or it is out of date
+        """
+        try:
+            with np.load(self.file_name) as index_file:
+                index = dict((name, index_file[name]) for name in index_file.files)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if not np.array_equal(index.get("signature"), signature):
+            return None
+
+        return index
+
+    def __save(self, index):
+        try:
+            with open(self.file_name + ".tmp", "wb") as f:
+                np.savez(f, **index)
+            os.rename(self.file_name + ".tmp", self.file_name)
+        except (IOError, OSError):
+            # Failing to persist the index is never fatal, it is rebuilt next time
+            pass
+
+    def __get_index(self, cur):
+        with self.__lock:
+            if self.__index is None:
+                signature = self.__get_signature(cur)
+                index = self.__load_file(signature)
+
+                if index is None:
+                    index = self.__build(cur, signature)
+                    self.__save(index)
+
+                self.__index = index
+
+            return self.__index
+
+    def refresh(self, cur):
+        """
+        Rebuild the index from itn_link and link_grid
+        """
+        with self.__lock:
+            self.__index = self.__build(cur, self.__get_signature(cur))
+            self.__save(self.__index)
+
+    def select(self, cur, filters, natures):
+        """
+        :param cur: cursor the index is loaded or built with, on first use in this process
+        :param filters: list of (column, column_value) eg (street, "OXFORD STREET")
+        :param natures: list of natures
+        :return: LinkSelection of the links matching any filter with one of the natures,
+            None if a filter column is not held by the index
+        """
+        column_values = {}
+        for column, value in filters:
+            if column not in INDEX_COLUMNS:
+                return None
+            column_values.setdefault(column, []).append(value)
+
+        index = self.__get_index(cur)
+
+        mask = np.zeros(len(index["toid"]), dtype=bool)
+        for column, values in column_values.iteritems():
+            mask |= np.in1d(index[column], np.array(values, dtype=np.str_))
+        mask &= np.in1d(index["nature"], np.array(natures, dtype=np.str_))
+
+        positions = np.flatnonzero(mask)
+        street = index["street"][positions]
+        identifier = np.where(street != '', street, index["classification"][positions]).astype(object)
+        identifier[identifier == ''] = None
+
+        frame = pd.DataFrame({'length': index["length"][positions], 'nature': index["nature"][positions].astype(object),
+                              'identifier': identifier},
+                             index=index["toid"][positions].astype(object), columns=['length', 'nature', 'identifier'])
+
+        box_starts = index["box_offsets"][positions]
+        box_counts = index["box_offsets"][positions + 1] - box_starts
+
+        return LinkSelection(frame, box_starts, box_counts, index["box_codes"], index["boxes"])
+
+class BoxRainfall(object):
+    """
+    Rainfall of a set of grid boxes sorted by box then period, summing for traffic periods the depths
+    of the rainfall periods they contain (traffic.period @> rainfall.period) without a range join
+    """
+
+    def __init__(self, box_codes, lowers, uppers, depths):
+        """
+        :param box_codes: index of the box of every rainfall period in LinkSelection.boxes
+        :param lowers: period starts, integer seconds
+        :param uppers: period ends, integer seconds
+        :param depths: depths in 1 / DEPTH_SCALE millimeters summed over any repeated (box, period)
+        :raise OverlappingPeriods: if periods of a box overlap, their sums need the range join
+        """
+        order = np.lexsort((lowers, box_codes))
+        self.box_codes = np.asarray(box_codes, dtype=np.int64)[order]
+        self.lowers = np.asarray(lowers, dtype=np.int64)[order]
+        self.uppers = np.asarray(uppers, dtype=np.int64)[order]
+        self.cumulative_depths = np.concatenate(([0], np.cumsum(np.asarray(depths, dtype=np.int64)[order])))
+
+        same_box = self.box_codes[1:] == self.box_codes[:-1]
+        if np.any(same_box & (self.uppers[:-1] > self.lowers[1:])):
+            raise OverlappingPeriods("Rainfall periods of a grid box overlap")
+
+    def get_depths(self, rows, n_rows, box_codes, lowers, uppers, repeats=1):
+        """
+        :param rows: traffic row of every (traffic period, box) pair
+        :param box_codes: box of every pair
+        :param lowers: traffic period start of every pair, integer seconds
+        :param uppers: traffic period end of every pair, integer seconds
+        :param repeats: number of times the depths of every pair are counted
+        :return: depth in millimeters of every traffic row, summed over the rainfall periods
+            of its boxes within [lower, upper)
+        """
+        box_codes = np.asarray(box_codes, dtype=np.int64)
+
+        if not len(self.lowers) or not len(box_codes):
+            return np.zeros(n_rows)
+
+        origin = min(self.lowers.min(), np.min(lowers))
+        span = max(self.uppers.max(), np.max(uppers)) - origin + 1
+
+        # Periods are sorted by box then start, so a single key orders them
+        keys = self.box_codes * span + (self.lowers - origin)
+        starts = np.searchsorted(keys, box_codes * span + (lowers - origin), side='left')
+        ends = np.searchsorted(keys, box_codes * span + (uppers - origin), side='left')
+
+        depths = self.cumulative_depths[ends] - self.cumulative_depths[starts]
+
+        # Periods of a box do not overlap, so only the last one starting within a traffic period can end after it
+        straddling = (ends > starts) & (self.uppers[np.maximum(ends - 1, 0)] > uppers)
+        last = ends[straddling] - 1
+        depths[straddling] -= self.cumulative_depths[last + 1] - self.cumulative_depths[last]
+        depths *= repeats
+
+        # Integer sums below 2 ** 53 are exact in float64
+        return np.bincount(rows, weights=depths, minlength=n_rows) / float(DEPTH_SCALE)
+
+def expand_boxes(box_starts, box_counts, box_codes):
+    """
+    :param box_starts: first entry in box_codes of the boxes of every row
+    :param box_counts: number of boxes of every row
+    :return: (row, box code) of every (row, box) pair
+    """
+    rows = np.repeat(np.arange(len(box_counts)), box_counts)
+    pair_offsets = np.arange(len(rows)) - np.repeat(np.cumsum(box_counts) - box_counts, box_counts)
+
+    return rows, box_codes[np.repeat(box_starts, box_counts) + pair_offsets]
@@ -0,0 +1,119 @@
+"""
+Registry of the model families relating rainfall depth, day type and hour to traffic speed.
+
+The fitter searches every registered family and stores the index of the best one as best_function,
+rainbreaker evaluates road models through the same index, so families are only ever appended.
+"""
+import numpy as np
+from collections import namedtuple
+
+# Parameters held per model in the compiled rainbreaker model store
+MAX_PARAMETERS = 9
+
+# residual(params, speed, rainfall_depth, day, hour) is minimised by the fitter,
+# predict(params, rainfall_depth, day, hour) broadcasts over arrays,
+# jacobian(params, speed, rainfall_depth, day, hour) returns one row per parameter
+# and bounds is the (lower, upper) parameter arrays of bounded fits
+ModelFamily = namedtuple('ModelFamily', 'name residual predict jacobian initial n_parameters bounds')
+
+_families = []
+
+# Predictors by family index, updated in place as families are registered
+predictors = []
+
+def register_family(name, residual, predict, jacobian, initial, bounds=None):
+    """
+    :param jacobian: analytic Jacobian of residual, finite differences are used if None
+    :param initial: initial parameters of the fit
+    :param bounds: (lower, upper) parameter bounds of bounded fits, unbounded if None
+    :return: index of the family, the best_function value of models fitted with it
+    """
+    initial = np.asarray(initial, dtype=np.float64)
+
+    if len(initial) > MAX_PARAMETERS:
+        raise ValueError("Model family can not have more than %s parameters" % MAX_PARAMETERS)
+
+    if bounds is None:
+        bounds = (-np.inf, np.inf)
+
+    bounds = tuple(np.broadcast_to(np.asarray(bound, dtype=np.float64), initial.shape).copy() for bound in bounds)
+
+    if np.any(initial < bounds[0]) or np.any(initial > bounds[1]):
+        raise ValueError("Initial parameters of %s are out of its bounds" % name)
+
+    _families.append(ModelFamily(name, residual, predict, jacobian, initial, len(initial), bounds))
+    predictors.append(predict)
+
+    return len(_families) - 1
+
+def get_family(index):
+    return _families[index]
+
+def get_families():
+    """
+    :return: list of every ModelFamily, in index order
+    """
+    return list(_families)
+
+def power_terms(base, exponent):
+  """
+  :return: (base ** exponent, its derivative with respect to exponent), the derivative taken as 0 where base is 0
+  """
+  power = base ** exponent
+  log_base = np.log(np.where(base > 0, base, 1))
+  return power, power * log_base
+
+def func0(params, speed, rainfall_depth, day, hour):
+  return plot_func0(params, rainfall_depth, day, hour) - speed
+
+def plot_func0(params, rainfall_depth, day, hour):
+  p0, e0, p1, e1, p2, e2, c = params
+  return p0 * rainfall_depth ** e0 + p1 * day ** e1 + p2 * hour ** e2 + c
+
+def jac0(params, speed, rainfall_depth, day, hour):
+  p0, e0, p1, e1, p2, e2, c = params
+  depth_power, depth_log = power_terms(rainfall_depth, e0)
+  day_power, day_log = power_terms(day, e1)
+  hour_power, hour_log = power_terms(hour, e2)
+  return np.vstack([depth_power, p0 * depth_log, day_power, p1 * day_log, hour_power, p2 * hour_log,
+                    np.ones_like(rainfall_depth)])
+
+def func1(params, speed, rainfall_depth, day, hour):
+  return plot_func1(params, rainfall_depth, day, hour) - speed
+
+def plot_func1(params, rainfall_depth, day, hour):
+  p0, p1, e1, p2, e2, p3, e3, c = params
+  return p0 * np.exp(p1 * rainfall_depth ** e1 + p2 * hour ** e2) + p3 * day ** e3 + c
+
+def jac1(params, speed, rainfall_depth, day, hour):
+  p0, p1, e1, p2, e2, p3, e3, c = params
+  depth_power, depth_log = power_terms(rainfall_depth, e1)
+  hour_power, hour_log = power_terms(hour, e2)
+  day_power, day_log = power_terms(day, e3)
+  exponential = np.exp(p1 * depth_power + p2 * hour_power)
+  return np.vstack([exponential, p0 * exponential * depth_power, p0 * exponential * p1 * depth_log,
+                    p0 * exponential * hour_power, p0 * exponential * p2 * hour_log, day_power, p3 * day_log,
+                    np.ones_like(rainfall_depth)])
+
+def func2(params, speed, rainfall_depth, day, hour):
+  return plot_func2(params, rainfall_depth, day, hour) - speed
+
+def plot_func2(params, rainfall_depth, day, hour):
+  p0, e0, p1, e1, p2, p3, p4, p5, c = params
+  return p0 * rainfall_depth ** e0 + p1 * day ** e1 + p2 * hour ** 4  + p3 * hour ** 3 + p4 * hour ** 2 + p5 * hour + c
+
+def jac2(params, speed, rainfall_depth, day, hour):
+  p0, e0, p1, e1, p2, p3, p4, p5, c = params
+  depth_power, depth_log = power_terms(rainfall_depth, e0)
+  day_power, day_log = power_terms(day, e1)
+  return np.vstack([depth_power, p0 * depth_log, day_power, p1 * day_log, hour ** 4, hour ** 3, hour ** 2, hour,
+                    np.ones_like(rainfall_depth)])
+
+# Bounded fits keep exponents non negative, depth, day and hour are 0 for some rows and a negative
+# exponent makes their term infinite there
+register_family("power", func0, plot_func0, jac0, [1,1,1,1,1,1,1],
+                ([-np.inf, 0, -np.inf, 0, -np.inf, 0, -np.inf], np.inf))
+register_family("exponential", func1, plot_func1, jac1, [1,1,1,1,1,1,1,1],
+                ([-np.inf, -np.inf, 0, -np.inf, 0, -np.inf, 0, -np.inf], np.inf))
+register_family("quartic_hour", func2, plot_func2, jac2, [1,1,1,1,1,1,1,1,1],
+                ([-np.inf, 0, -np.inf, 0, -np.inf, -np.inf, -np.inf, -np.inf, -np.inf], np.inf))
@@ -1,218 +1,824 @@
-import psycopg2
 import os
+import argparse
+import multiprocessing
 import numpy as np
-from scipy.optimize import leastsq
+from scipy.optimize import leastsq, least_squares
 import matplotlib
 matplotlib.use('Agg') # For saving figures over ssh
 import matplotlib.pyplot as plt
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
 import json
 from dataManager import DataManager
+import rainbreaker
+import model_families
+import instrumentation
 
 plot_directory = os.path.join((os.path.dirname(__file__)), 'road_plots')
+prediction_directory = os.path.join((os.path.dirname(__file__)), 'road_predictions')
+
+# Axes reused for every plot rendered by this process
+_plot_axes = None
+
+ERROR_QUANTILES = (0.5, 0.9, 0.99)
+BACKENDS = ("leastsq", "least_squares")
+SEARCHES = ("exhaustive", "pruned")
+
+# Training sets smaller than this are screened in full by the pruned search
+MIN_SUBSAMPLE_ROWS = 100
+
+def to_array(values):
+    """
+    :return: contiguous float64 array of a series, so model functions do no index alignment or dtype dispatch
+    """
+    return np.ascontiguousarray(values, dtype=np.float64)
+
+def get_best_params(df, func, initial, jac=None, backend="leastsq", bounds=(-np.inf, np.inf)):
+    """
+    :param jac: analytic Jacobian of func, one row per parameter, finite differences if None
+    :param backend: leastsq, or least_squares to fit within bounds
+    :param bounds: (lower, upper) parameter bounds of least_squares, initial is clipped into them
+    """
+    args = (to_array(df.speed), to_array(df.depth), to_array(df.dow), to_array(df.hour))
+
+    func = instrumentation.counted("fit.function_evaluations", func)
+    if jac is not None:
+        jac = instrumentation.counted("fit.jacobian_evaluations", jac)
+
+    with instrumentation.timer("fit." + backend):
+        if backend == "least_squares":
+            jac_rows = (lambda params, *args: jac(params, *args).T) if jac is not None else "2-point"
+            # Warm start parameters of an unbounded fit may be out of bounds
+            initial = np.clip(initial, bounds[0], bounds[1])
+            result = least_squares(func, initial, jac=jac_rows, bounds=bounds, args=args, max_nfev=1000*(len(initial) + 1))
+            return result.x
+
+        popt, _ = leastsq(func, initial, args=args, Dfun=jac, col_deriv=1, maxfev=10000*(len(initial) + 1), ftol=10, xtol=10)
+        return popt
+
+@instrumentation.timed("fit.get_statistics")
+def get_statistics(params, plot_func, depth, day, hour, speed):
+    """
+    :return: (predictions, mse, mae) on validation data, every row evaluated at once
+    """
+    preds = plot_func(params, to_array(depth), to_array(day), to_array(hour))
+    diff = preds - to_array(speed)
 
-def get_best_params(df, func, initial):
-    popt, _ = leastsq(func, initial, args=(df.speed, df.depth, df.dow, df.hour), maxfev=10000*(len(initial) + 1), ftol=10, xtol=10)
-    return popt
+    mse = np.mean(diff ** 2)
+    mae = np.mean(np.absolute(diff))
 
-def get_statistics(params, plot_func, depth, day, hour, speed):
+    return preds, mse, mae
 
-    preds = []
-    # Find MSE and MAE on validation data using best function
-    total_sq_error = 0
-    total_error = 0
+def get_error_summary(predictions, speed, quantiles=ERROR_QUANTILES):
+    """
+    :return: dictionary with the R squared of predictions and the quantiles of their absolute errors
+    """
+    speed = to_array(speed)
+    diff = predictions - speed
 
-    for v,d in enumerate(depth):
-        preds.append(plot_func(params, d, day.iloc[v], hour.iloc[v]))
-        diff = preds[v] - speed.iloc[v]
-        total_sq_error += diff ** 2
-        total_error += np.absolute(diff)
-    mse = total_sq_error / len(depth)
-    mae = total_error / len(depth)
+    total_sum_squares = np.sum((speed - speed.mean()) ** 2)
+    r2 = 1 - np.sum(diff ** 2) / total_sum_squares if total_sum_squares else np.nan
 
-    return preds, mse, mae
+    return {
+        "r2": r2,
+        "error_quantiles": dict(zip([str(q) for q in quantiles], np.percentile(np.absolute(diff), [q * 100 for q in quantiles])))
+    }
 
+@instrumentation.timed("plot.render")
 def plot(depths, speeds, predicted_speeds, street, nature):
-    plt.figure()
-    plt.plot(depths, speeds, 'gx')
-    plt.plot(depths, predicted_speeds, 'rx')
-    plt.ylim([0,100])
-    plt.xlim([0,1.5])
-    plt.savefig(os.path.join(plot_directory, "%s_%s" % (street, nature) + ".png"))
-    plt.close()
+    global _plot_axes
+
+    if _plot_axes is None:
+        _plot_axes = plt.figure().add_subplot(111)
+
+    _plot_axes.cla()
+    _plot_axes.plot(depths, speeds, 'gx')
+    _plot_axes.plot(depths, predicted_speeds, 'rx')
+    _plot_axes.set_ylim([0,100])
+    _plot_axes.set_xlim([0,1.5])
+    _plot_axes.figure.savefig(os.path.join(plot_directory, "%s_%s" % (street, nature) + ".png"))
+
+@instrumentation.timed("fit.save_predictions")
+def save_predictions(street, nature, depths, speeds, predicted_speeds):
+    """
+    Save the validation data and predictions of a fit for the plot stage
+    """
+    if not os.path.isdir(prediction_directory):
+        try:
+            os.makedirs(prediction_directory)
+        except OSError:
+            # Created by another worker
+            if not os.path.isdir(prediction_directory):
+                raise
+
+    file_name = os.path.join(prediction_directory, "%s_%s" % (street, nature) + ".npz")
+
+    with open(file_name + ".tmp", "wb") as f:
+        np.savez(f, street=street, nature=nature, depth=to_array(depths), speed=to_array(speeds),
+                 prediction=to_array(predicted_speeds))
+
+    os.rename(file_name + ".tmp", file_name)
+
+def render_prediction(file_name):
+    try:
+        predictions = np.load(file_name)
+        plot(predictions["depth"], predictions["speed"], predictions["prediction"],
+             str(predictions["street"]), str(predictions["nature"]))
+    except Exception, e:
+        print str(e)
+        print("%s plot failed" % file_name)
+        instrumentation.count("plot.failures")
+
+def render_plots(pool=None, force=False):
+    """
+    Render the plot of every saved prediction whose plot is missing or older than it
+
+    :param pool: multiprocessing pool to render in, rendered in process if None
+    :param force: render every saved prediction
+    """
+    if not os.path.isdir(prediction_directory):
+        return
+
+    file_names = []
+
+    for name in sorted(os.listdir(prediction_directory)):
+        if not name.endswith(".npz"):
+            continue
+
+        file_name = os.path.join(prediction_directory, name)
+        plot_file_name = os.path.join(plot_directory, name[:-len(".npz")] + ".png")
 
-conn = psycopg2.connect(database="tfl", user="tfl", password="tfl", host="127.0.0.1", port=9999)
-cur = conn.cursor()
+        if force or not os.path.exists(plot_file_name) or \
+                os.path.getmtime(plot_file_name) < os.path.getmtime(file_name):
+            file_names.append(file_name)
 
-cur.execute("select distinct classification from itn_link where description = 'Motorway';")
-motorways = [("classification", m[0].replace("'", "''")) for m in cur.fetchall()]
+    print "Rendering %s plots" % len(file_names)
 
-cur.execute('select distinct street from itn_link;')
-streets = [("street", s[0].replace("'", "''")) for s in cur.fetchall()]
+    if pool is None:
+        map(render_prediction, file_names)
+    else:
+        instrumentation.pool_map(pool, render_prediction, file_names, chunksize=16)
 
 natures = [
     "Single Carriageway", "Traffic Island Link", "Dual Carriageway",
     "Roundabout", "Traffic Island Link At Junction", "Slip Road"
 ]
 
-dM = DataManager()
- 
 def days_to_binary(day):
     if day == 0 or day == 6:
         return 0
     return 1
 
-def func0(params, speed, rainfall_depth, day, hour):
-  p0, e0, p1, e1, p2, e2, c = params
-  return p0 * rainfall_depth ** e0 + p1 * day ** e1 + p2 * hour ** e2 + c - speed
+def reject_outliers(data, m=2):
+    return data[abs(data - np.mean(data)) < m * np.std(data)]
 
-def plot_func0(params, rainfall_depth, day, hour):
-  p0, e0, p1, e1, p2, e2, c = params
-  return p0 * rainfall_depth ** e0 + p1 * day ** e1 + p2 * hour ** e2 + c
+def prepare_road(training_data, validation_data):
+    """
+    :return: list of (nature, training dataframe, validation dataframe) of every nature to fit for a road
+    """
+    training_data['dow'] = training_data['dow'].apply(days_to_binary)
+    validation_data['dow'] = validation_data['dow'].apply(days_to_binary)
 
-def func1(params, speed, rainfall_depth, day, hour):
-  p0, p1, e1, p2, e2, p3, e3, c = params
-  return p0 * np.exp(p1 * rainfall_depth ** e1 + p2 * hour ** e2) + p3 * day ** e3 + c - speed
+    training_grouped = {nature: nature_df for nature, nature_df in training_data.groupby(['nature'])}
+    validation_grouped = {nature: nature_df for nature, nature_df in validation_data.groupby(['nature'])}
 
-def plot_func1(params, rainfall_depth, day, hour):
-  p0, p1, e1, p2, e2, p3, e3, c = params
-  return p0 * np.exp(p1 * rainfall_depth ** e1 + p2 * hour ** e2) + p3 * day ** e3 + c
+    jobs = []
 
-def func2(params, speed, rainfall_depth, day, hour):
-  p0, e0, p1, e1, p2, p3, p4, p5, c = params
-  return p0 * rainfall_depth ** e0 + p1 * day ** e1 + p2 * hour ** 4  + p3 * hour ** 3 + p4 * hour ** 2 + p5 * hour + c - speed
+    for nature, nature_training in training_grouped.iteritems():
 
-def plot_func2(params, rainfall_depth, day, hour):
-  p0, e0, p1, e1, p2, p3, p4, p5, c = params
-  return p0 * rainfall_depth ** e0 + p1 * day ** e1 + p2 * hour ** 4  + p3 * hour ** 3 + p4 * hour ** 2 + p5 * hour + c
+        if nature not in validation_grouped:
+            continue
 
-functions = [
-    [func0, plot_func0, np.array([1,1,1,1,1,1,1])],
-    [func1, plot_func1, np.array([1,1,1,1,1,1,1,1])],
-    [func2, plot_func2, np.array([1,1,1,1,1,1,1,1,1])]
-]
+        # Get data for this street of all links with specific nature
+        if len(nature_training) >= 3:
+            jobs.append((nature, nature_training, validation_grouped[nature]))
 
-def reject_outliers(data, m=2):
-    return data[abs(data - np.mean(data)) < m * np.std(data)]
+    return jobs
 
-# Overall tracking of best function
-best_funcs_nature_tally = defaultdict(lambda: {"function_tally": list(np.zeros(len(functions))), "avg_mse": 0, "avg_mae": 0, "total_count": 0})
-best_funcs_tally = {"function_tally": list(np.zeros(len(functions))), "avg_mse": 0, "avg_mae": 0, "total_count": 0}
+def fit_family(street, index, family, training, validation, initial, fit_options):
+    """
+    :param fit_options: options from new_fit_options, the backend and whether to fit within the family bounds
+    :return: (parameters, validation predictions, mse, mae), None if the fit failed
+    """
+    print "Function %i" % index
 
-roads = streets + motorways
-total_roads = len(roads)
+    bounds = family.bounds if fit_options["bounded"] else (-np.inf, np.inf)
 
-for i, (column, street) in enumerate(roads):
+    try:
+        params = get_best_params(training, family.residual, initial, family.jacobian, fit_options["backend"], bounds)
+    except Exception, e:
+        print str(e)
+        print("%s function failed" % street)
+        instrumentation.count("fit.failures")
+        return None
 
-    print ("%s / %s") % (i, total_roads), street
+    predictions, mse, mae = get_statistics(params, family.predict, validation.depth, validation.dow, validation.hour, validation.speed)
 
-    training_data = dM.get_data("traffic", "rainfall", [(column, street)], natures, tuple(range(7)), tuple(range(24)))
-    validation_data = dM.get_data("traffic_aug13", "rainfall_aug13", [(column, street)], natures, tuple(range(7)), tuple(range(24)))
+    return params, predictions, mse, mae
 
-    street = street.replace("''", "'")
+def select_best(fits):
+    """
+    :param fits: dictionary of family index -> fit_family result
+    :return: index of the family with the lowest validation mse, -1 if there are none
+    """
+    best_mse = -1
+    best_func_index = -1
 
-    if not len(training_data) or not len(validation_data):
-        continue
+    for i in sorted(fits):
+        mse = fits[i][2]
 
-    training_data['dow'] = training_data['dow'].apply(days_to_binary)
-    validation_data['dow'] = validation_data['dow'].apply(days_to_binary)
+        if mse < best_mse or best_mse == -1:
+            best_mse = mse
+            best_func_index = i
 
-    training_grouped = {nature: nature_df for nature, nature_df in training_data.groupby(['nature'])}
-    validation_grouped = {nature: nature_df for nature, nature_df in validation_data.groupby(['nature'])}
+    return best_func_index
 
-    street_function_count = list(np.zeros(len(functions)))
+def subsample(training, fraction):
+    """
+    :return: every n-th row of training so that about fraction of it is kept, all of it if that is too few rows
+    """
+    if not fraction or fraction >= 1:
+        return training
 
-    nature_results = {}
+    sample = training.iloc[::int(round(1 / fraction))]
 
-    for nature, nature_training in training_grouped.iteritems():
+    return sample if len(sample) >= MIN_SUBSAMPLE_ROWS else training
 
-        if nature not in validation_grouped:
+def exhaustive_search(street, training, validation, initials, fit_options):
+    """
+    :return: dictionary of family index -> fit_family result of every family that could be fitted
+    """
+    fits = {}
+
+    for i, family in enumerate(model_families.get_families()):
+        fit = fit_family(street, i, family, training, validation, initials.get(i, family.initial), fit_options)
+
+        if fit is not None:
+            fits[i] = fit
+
+    return fits
+
+def pruned_search(street, training, validation, initials, fit_options):
+    """
+    Screen every family with a fit on a subsample of training, and only fit in full the families whose screening mse
+    is within the prune margin of the best one. Families whose screening fit failed, or has no finite mse, are fitted
+    in full too rather than pruned on no evidence. The full fits start from the same initial parameters as those of
+    exhaustive_search, so a family that is not pruned is fitted exactly as it is there
+
+    :return: (dictionary of family index -> fit_family result of the families fitted in full, list of pruned indices)
+    """
+    families = model_families.get_families()
+    screening_training = subsample(training, fit_options["subsample"])
+    screening = {}
+
+    for i in range(len(families)):
+        screening[i] = fit_family(street, i, families[i], screening_training, validation,
+                                  initials.get(i, families[i].initial), fit_options)
+
+    screened = dict((i, fit) for i, fit in screening.iteritems() if fit is not None and np.isfinite(fit[2]))
+    pruned = []
+
+    if screened:
+        threshold = min(fit[2] for fit in screened.itervalues()) * (1 + fit_options["prune_margin"])
+        pruned = sorted(i for i, fit in screened.iteritems() if fit[2] > threshold)
+
+    if screening_training is training:
+        # The screening fits were full fits
+        return dict((i, fit) for i, fit in screening.iteritems() if fit is not None and i not in pruned), pruned
+
+    fits = {}
+
+    for i in range(len(families)):
+        if i in pruned:
             continue
 
-        nature_validation = validation_grouped[nature]
+        if i not in screened:
+            instrumentation.count("fit.screening_failures")
 
-        # Get data for this street of all links with specific nature
-        if len(nature_training) >= 3:
+        full_fit = fit_family(street, i, families[i], training, validation, initials.get(i, families[i].initial),
+                              fit_options)
 
-            best_mse = -1
-            best_func_index = -1
+        if full_fit is not None:
+            fits[i] = full_fit
 
-            for i, (func, plot_func, initial) in enumerate(functions):
+    return fits, pruned
 
-                print "Function %i" % i
+@instrumentation.timed("fit.nature")
+def fit_nature(job):
+    """
+    :param job: (street, nature, training dataframe, validation dataframe, dictionary of function index -> initial
+        parameters overriding those of the model family, fit options)
+    :return: (nature, result_data, best function index or -1, best mse, best mae)
+    """
+    street, nature, nature_training, nature_validation, initials, fit_options = job
 
-                try:
-                    params = get_best_params(nature_training, func, initial)
-                except Exception, e:
-                    print str(e)
-                    print("%s function failed" % street)
-                    continue
+    search = None
+
+    if fit_options["search"] == "pruned":
+        fits, pruned = pruned_search(street, nature_training, nature_validation, initials, fit_options)
+        search = {"pruned": pruned}
+
+        if fit_options["audit_search"]:
+            search["exhaustive_best"] = select_best(exhaustive_search(street, nature_training, nature_validation,
+                                                                      initials, fit_options))
+    else:
+        fits = exhaustive_search(street, nature_training, nature_validation, initials, fit_options)
+
+    best_func_index = select_best(fits)
+
+    if best_func_index == -1:
+        average_speed = nature_validation.speed.mean()
+        return nature, {'avg_speed': average_speed}, best_func_index, None, None
+
+    print best_func_index
+
+    best_popt, best_preds, best_mse, best_mae = fits[best_func_index]
 
-                predictions, mse, mae = get_statistics(params, plot_func, nature_validation.depth, nature_validation.dow, nature_validation.hour, nature_validation.speed)
+    result_data = {
+        "best_function": best_func_index,
+        "parameters": list(best_popt),
+        "mse": best_mse,
+        "mae": best_mae
+    }
 
-                if mse < best_mse or best_mse == -1:
-                    best_mse = mse
-                    best_mae = mae
-                    best_preds = predictions
-                    best_popt = params
-                    best_func_index = i
+    if search is not None:
+        search["best"] = best_func_index
+        result_data["search"] = search
 
-            if best_func_index != -1:
+    if fit_options["extended_stats"]:
+        result_data.update(get_error_summary(best_preds, nature_validation.speed))
 
-                print best_func_index
-                # Increment tally for function format with best MSE for this street
-                street_function_count[best_func_index] += 1
+    try:
+        save_predictions(street, nature, nature_validation.depth, nature_validation.speed, best_preds)
+    except Exception, e:
+        print str(e)
 
-                best_funcs_nature_tally[nature]["function_tally"][best_func_index] += 1
-                best_funcs_nature_tally[nature]["avg_mse"]+= best_mse
-                best_funcs_nature_tally[nature]["avg_mae"]+= best_mae
-                best_funcs_nature_tally[nature]["total_count"]+= 1
+    return nature, result_data, best_func_index, best_mse, best_mae
 
-                best_funcs_tally["function_tally"][best_func_index] += 1
-                best_funcs_tally["avg_mse"] += best_mse
-                best_funcs_tally["avg_mae"] += best_mae
-                best_funcs_tally["total_count"]+= 1
+JOURNAL_PATH = "fit_journal.jsonl"
+WATERMARKS_PATH = "road_watermarks.json"
 
-                result_data = {
-                    "best_function": best_func_index,
-                    "parameters": list(best_popt),
-                    "mse": best_mse,
-                    "mae": best_mae
-                }
+class FitJournal(object):
+    """
+    Append only journal of the completed (road, nature) fits of a run, one json record per line, so that an
+    interrupted run can resume where it stopped
+    """
 
+    def __init__(self, path=JOURNAL_PATH, fresh=False):
+        self.path = path
+        self.__fits = OrderedDict()
+        self.__complete = set()
+
+        if fresh and os.path.exists(path):
+            os.remove(path)
+
+        if os.path.exists(path):
+            self.__load()
+
+        self.__file = open(path, "ab")
+
+    def __load(self):
+        with open(self.path, "rb") as f:
+            for line in f:
                 try:
-                    plot(nature_validation.depth, nature_validation.speed, best_preds, street, nature)
-                except Exception, e:
-                    print str(e)
+                    record = json.loads(line)
+                except ValueError:
+                    # Torn last line of an interrupted run, its fit is redone
                     continue
+
+                road = record["road"]
+
+                if record.get("complete"):
+                    self.__complete.add(road)
+                else:
+                    self.__fits.setdefault(road, OrderedDict())[record["nature"]] = (
+                        record["nature"], record["result"], record["best_function"],
+                        record["mse"], record["mae"]
+                    )
+
+    def __append(self, record):
+        self.__file.write(json.dumps(record) + "\n")
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+
+    def is_complete(self, road):
+        return road in self.__complete
+
+    def has_fit(self, road, nature):
+        return nature in self.__fits.get(road, ())
+
+    def get_fits(self, road):
+        """
+        :return: list of fit_nature results journaled for road
+        """
+        return self.__fits.get(road, {}).values()
+
+    def record_fit(self, road, fit):
+        nature, result_data, best_func_index, best_mse, best_mae = fit
+        self.__append({
+            "road": road, "nature": nature, "result": result_data, "best_function": best_func_index,
+            "mse": best_mse, "mae": best_mae
+        })
+        self.__fits.setdefault(road, OrderedDict())[nature] = fit
+
+    def record_road(self, road):
+        self.__append({"road": road, "complete": True})
+        self.__complete.add(road)
+
+    def iter_completed(self):
+        """
+        :return: generator of (road, list of fit_nature results) of completed roads, in journal order
+        """
+        for road, fits in self.__fits.iteritems():
+            if road in self.__complete:
+                yield road, fits.values()
+
+    def close(self):
+        self.__file.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self.path)
+
+def read_road_file(street):
+    """
+    :return: dictionary of nature -> result_data of the road file of a previous run, empty if there is none
+    """
+    try:
+        with open("road_data/" + street + ".json", "rb") as f:
+            return json.load(f)["nature_results"]
+    except IOError:
+        return {}
+
+def get_initials(nature_results, nature):
+    """
+    :return: dictionary of function index -> parameters previously fitted for nature, to warm start from
+    """
+    result_data = nature_results.get(nature, {})
+
+    if "best_function" not in result_data:
+        return {}
+
+    return {result_data["best_function"]: np.array(result_data["parameters"])}
+
+def journal_unchanged_roads(journal, watermarks, previous_watermarks):
+    """
+    Record the fits in the road files of every road whose traffic data has not changed since the previous run,
+    so they are not fitted again and are counted in the tallies
+    """
+    for street, watermark in watermarks.iteritems():
+
+        if previous_watermarks.get(street) != watermark or journal.is_complete(street):
+            continue
+
+        if not os.path.exists("road_data/" + street + ".json"):
+            continue
+
+        for nature, result_data in read_road_file(street).iteritems():
+            if "best_function" in result_data:
+                fit = (nature, result_data, result_data["best_function"], result_data["mse"], result_data["mae"])
             else:
-                average_speed = nature_validation.speed.mean()
-                result_data = {'avg_speed': result_data}
+                fit = (nature, result_data, -1, None, None)
+
+            journal.record_fit(street, fit)
+
+        journal.record_road(street)
+
+def new_fit_options(backend="leastsq", extended_stats=False, search="exhaustive", prune_margin=0.25, subsample=0.25,
+                    audit_search=False, bounded=False):
+    """
+    :param backend: leastsq, or least_squares which can fit within bounds, both with the analytic Jacobians
+        of the model families
+    :param extended_stats: add R squared and error quantiles to the results
+    :param search: exhaustive fits every model family in full, pruned screens them first (see pruned_search)
+    :param prune_margin: relative margin over the best screening mse beyond which a family is pruned
+    :param subsample: fraction of the training data screening fits use, all of it if 0 or 1
+    :param audit_search: also run the exhaustive search to report whether pruning changed the best function
+    :param bounded: fit within the parameter bounds of every model family, least_squares only
+    """
+    if backend not in BACKENDS:
+        raise ValueError("Unknown fitting backend %s" % backend)
+
+    if search not in SEARCHES:
+        raise ValueError("Unknown model search %s" % search)
+
+    if bounded and backend != "least_squares":
+        raise ValueError("Bounded fitting needs the least_squares backend")
+
+    return {"backend": backend, "extended_stats": extended_stats, "search": search, "prune_margin": prune_margin,
+            "subsample": subsample, "audit_search": audit_search, "bounded": bounded}
+
+def iter_road_fits(road_data, total_roads, pool=None, max_pending=None, journal=None, warm_start=False,
+                   fit_options=None):
+    """
+    :param road_data: iterator of (column, street, (training dataframe, validation dataframe))
+    :param pool: multiprocessing pool to fit (road, nature) jobs in, fitted in process if None
+    :param max_pending: maximum number of jobs submitted to the pool ahead of the results consumed
+    :param journal: FitJournal whose completed roads and fits are skipped
+    :param warm_start: start fitting from the parameters in the road files of the previous run
+    :param fit_options: options from new_fit_options, defaults if None
+    :return: generator of (street, list of new fit_nature results), in road order whatever the pool size
+    """
+    fit_options = fit_options or new_fit_options()
+    pending = deque()
+    pending_jobs = 0
+
+    for i, (column, street, (training_data, validation_data)) in enumerate(road_data):
+
+        print ("%s / %s") % (i, total_roads), street
+
+        if not len(training_data) or not len(validation_data):
+            continue
+
+        if journal is not None and journal.is_complete(street):
+            continue
+
+        nature_results = read_road_file(street) if warm_start else {}
+
+        jobs = [(street,) + job + (get_initials(nature_results, job[0]), fit_options)
+                for job in prepare_road(training_data, validation_data)
+                if journal is None or not journal.has_fit(street, job[0])]
+
+        if pool is None:
+            yield street, [fit_nature(job) for job in jobs]
+            continue
+
+        pending.append((street, [instrumentation.apply_async(pool, fit_nature, (job,)) for job in jobs]))
+        pending_jobs += len(jobs)
+
+        # Bound the data held by queued jobs, results are consumed in submission order
+        while pending_jobs > max_pending:
+            street, handles = pending.popleft()
+            pending_jobs -= len(handles)
+            yield street, [handle.get() for handle in handles]
+
+    while pending:
+        street, handles = pending.popleft()
+        yield street, [handle.get() for handle in handles]
+
+def new_tally():
+    return {"function_tally": list(np.zeros(len(model_families.get_families()))), "avg_mse": 0, "avg_mae": 0, "total_count": 0}
 
-            nature_results[nature] = result_data
+@instrumentation.timed("fit.write_road_file")
+def write_road_file(street, nature_fits):
+    street_function_count = list(np.zeros(len(model_families.get_families())))
+
+    nature_results = {}
+
+    for nature, result_data, best_func_index, best_mse, best_mae in nature_fits:
+
+        if best_func_index != -1:
+            # Increment tally for function format with best MSE for this street
+            street_function_count[best_func_index] += 1
+
+        nature_results[nature] = dict((k, v) for k, v in result_data.iteritems() if k != "search")
 
     # Analysis for street
     with open("road_data/" + street + ".json", "wb") as f:
         json.dump({"street_tally": street_function_count, "nature_results": nature_results}, f)
         f.close()
 
+def tally_fits(nature_fits, best_funcs_tally, best_funcs_nature_tally):
+    for nature, result_data, best_func_index, best_mse, best_mae in nature_fits:
+
+        if best_func_index == -1:
+            continue
+
+        best_funcs_nature_tally[nature]["function_tally"][best_func_index] += 1
+        best_funcs_nature_tally[nature]["avg_mse"]+= best_mse
+        best_funcs_nature_tally[nature]["avg_mae"]+= best_mae
+        best_funcs_nature_tally[nature]["total_count"]+= 1
+
+        best_funcs_tally["function_tally"][best_func_index] += 1
+        best_funcs_tally["avg_mse"] += best_mse
+        best_funcs_tally["avg_mae"] += best_mae
+        best_funcs_tally["total_count"]+= 1
+
+def tally_journal(journal):
+    """
+    :return: (overall tally, tally per nature) of every completed road of the journal
+    """
+    best_funcs_nature_tally = defaultdict(new_tally)
+    best_funcs_tally = new_tally()
+
+    for street, nature_fits in journal.iter_completed():
+        tally_fits(nature_fits, best_funcs_tally, best_funcs_nature_tally)
+
+    return best_funcs_tally, best_funcs_nature_tally
+
+def write_total_analysis(journal):
+    best_funcs_tally, best_funcs_nature_tally = tally_journal(journal)
+
     # Analysis for all streets
     with open("./TOTAL_analysis.json", "wb") as f:
             json.dump({"total_tally": best_funcs_tally, "total_nature_tally": best_funcs_nature_tally}, f)
             f.close()
 
-for nature, info_dict in best_funcs_nature_tally.iteritems():
-    best_funcs_tally = info_dict["total_count"]
-    info_dict["function_percentages"] = [x * 100 / best_funcs_tally for x in info_dict["function_tally"]]
-    info_dict["avg_mse"] = info_dict["avg_mse"] / best_funcs_tally
-    info_dict["avg_mae"] = info_dict["avg_mae"] / best_funcs_tally
-
-best_funcs_tally = best_funcs_tally["total_count"]
-best_funcs_tally["function_percentages"] = [x * 100 / best_funcs_tally for x in best_funcs_tally["function_tally"]]
-best_funcs_tally["avg_mse"] = best_funcs_tally["avg_mse"] / best_funcs_tally
-best_funcs_tally["avg_mae"] = best_funcs_tally["avg_mae"] / best_funcs_tally
-
-with open("stats.json", "a") as f:
-    json.dump(best_funcs_nature_tally, f)
-    json.dump(best_funcs_tally, f)
-    f.close()
+def write_search_report(journal):
+    """
+    Summarise the pruned searches of the journal: how many candidates were pruned and, for audited fits, how often the
+    best function differs from that of the exhaustive search
+    """
+    report = {"fits": 0, "candidates_pruned": 0, "audited": 0, "outcome_changed": 0, "changed": []}
+
+    for street, nature_fits in journal.iter_completed():
+        for nature, result_data, best_func_index, best_mse, best_mae in nature_fits:
+            search = result_data.get("search")
+
+            if search is None:
+                continue
+
+            report["fits"] += 1
+            report["candidates_pruned"] += len(search["pruned"])
+
+            if "exhaustive_best" in search:
+                report["audited"] += 1
+
+                if search["exhaustive_best"] != search["best"]:
+                    report["outcome_changed"] += 1
+                    report["changed"].append([street, nature, search["best"], search["exhaustive_best"]])
+
+    with open("search_report.json", "wb") as f:
+        json.dump(report, f)
+
+def finish_tally(info_dict):
+    total_count = info_dict["total_count"]
+
+    if total_count:
+        info_dict["function_percentages"] = [x * 100 / total_count for x in info_dict["function_tally"]]
+        info_dict["avg_mse"] = info_dict["avg_mse"] / total_count
+        info_dict["avg_mae"] = info_dict["avg_mae"] / total_count
+
+def read_watermarks(watermarks_path):
+    try:
+        with open(watermarks_path, "rb") as f:
+            return json.load(f)
+    except IOError:
+        return {}
+
+def write_watermarks(watermarks_path, watermarks):
+    with open(watermarks_path + ".tmp", "wb") as f:
+        json.dump(watermarks, f)
+
+    os.rename(watermarks_path + ".tmp", watermarks_path)
+
+def run_pipeline(workers=1, journal_path=JOURNAL_PATH, fresh=False, aggregate_interval=0, incremental=False,
+                 watermarks_path=WATERMARKS_PATH, extended_stats=False, backend="leastsq", search="exhaustive",
+                 prune_margin=0.25, subsample=0.25, audit_search=False, plots=True, bounded=False,
+                 materialize_rainfall=False):
+    """
+    Fit every road and nature, resuming from the journal of an interrupted run unless fresh is set
+
+    :param workers: number of processes fitting (road, nature) jobs, 1 fits in this process
+    :param journal_path: checkpoint journal, removed once the run completes
+    :param fresh: discard the journal of a previous run and fit every road again
+    :param aggregate_interval: also write TOTAL_analysis.json after every this many roads, only at the end if 0
+    :param incremental: only refit roads whose traffic row count or latest period changed since the run that
+        wrote the watermarks, starting from their previous parameters
+    :param watermarks_path: per road watermarks of the traffic data fitted, written once the run completes
+    :param extended_stats: add the R squared and absolute error quantiles of the best function to the road files
+    :param backend: leastsq, or least_squares which bounded fitting needs
+    :param search: exhaustive, or pruned to screen model families on a subsample and prune those clearly worse,
+        with prune_margin, subsample and audit_search as in new_fit_options. Writes search_report.json
+    :param plots: render the plots of the new fits once fitting completes, they can be rendered later with render_plots
+    :param bounded: fit within the parameter bounds of the model families
+    :param materialize_rainfall: read rainfall from its materialization per traffic period, which is created or
+        refreshed in the database, instead of range joining the rainfall tables
+    """
+    fit_options = new_fit_options(backend, extended_stats, search, prune_margin, subsample, audit_search, bounded)
+
+    # Start workers before any database connection is opened
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+
+    journal = FitJournal(journal_path, fresh)
+
+    try:
+        dM = DataManager(materialized_rainfall=materialize_rainfall)
+
+        total_roads = len(dM.get_streets()) + len(dM.get_motorways())
+
+        table_pairs = [("traffic", "rainfall"), ("traffic_aug13", "rainfall_aug13")]
+
+        # Read before fitting, data landing during the run is fitted by the next incremental run
+        watermarks = dM.get_road_watermarks([traffic_table for traffic_table, rainfall_table in table_pairs], natures)
+
+        roads = None
+
+        if incremental:
+            journal_unchanged_roads(journal, watermarks, read_watermarks(watermarks_path))
+            roads = [street for street in watermarks if not journal.is_complete(street)]
+            print "Refitting %s of %s roads" % (len(roads), len(watermarks))
+
+        # Stream training and validation data of every road in bulk instead of querying per road
+        road_data = dM.iter_road_data(table_pairs, natures, tuple(range(7)), tuple(range(24)), roads=roads)
+
+        for i, (street, nature_fits) in enumerate(iter_road_fits(road_data, total_roads, pool, 4 * workers, journal,
+                                                                 incremental, fit_options)):
+
+            for fit in nature_fits:
+                journal.record_fit(street, fit)
+
+            write_road_file(street, journal.get_fits(street))
+            journal.record_road(street)
+
+            if aggregate_interval and (i + 1) % aggregate_interval == 0:
+                write_total_analysis(journal)
+
+        if plots:
+            with instrumentation.timer("pipeline.plots"):
+                render_plots(pool)
+    except:
+        journal.close()
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    write_total_analysis(journal)
+
+    if search == "pruned":
+        write_search_report(journal)
+
+    best_funcs_tally, best_funcs_nature_tally = tally_journal(journal)
+
+    for nature, info_dict in best_funcs_nature_tally.iteritems():
+        finish_tally(info_dict)
+
+    finish_tally(best_funcs_tally)
+
+    with open("stats.json", "a") as f:
+        json.dump(best_funcs_nature_tally, f)
+        json.dump(best_funcs_tally, f)
+        f.close()
+
+    write_watermarks(watermarks_path, watermarks)
+
+    journal.remove()
+
+    # Repack the rewritten road files into the compiled store read by rainbreaker
+    rainbreaker.build_model_store()
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit rainfall models for every road and nature")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+                        help="number of processes fitting (road, nature) jobs, 1 fits in this process")
+    parser.add_argument("--journal", default=JOURNAL_PATH,
+                        help="checkpoint journal an interrupted run resumes from")
+    parser.add_argument("--fresh", action="store_true",
+                        help="discard the journal of an interrupted run and fit every road again")
+    parser.add_argument("--aggregate-interval", type=int, default=0,
+                        help="write TOTAL_analysis.json every this many roads as well as at the end")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only refit roads whose traffic data changed since the last run, from their previous fits")
+    parser.add_argument("--extended-stats", action="store_true",
+                        help="add the R squared and absolute error quantiles of each fit to the road files")
+    parser.add_argument("--backend", choices=BACKENDS, default="leastsq",
+                        help="least squares solver, both use the analytic Jacobians of the model families")
+    parser.add_argument("--bounded", action="store_true",
+                        help="fit within the parameter bounds of the model families, needs --backend least_squares")
+    parser.add_argument("--search", choices=SEARCHES, default="exhaustive",
+                        help="fit every model family, or screen them on a subsample and prune those clearly worse")
+    parser.add_argument("--prune-margin", type=float, default=0.25,
+                        help="relative margin over the best screening mse beyond which a family is pruned")
+    parser.add_argument("--subsample", type=float, default=0.25,
+                        help="fraction of the training data the screening fits of the pruned search use")
+    parser.add_argument("--audit-search", action="store_true",
+                        help="also fit every family to report how often pruning changed the best function")
+    parser.add_argument("--materialize-rainfall", action="store_true",
+                        help="create or refresh the rainfall tables summed per traffic period and extract from them")
+    parser.add_argument("--no-plots", action="store_true",
+                        help="only save the predictions of the fits, render them later with --plots-only")
+    parser.add_argument("--plots-only", action="store_true",
+                        help="render the plots of every saved prediction without fitting")
+    parser.add_argument("--metrics",
+                        help="record stage timings and counters, including those of the workers, to this json report")
+    parser.add_argument("--profile", action="store_true",
+                        help="with --metrics, also profile this process with cProfile")
+    args = parser.parse_args()
+
+    if args.metrics:
+        # Before the pool is started so workers record too
+        instrumentation.enable(profile=args.profile)
+
+    try:
+        if args.plots_only:
+            pool = multiprocessing.Pool(args.workers) if args.workers > 1 else None
+
+            try:
+                render_plots(pool, force=True)
+            finally:
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+            return
+
+        run_pipeline(args.workers, args.journal, args.fresh, args.aggregate_interval, args.incremental,
+                     extended_stats=args.extended_stats, backend=args.backend, search=args.search,
+                     prune_margin=args.prune_margin, subsample=args.subsample, audit_search=args.audit_search,
+                     plots=not args.no_plots, bounded=args.bounded, materialize_rainfall=args.materialize_rainfall)
+    finally:
+        if args.metrics:
+            instrumentation.write_report(args.metrics)
+
+if __name__ == '__main__':
+    main()
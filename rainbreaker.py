@@ -2,25 +2,144 @@ import numpy as np
 import os.path
 import json
 import difflib
+import threading
+from collections import OrderedDict, namedtuple
+import model_families
+import instrumentation
 
 __nature_list = [
     "Single Carriageway", "Traffic Island Link", "Dual Carriageway",
     "Roundabout", "Traffic Island Link At Junction", "Slip Road"
 ]
 
+__nature_ids = dict((nature, nature_id) for nature_id, nature in enumerate(__nature_list))
+
 __weekday_list = ['sunday', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday']
 
 __SIMILARITY_THRESHOLD = 0.7
 
+# Memo of fuzzy nature matches, bounded LRU
+_NATURE_CACHE_SIZE = 1024
+_nature_cache = OrderedDict()
+_nature_cache_lock = threading.Lock()
+_nature_cache_stats = {"exact": 0, "hits": 0, "misses": 0}
+
 _data_directory = os.path.join((os.path.dirname(__file__)), 'road_data')
 
 _MPH_TO_KPH = 1.60934
 _MPH_TO_MPS = 0.44704
 
-def __get_best_nature_approximation(nature):
+_UNIT_FACTORS = {'mph': 1.0, 'kph': _MPH_TO_KPH, 'ms': _MPH_TO_MPS}
+
+# Approximate upper bound on memory held by parsed road models
+_MODEL_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Per nature bookkeeping (dict slot, namedtuple, array header) used when sizing cache entries
+_NATURE_MODEL_OVERHEAD = 512
+
+# Compiled model store, a single memory mapped structured array of every
+# road/nature result sorted by road then nature. Roads without any nature
+# results keep one row with an empty nature so they still validate. Road
+# files modified after the store was written are read from json instead
+_STORE_SUFFIX = '.npy'
+_STORE_MAX_PARAMETERS = model_families.MAX_PARAMETERS
+
+def _get_store_dtype(road_length, nature_length):
+    """
+    :return: dtype of store rows holding road and nature names of up to these lengths
+    """
+    return np.dtype([
+        ('road', 'U%i' % max(road_length, 1)), ('nature', 'U%i' % max(nature_length, 1)),
+        ('function', 'i1'), ('n_parameters', 'i1'), ('parameters', 'f8', (_STORE_MAX_PARAMETERS,)),
+        ('mse', 'f8'), ('mae', 'f8'), ('avg_speed', 'f8')
+    ])
+
+_ModelStore = namedtuple('ModelStore', 'file_name mtime rows roads available_roads')
+
+_model_store = None
+_model_store_lock = threading.Lock()
+
+# Compact form of a single nature result: index into _func_list (None when only
+# avg_speed is known), float64 parameter array and average speed
+_NatureModel = namedtuple('NatureModel', 'function parameters avg_speed')
+
+
+class _ModelRegistry(object):
+    """
+    Process-wide LRU cache of parsed road models, bounded by an approximate memory cap
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.__models = OrderedDict()
+        self.__size = 0
+        self.__lock = threading.Lock()
+
+    def get(self, key, loader, version=None):
+        """
+        :param key: cache key, the road's model file name
+        :param loader: callable returning (model, size) for key, model is None if road not found
+        :param version: version of the model on disk, a cached model of another version is reloaded
+        :return: cached model for key, loading it on a miss
+        """
+        with self.__lock:
+            entry = self.__models.get(key)
+            if entry is not None and entry[2] == version:
+                # Re-insert to mark as most recently used
+                del self.__models[key]
+                self.__models[key] = entry
+                return entry[0]
+
+        model, size = loader(key)
+
+        with self.__lock:
+            self.__discard(key)
+
+            # Unknown roads are not cached so newly written files are picked up
+            if model is not None:
+                self.__models[key] = (model, size, version)
+                self.__size += size
+                self.__evict()
+
+        return model
+
+    def invalidate(self, key=None):
+        """
+        :param key: cache key to drop, drops every entry when None
+        """
+        with self.__lock:
+            if key is None:
+                self.__models.clear()
+                self.__size = 0
+            else:
+                self.__discard(key)
+
+    def resize(self, max_bytes):
+        with self.__lock:
+            self.max_bytes = max_bytes
+            self.__evict()
+
+    def stats(self):
+        with self.__lock:
+            return {"roads": len(self.__models), "bytes": self.__size, "max_bytes": self.max_bytes}
+
+    def __discard(self, key):
+        entry = self.__models.pop(key, None)
+        if entry is not None:
+            self.__size -= entry[1]
+
+    def __evict(self):
+        while self.__size > self.max_bytes and self.__models:
+            _, (_, size, _) = self.__models.popitem(last=False)
+            self.__size -= size
+
+
+_model_registry = _ModelRegistry(_MODEL_CACHE_MAX_BYTES)
+
+def __match_nature(nature):
 
     similarity_measure = lambda n: difflib.SequenceMatcher(None, nature, n).ratio()
-    nature_similarity = map(similarity_measure, __nature_list)
+    nature_similarity = [similarity_measure(n) for n in __nature_list]
 
     max_similarity = max(nature_similarity)
 
@@ -30,6 +149,40 @@ def __get_best_nature_approximation(nature):
     else:
         return None
 
+def __get_best_nature_approximation(nature):
+    """
+    :param nature: nature name, possibly misspelt, or nature id
+    :return: closest nature name, None if nothing is similar enough
+    """
+    if isinstance(nature, (int, np.integer)) and not isinstance(nature, bool):
+        if nature < 0 or nature >= len(__nature_list):
+            raise ValueError("Nature id has to be between (inclusive) 0-%i" % (len(__nature_list) - 1))
+        return __nature_list[nature]
+
+    if nature in __nature_ids:
+        with _nature_cache_lock:
+            _nature_cache_stats["exact"] += 1
+        return nature
+
+    with _nature_cache_lock:
+        if nature in _nature_cache:
+            # Re-insert to mark as most recently used
+            approximation = _nature_cache.pop(nature)
+            _nature_cache[nature] = approximation
+            _nature_cache_stats["hits"] += 1
+            return approximation
+
+    approximation = __match_nature(nature)
+
+    with _nature_cache_lock:
+        _nature_cache_stats["misses"] += 1
+        _nature_cache[nature] = approximation
+
+        while len(_nature_cache) > _NATURE_CACHE_SIZE:
+            _nature_cache.popitem(last=False)
+
+    return approximation
+
 def __check_dow_input(dow):
     if type(dow) == int:
         if dow >= len(__weekday_list) or dow < 0:
@@ -58,6 +211,8 @@ def __check_hour_input(hour):
     return hour
 
 def __get_road_speed(road, nature, hour, dow, depth):
+    instrumentation.count("rainbreaker.predictions")
+
     road_data = __get_road_data(road)
 
     dow = __check_dow_input(dow)
@@ -65,62 +220,373 @@ def __get_road_speed(road, nature, hour, dow, depth):
 
     nature = __get_best_nature_approximation(nature)
 
-    if not road_data:
+    if road_data is None:
         raise ValueError('Road does not exist, please validate beforehand')
     else:
-        nature_data = road_data.get("nature_results", {}).get(nature, {})
+        nature_model = road_data.get(nature)
 
-        if not nature_data:
+        if nature_model is None:
             raise ValueError("Road does not contain this nature, use get_natures_for_road "
                              "to find the natures contained for a given road")
 
-        if "best_function" in nature_data:
-            function = _func_list[nature_data["best_function"]]
-            parameters = nature_data["parameters"]
-            return function(parameters, depth, __days_to_binary(dow), hour)
+        if nature_model.function is not None:
+            function = _func_list[nature_model.function]
+            return function(nature_model.parameters, depth, __days_to_binary(dow), hour)
+        elif nature_model.avg_speed is not None:
+            return nature_model.avg_speed
         else:
-            return float(nature_data["avg_speed"])
+            raise ValueError("Road has no usable model for this nature")
 
 def __days_to_binary(day):
     if day == 0 or day == 6:
         return 0
     return 1
 
-def __plot_func0(params, rainfall_depth, day, hour):
-  p0, e0, p1, e1, p2, e2, c = params
-  return p0 * rainfall_depth ** e0 + p1 * day ** e1 + p2 * hour ** e2 + c
+def __check_dow_array(dows):
+    """
+    :param dows: array of days of the week as ints or strings
+    :return: int array of days of the week, Sunday = 0
+    """
+    if hasattr(dows, 'dtype'):
+        dows = np.asarray(dows)
+    else:
+        # Stop mixed lists of ints and strings being coerced to strings
+        dows = np.array(list(dows), dtype=object)
+
+    if dows.dtype.kind in 'iu':
+        if dows.size and (dows.min() < 0 or dows.max() >= len(__weekday_list)):
+            raise ValueError("Day of the week has to be between (inclusive) 0-6")
+        return dows.astype(np.int64)
+
+    if dows.dtype.kind not in 'SUO':
+        raise TypeError("Day of the week must be an int or string")
+
+    # Validate each distinct value once with the scalar rules
+    unique_dows, inverse = np.unique(dows, return_inverse=True)
+    codes = []
+    for dow in unique_dows:
+        if isinstance(dow, (int, np.integer)) and not isinstance(dow, bool):
+            codes.append(__check_dow_input(int(dow)))
+        elif isinstance(dow, basestring):
+            codes.append(__check_dow_input(str(dow)))
+        else:
+            raise TypeError("Day of the week must be an int or string")
+
+    return np.array(codes, dtype=np.int64)[inverse]
+
+def __check_hour_array(hours):
+    """
+    :param hours: array of ints
+    :return: int array of hours
+    """
+    hours = np.asarray(hours)
+
+    if hours.dtype.kind not in 'iu':
+        raise TypeError("Hour must be an int")
+    if hours.size and (hours.min() < 0 or hours.max() >= 24):
+        raise ValueError("Hour must be int between 0-23 (inclusive")
+
+    return hours.astype(np.int64)
 
-def __plot_func1(params, rainfall_depth, day, hour):
-  p0, p1, e1, p2, e2, p3, e3, c = params
-  return p0 * np.exp(p1 * rainfall_depth ** e1 + p2 * hour ** e2) + p3 * day ** e3 + c
+# Predictors of the registered model families, indexed by best_function
+_func_list = model_families.predictors
 
-def __plot_func2(params, rainfall_depth, day, hour):
-  p0, e0, p1, e1, p2, p3, p4, p5, c = params
-  return p0 * rainfall_depth ** e0 + p1 * day ** e1 + p2 * hour ** 4  + p3 * hour ** 3 + p4 * hour ** 2 + p5 * hour + c
+def __road_file_name(road):
+    return os.path.join(_data_directory, road.upper() + ".json")
 
-_func_list = [__plot_func0, __plot_func1, __plot_func2]
+def __store_file_name():
+    return os.path.normpath(_data_directory) + _STORE_SUFFIX
+
+def __parse_avg_speed(nature_data):
+    try:
+        return float(nature_data["avg_speed"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def __parse_nature_model(nature_data):
+    """
+    :param nature_data: dictionary of a single nature result as written by the fitting script
+    :return: _NatureModel
+    """
+    if "best_function" in nature_data:
+        parameters = np.array(nature_data["parameters"], dtype=np.float64)
+        return _NatureModel(int(nature_data["best_function"]), parameters, None)
+
+    return _NatureModel(None, None, __parse_avg_speed(nature_data))
+
+def __read_road_file(file_name):
+    """
+    :param file_name: path of road json file
+    :return: dictionary of json data, empty dictionary if missing or unreadable
+    """
+    if not os.path.isfile(file_name):
+        return {}
+
+    with open(file_name) as data_file:
+        try:
+            return json.load(data_file)
+        except:
+            return {}
+
+def __load_json_road_model(file_name):
+    """
+    :param file_name: path of road json file
+    :return: (dictionary of nature -> _NatureModel, approximate size in bytes),
+        model is None if road not found
+    """
+    data = __read_road_file(file_name)
+
+    if not data:
+        return None, 0
+
+    natures = {}
+    size = _NATURE_MODEL_OVERHEAD
+
+    for nature, nature_data in data.get("nature_results", {}).items():
+        model = __parse_nature_model(nature_data)
+        natures[nature] = model
+
+        size += _NATURE_MODEL_OVERHEAD + len(nature)
+        if model.parameters is not None:
+            size += model.parameters.nbytes
+
+    return natures, size
+
+def __load_store_road_model(store, road):
+    """
+    :param store: open _ModelStore
+    :param road: upper case road name
+    :return: (dictionary of nature -> _NatureModel, approximate size in bytes),
+        model is None if road not found. Parameters are views into the store
+    """
+    start = np.searchsorted(store.roads, road, side='left')
+    stop = np.searchsorted(store.roads, road, side='right')
+
+    if start == stop:
+        return None, 0
+
+    natures = {}
+    size = _NATURE_MODEL_OVERHEAD
+
+    for row in store.rows[start:stop]:
+        nature = row['nature']
+
+        if not nature:
+            continue
+
+        if row['function'] >= 0:
+            model = _NatureModel(int(row['function']), row['parameters'][:row['n_parameters']], None)
+        else:
+            avg_speed = float(row['avg_speed'])
+            model = _NatureModel(None, None, None if np.isnan(avg_speed) else avg_speed)
+
+        natures[nature] = model
+        size += _NATURE_MODEL_OVERHEAD + len(nature)
+
+    return natures, size
+
+def __get_model_store():
+    """
+    :return: _ModelStore memory mapped read-only, None if no store has been built
+        for the current data directory
+    """
+    global _model_store
+
+    file_name = __store_file_name()
+    store = _model_store
+
+    if store is not None and store.file_name == file_name:
+        return store
+
+    if not os.path.isfile(file_name):
+        return None
+
+    with _model_store_lock:
+        if _model_store is None or _model_store.file_name != file_name:
+            mtime = os.path.getmtime(file_name)
+            rows = np.load(file_name, mmap_mode='r')
+            roads = rows['road']
+            available_roads = [str(r) for r in np.unique(roads) if r and not r.startswith('.')]
+            _model_store = _ModelStore(file_name, mtime, rows, roads, available_roads)
+
+        return _model_store
+
+def __get_modification_time(file_name):
+    """
+    :return: modification time of file_name, None if it does not exist
+    """
+    try:
+        return os.path.getmtime(file_name)
+    except OSError:
+        return None
+
+def __is_modified_since(file_name, mtime):
+    """
+    :return: True if file_name exists and was modified at or after mtime
+    """
+    modified = __get_modification_time(file_name)
+
+    return modified is not None and modified >= mtime
+
+@instrumentation.timed("rainbreaker.load_model")
+def __load_road_model(road, file_name):
+    store = __get_model_store()
+
+    # A road rewritten since the store was built, then invalidated, is read from its json file
+    if store is not None and not __is_modified_since(file_name, store.mtime):
+        return __load_store_road_model(store, road)
+
+    return __load_json_road_model(file_name)
 
 def __get_road_data(road):
     """
     :param road: string
-    :return: dictionary of data for road, return empty dictionary if road not found
+    :return: dictionary of nature -> _NatureModel for road, None if road not found
     """
-
     road = road.upper()
+    file_name = __road_file_name(road)
 
-    file_name = os.path.join(_data_directory, road + ".json")
+    # Keyed on the road file modification time, so a road refitted by another process is reloaded
+    return _model_registry.get(file_name, lambda file_name: __load_road_model(road, file_name),
+                               __get_modification_time(file_name))
 
-    if os.path.isfile(file_name):
-        with open(file_name) as data_file:
-            try:
-                data = json.load(data_file)
-            except:
-                data = {}
+@instrumentation.timed("rainbreaker.build_model_store")
+def build_model_store(file_name=None):
+    """
+    Pack every road json file of the data directory into a single compiled
+    store. Once built, the store is memory mapped read-only and shared
+    through the page cache instead of parsing per road json files, which
+    remain the fallback when no store exists.
 
-            return data
+    Args:
+        file_name (string): Path to write the store to,
+            defaults to the data directory path with a .npy suffix
 
-    else:
-        return {}
+    Returns:
+        string: Path of the written store
+    """
+    if file_name is None:
+        file_name = __store_file_name()
+
+    tail_len = len('.json')
+    rows = []
+
+    for entry in sorted(os.listdir(_data_directory)):
+        if not entry.endswith('.json'):
+            continue
+
+        road = entry[:-tail_len].upper()
+        data = __read_road_file(os.path.join(_data_directory, entry))
+
+        if not data:
+            continue
+
+        nature_results = data.get("nature_results", {})
+
+        if not nature_results:
+            rows.append((road, '', -1, 0, np.zeros(_STORE_MAX_PARAMETERS), np.nan, np.nan, np.nan))
+
+        for nature, nature_data in nature_results.items():
+            parameters = np.zeros(_STORE_MAX_PARAMETERS)
+            n_parameters = 0
+
+            if "best_function" in nature_data:
+                function = nature_data["best_function"]
+                n_parameters = len(nature_data["parameters"])
+
+                if n_parameters > _STORE_MAX_PARAMETERS:
+                    raise ValueError("%s %s has more than %i parameters" % (road, nature, _STORE_MAX_PARAMETERS))
+
+                parameters[:n_parameters] = nature_data["parameters"]
+                avg_speed = None
+            else:
+                function = -1
+                avg_speed = __parse_avg_speed(nature_data)
+
+            rows.append((road, nature, function, n_parameters, parameters,
+                         nature_data.get("mse", np.nan), nature_data.get("mae", np.nan),
+                         np.nan if avg_speed is None else avg_speed))
+
+    # Name fields are sized to the longest names, fixed widths would truncate longer ones
+    store = np.array(rows, dtype=_get_store_dtype(max([len(row[0]) for row in rows] or [0]),
+                                                   max([len(row[1]) for row in rows] or [0])))
+    store.sort(order=['road', 'nature'])
+
+    # Replace atomically so processes mapping the previous store keep a consistent view
+    temp_file_name = file_name + '.tmp'
+    with open(temp_file_name, 'wb') as store_file:
+        np.save(store_file, store)
+    os.rename(temp_file_name, file_name)
+
+    invalidate_road()
+
+    return file_name
+
+def invalidate_road(road=None):
+    """
+    Drop cached model data so it is re-read from disk on next use.
+    Cached roads are reloaded anyway once their road file is modified, eg
+    refitted by multivariate_model_fitting.py in another process, and a road
+    file newer than the compiled store is read instead of the store.
+
+    Args:
+        road (string): Name of road to invalidate, all roads if None
+    """
+    global _model_store
+
+    if road is None:
+        # Reopen the compiled store too, it may have been rebuilt
+        with _model_store_lock:
+            _model_store = None
+
+    _model_registry.invalidate(None if road is None else __road_file_name(road))
+
+def set_model_cache_limit(max_bytes):
+    """
+    Set approximate memory cap of the model cache, least recently used
+    roads are evicted when exceeded
+
+    Args:
+        max_bytes (int): Maximum size in bytes, 0 disables caching
+    """
+    _model_registry.resize(max_bytes)
+
+def get_model_cache_stats():
+    """
+    Returns dictionary with number of cached roads, their approximate
+    size in bytes and the configured cap
+    """
+    return _model_registry.stats()
+
+def resolve_nature(nature):
+    """
+    Resolve a nature name, allowing for misspellings, to a nature id. The id
+    can be passed as the nature of every prediction function to skip
+    matching the name on each call
+
+    Args:
+        nature (string): Name of nature
+
+    Returns:
+        int: Nature id
+    """
+    approximation = __get_best_nature_approximation(nature)
+
+    if approximation is None:
+        raise ValueError("%s is not similar to any nature" % nature)
+
+    return __nature_ids[approximation]
+
+def get_nature_cache_stats():
+    """
+    Returns dictionary with counts of exact nature names, fuzzy matches
+    answered from the memo (hits) and fuzzy matches computed (misses)
+    """
+    with _nature_cache_lock:
+        stats = dict(_nature_cache_stats)
+        stats["size"] = len(_nature_cache)
+
+    return stats
 
 def validate_road(road):
     """
@@ -132,7 +598,7 @@ def validate_road(road):
     Returns:
         bool: Is given road modelled
     """
-    return any(__get_road_data(road))
+    return __get_road_data(road) is not None
 
 def get_natures_for_road(road):
     """
@@ -140,8 +606,8 @@ def get_natures_for_road(road):
     """
     road_data = __get_road_data(road)
 
-    if road_data:
-        return [str(a) for a in road_data['nature_results'].keys()]
+    if road_data is not None:
+        return [str(a) for a in road_data.keys()]
     else:
         return []
 
@@ -149,6 +615,11 @@ def get_available_roads():
     """
     Returns list of all roads contained in the model
     """
+    store = __get_model_store()
+
+    if store is not None:
+        return list(store.available_roads)
+
     directory_items = os.listdir(_data_directory)
     tail_len = len('.json')
 
@@ -160,7 +631,8 @@ def get_speed_without_rainfall_mph(road, nature, hour, dow):
 
     Args:
         road (string): Name of road to investigate
-        nature (string): Name of nature to investigate
+        nature (string or int): Name of nature to investigate,
+            or nature id from resolve_nature
         hour (int): Time of day to investigate.
             Inputted as a number from 0-23
         dow (int): Day of week.
@@ -180,7 +652,8 @@ def get_speed_without_rainfall_kph(road, nature, hour, dow):
 
     Args:
         road (string): Name of road to investigate
-        nature (string): Name of nature to investigate
+        nature (string or int): Name of nature to investigate,
+            or nature id from resolve_nature
         hour (int): Time of day to investigate.
             Inputted as a number from 0-23
         dow (int): Day of week.
@@ -200,7 +673,8 @@ def get_speed_without_rainfall_ms(road, nature, hour, dow):
 
     Args:
         road (string): Name of road to investigate
-        nature (string): Name of nature to investigate
+        nature (string or int): Name of nature to investigate,
+            or nature id from resolve_nature
         hour (int): Time of day to investigate.
             Inputted as a number from 0-23
         dow (int): Day of week.
@@ -220,7 +694,8 @@ def get_speed_with_rainfall_mph(road, nature, hour, dow, depth):
 
     Args:
         road (string): Name of road to investigate
-        nature (string): Name of nature to investigate
+        nature (string or int): Name of nature to investigate,
+            or nature id from resolve_nature
         hour (int): Time of day to investigate.
             Inputted as a number from 0-23
         dow (int): Day of week.
@@ -247,7 +722,8 @@ def get_speed_with_rainfall_kph(road, nature, hour, dow, depth):
 
     Args:
         road (string): Name of road to investigate
-        nature (string): Name of nature to investigate
+        nature (string or int): Name of nature to investigate,
+            or nature id from resolve_nature
         hour (int): Time of day to investigate.
             Inputted as a number from 0-23
         dow (int): Day of week.
@@ -274,7 +750,8 @@ def get_speed_with_rainfall_ms(road, nature, hour, dow, depth):
 
     Args:
         road (string): Name of road to investigate
-        nature (string): Name of nature to investigate
+        nature (string or int): Name of nature to investigate,
+            or nature id from resolve_nature
         hour (int): Time of day to investigate.
             Inputted as a number from 0-23
         dow (int): Day of week.
@@ -301,7 +778,8 @@ def get_percentage_slowdown(road, nature, hour, dow, depth):
 
     Args:
         road (string): Name of road to investigate
-        nature (string): Name of nature to investigate
+        nature (string or int): Name of nature to investigate,
+            or nature id from resolve_nature
         hour (int): Time of day to investigate.
             Inputted as a number from 0-23
         dow (int): Day of week.
@@ -316,3 +794,96 @@ def get_percentage_slowdown(road, nature, hour, dow, depth):
     speed_rainfall = get_speed_with_rainfall_mph(road, nature, hour, dow, depth)
 
     return (1.0 - (speed_rainfall / speed_no_rainfall)) * 100.0
+
+@instrumentation.timed("rainbreaker.predict_speeds")
+def predict_speeds(roads, natures=None, hours=None, dows=None, depths=None, unit='mph'):
+    """
+    Get predicted speeds for many (road, nature, hour, dow, depth) rows at once.
+    Rows are grouped by road and nature so each model is evaluated once per
+    group over whole arrays. As with get_speed_with_rainfall_*, the speed
+    without rainfall is used wherever the model is increasing with depth.
+
+    Args:
+        roads (array of strings or DataFrame): Names of roads to investigate,
+            or a DataFrame with columns road, nature, hour, dow and depth
+        natures (array of strings or ints): Names of natures to investigate,
+            or nature ids from resolve_nature
+        hours (array of ints): Times of day to investigate, 0-23
+        dows (array of ints or strings): Days of week.
+            Integer with Sunday = 0 through to Saturday = 6, or day name
+        depths (array of floats): Depths of rainfall in 15 minute period
+            given in millimeters
+        unit (string): Unit of returned speeds, one of 'mph', 'kph' or 'ms'
+
+    Returns:
+        numpy.ndarray: The predicted speed of every row in the given unit.
+    """
+    if hasattr(roads, 'columns'):
+        frame = roads
+        roads, natures, hours, dows, depths = \
+            frame['road'], frame['nature'], frame['hour'], frame['dow'], frame['depth']
+
+    if unit not in _UNIT_FACTORS:
+        raise ValueError("Unit must be one of %s" % ", ".join(sorted(_UNIT_FACTORS)))
+
+    roads = np.asarray(roads)
+    natures = np.asarray(natures)
+    hours = __check_hour_array(hours).astype(np.float64)
+    dows = __check_dow_array(dows)
+    days = np.where((dows == 0) | (dows == 6), 0.0, 1.0)
+    depths = np.asarray(depths, dtype=np.float64)
+
+    if not (len(roads) == len(natures) == len(hours) == len(days) == len(depths)):
+        raise ValueError("All inputs must have the same length")
+
+    instrumentation.count("rainbreaker.batch_rows", len(roads))
+
+    speeds = np.empty(len(roads), dtype=np.float64)
+
+    if not len(roads):
+        return speeds
+
+    # Group rows by (road, nature) using integer codes
+    unique_roads, road_codes = np.unique(roads, return_inverse=True)
+    unique_natures, nature_codes = np.unique(natures, return_inverse=True)
+    group_codes = road_codes * len(unique_natures) + nature_codes
+
+    order = np.argsort(group_codes, kind='mergesort')
+    sorted_codes = group_codes[order]
+    boundaries = np.flatnonzero(np.diff(sorted_codes)) + 1
+    starts = np.concatenate(([0], boundaries))
+    ends = np.concatenate((boundaries, [len(order)]))
+
+    approximated_natures = [__get_best_nature_approximation(n) for n in unique_natures]
+
+    for start, end in zip(starts, ends):
+        rows = order[start:end]
+        road_index, nature_index = divmod(sorted_codes[start], len(unique_natures))
+
+        road = unique_roads[road_index]
+        road_data = __get_road_data(road)
+
+        if road_data is None:
+            raise ValueError('Road %s does not exist, please validate beforehand' % road)
+
+        nature_model = road_data.get(approximated_natures[nature_index])
+
+        if nature_model is None:
+            raise ValueError("Road %s does not contain nature %s, use get_natures_for_road "
+                             "to find the natures contained for a given road" % (road, unique_natures[nature_index]))
+
+        if nature_model.function is not None:
+            function = _func_list[nature_model.function]
+            group_days, group_hours = days[rows], hours[rows]
+
+            speed_rainfall = function(nature_model.parameters, depths[rows], group_days, group_hours)
+            speed_no_rainfall = function(nature_model.parameters, np.zeros(len(rows)), group_days, group_hours)
+
+            # Model is increasing
+            speeds[rows] = np.where(speed_no_rainfall < speed_rainfall, speed_no_rainfall, speed_rainfall)
+        elif nature_model.avg_speed is not None:
+            speeds[rows] = nature_model.avg_speed
+        else:
+            raise ValueError("Road %s has no usable model for nature %s" % (road, unique_natures[nature_index]))
+
+    return speeds * _UNIT_FACTORS[unit]
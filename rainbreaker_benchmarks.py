@@ -0,0 +1,486 @@
+"""
+Benchmarks of the rainbreaker prediction and DataManager extraction hot paths.
+
+Predictions are timed against a synthetic directory of road models and extractions against
+synthetic traffic and rainfall tables in their own schema of the configured database, so the
+results only depend on the code under test. Results are written as json and can be compared
+with those of an earlier run:
+
+    python rainbreaker_benchmarks.py --output new.json --compare old.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import timeit
+import numpy as np
+import pandas as pd
+import rainbreaker
+import model_families
+
+NATURES = [
+    "Single Carriageway", "Traffic Island Link", "Dual Carriageway",
+    "Roundabout", "Traffic Island Link At Junction", "Slip Road"
+]
+
+PREDICTION_FUNCTIONS = [
+    ("get_speed_without_rainfall_mph", rainbreaker.get_speed_without_rainfall_mph, False),
+    ("get_speed_without_rainfall_kph", rainbreaker.get_speed_without_rainfall_kph, False),
+    ("get_speed_without_rainfall_ms", rainbreaker.get_speed_without_rainfall_ms, False),
+    ("get_speed_with_rainfall_mph", rainbreaker.get_speed_with_rainfall_mph, True),
+    ("get_speed_with_rainfall_kph", rainbreaker.get_speed_with_rainfall_kph, True),
+    ("get_speed_with_rainfall_ms", rainbreaker.get_speed_with_rainfall_ms, True),
+    ("get_percentage_slowdown", rainbreaker.get_percentage_slowdown, True)
+]
+
+BENCHMARK_SCHEMA = "tfl_benchmark"
+BENCHMARK_TABLES = ("traffic", "rainfall")
+
+# Share of fitted natures, the others only have an average speed
+FITTED_SHARE = 0.8
+
+# Largest rainfall depth in millimeters of the generated calls
+MAX_DEPTH = 4.0
+
+def summarize(times):
+    """
+    :param times: list of durations in seconds
+    :return: dictionary of call count and mean, median, 95th percentile and minimum in microseconds
+    """
+    times = np.asarray(times) * 1e6
+
+    return {
+        "calls": len(times),
+        "mean_us": float(times.mean()),
+        "median_us": float(np.median(times)),
+        "p95_us": float(np.percentile(times, 95)),
+        "min_us": float(times.min())
+    }
+
+def time_each(function, calls):
+    """
+    :param calls: list of argument tuples
+    :return: list of durations in seconds of every call
+    """
+    timer = timeit.default_timer
+    times = []
+
+    for args in calls:
+        start = timer()
+        function(*args)
+        times.append(timer() - start)
+
+    return times
+
+def time_repeated(function, repeat):
+    """
+    :return: (median duration in seconds over repeat calls, result of the last call)
+    """
+    timer = timeit.default_timer
+    times = []
+
+    for _ in range(repeat):
+        start = timer()
+        result = function()
+        times.append(timer() - start)
+
+    return float(np.median(times)), result
+
+def synthetic_parameters(family, random_state):
+    """
+    :return: small positive coefficients and exponents around a constant speed, the last parameter of every family
+    """
+    parameters = random_state.uniform(0.001, 0.05, family.n_parameters)
+    parameters[-1] = random_state.uniform(10, 40)
+    return parameters
+
+def write_model_directory(directory, n_roads, random_state):
+    """
+    Write a road json file per synthetic road as the fitting script does
+    :return: list of (road, list of natures)
+    """
+    families = model_families.get_families()
+    roads = []
+
+    for i in range(n_roads):
+        road = "BENCHMARK ROAD %05i" % i
+        natures = list(random_state.choice(NATURES, random_state.randint(1, 5), replace=False))
+        street_tally = [0] * len(families)
+        nature_results = {}
+
+        for nature in natures:
+            if random_state.uniform() < FITTED_SHARE:
+                function = random_state.randint(len(families))
+                street_tally[function] += 1
+                nature_results[nature] = {
+                    "best_function": function,
+                    "parameters": list(synthetic_parameters(families[function], random_state)),
+                    "mse": random_state.uniform(1, 50),
+                    "mae": random_state.uniform(1, 5)
+                }
+            else:
+                nature_results[nature] = {"avg_speed": random_state.uniform(10, 40)}
+
+        with open(os.path.join(directory, road + ".json"), "wb") as f:
+            json.dump({"street_tally": street_tally, "nature_results": nature_results}, f)
+
+        roads.append((road, natures))
+
+    return roads
+
+def random_calls(roads, n_calls, random_state):
+    """
+    :return: list of (road, nature, hour, dow, depth) over random roads of the model directory
+    """
+    calls = []
+
+    for i in random_state.randint(len(roads), size=n_calls):
+        road, natures = roads[i]
+        calls.append((road, natures[random_state.randint(len(natures))], random_state.randint(24),
+                      random_state.randint(7), random_state.uniform(0, MAX_DEPTH)))
+
+    return calls
+
+def benchmark_cold_start(roads, n_calls, random_state, use_store):
+    """
+    :param use_store: load models from the compiled model store, from the road json files otherwise
+    :return: dictionary of get_available_roads time and first call latency of uncached roads
+    """
+    store_file = os.path.normpath(rainbreaker._data_directory) + ".npy"
+
+    if use_store:
+        build_start = timeit.default_timer()
+        rainbreaker.build_model_store()
+        build_time = timeit.default_timer() - build_start
+    elif os.path.isfile(store_file):
+        os.remove(store_file)
+
+    rainbreaker.invalidate_road()
+
+    start = timeit.default_timer()
+    available_roads = rainbreaker.get_available_roads()
+    list_time = timeit.default_timer() - start
+
+    # Distinct roads so every call loads a model
+    indices = random_state.permutation(len(roads))[:n_calls]
+    calls = [(road, natures[0], 8, 2, 0.5) for road, natures in [roads[i] for i in indices]]
+
+    results = {
+        "roads": len(available_roads),
+        "get_available_roads_ms": list_time * 1e3,
+        "first_call": summarize(time_each(rainbreaker.get_speed_with_rainfall_mph, calls))
+    }
+
+    if use_store:
+        results["build_model_store_ms"] = build_time * 1e3
+        os.remove(store_file)
+        rainbreaker.invalidate_road()
+
+    return results
+
+def benchmark_single_calls(calls):
+    """
+    :return: dictionary of function name -> latency summary, each call made once beforehand so models are cached
+    """
+    results = {}
+
+    for name, function, with_depth in PREDICTION_FUNCTIONS:
+        function_calls = calls if with_depth else [call[:4] for call in calls]
+        time_each(function, function_calls)
+        results[name] = summarize(time_each(function, function_calls))
+
+    return results
+
+def benchmark_batch(calls, repeat):
+    """
+    :return: dictionary of predict_speeds time and throughput over every call at once
+    """
+    frame = pd.DataFrame(calls, columns=["road", "nature", "hour", "dow", "depth"])
+    rainbreaker.predict_speeds(frame)
+    seconds, _ = time_repeated(lambda: rainbreaker.predict_speeds(frame), repeat)
+
+    return {"rows": len(frame), "seconds": seconds, "rows_per_second": len(frame) / seconds}
+
+def benchmark_predictions(directory, args, random_state):
+    """
+    :return: dictionary of cold start, single call and batch results over a synthetic model directory
+    """
+    data_directory = rainbreaker._data_directory
+    rainbreaker._data_directory = directory
+
+    try:
+        roads = write_model_directory(directory, args.roads, random_state)
+        calls = random_calls(roads, args.calls, random_state)
+
+        results = {
+            "cold_start_json": benchmark_cold_start(roads, args.cold_calls, random_state, False),
+            "cold_start_store": benchmark_cold_start(roads, args.cold_calls, random_state, True),
+            "single_call": benchmark_single_calls(calls),
+            "batch": benchmark_batch(random_calls(roads, args.batch_rows, random_state), args.repeat)
+        }
+    finally:
+        rainbreaker._data_directory = data_directory
+        rainbreaker.invalidate_road()
+
+    return results
+
+def create_benchmark_tables(pool, n_links, days):
+    """
+    Create itn_link, link_grid and the traffic and rainfall tables in BENCHMARK_SCHEMA,
+    a link in ten is a motorway and every link has a traffic row for about a third of its 15 minute periods
+    """
+    statements = [
+        "DROP SCHEMA IF EXISTS %s CASCADE" % BENCHMARK_SCHEMA,
+        "CREATE SCHEMA %s" % BENCHMARK_SCHEMA,
+        "CREATE TABLE itn_link (toid VARCHAR(17) PRIMARY KEY, street VARCHAR(80), classification VARCHAR(7), "
+        "description VARCHAR(35), length FLOAT, nature VARCHAR(35))",
+        "CREATE TABLE link_grid (toid VARCHAR(17), box CHAR(9))",
+        "CREATE TABLE traffic (toid VARCHAR(17), period TSRANGE, journey_time INTEGER)",
+        "CREATE TABLE rainfall (os_grid CHAR(9), period TSRANGE, depth DECIMAL(8,4))",
+        """INSERT INTO itn_link
+           SELECT 'B' || i, CASE WHEN i %% 10 = 0 THEN '' ELSE 'BENCHMARK STREET ' || (i %% %(streets)s) END,
+                  CASE WHEN i %% 10 = 0 THEN 'M' || (i %% 7) ELSE 'A' || (i %% 50) END,
+                  CASE WHEN i %% 10 = 0 THEN 'Motorway' ELSE 'A Road' END, 20 + i %% 200,
+                  (ARRAY['%(natures)s'])[1 + i %% %(n_natures)s]
+           FROM generate_series(1, %(links)s) i""",
+        "INSERT INTO link_grid SELECT toid, 'BOX' || (substr(toid, 2)::int %% 16) FROM itn_link",
+        """INSERT INTO traffic
+           SELECT l.toid, tsrange(t, t + interval '15 minutes'), 60 + ((hashtext(l.toid || t::text) %% 240 + 240) %% 240)
+           FROM itn_link l, generate_series('2013-07-01'::timestamp, '2013-07-01'::timestamp + interval '%(days)s days'
+                                            - interval '15 minutes', '15 minutes') t
+           WHERE hashtext(l.toid || t::text) %% 3 = 0""",
+        """INSERT INTO rainfall
+           SELECT 'BOX' || b, tsrange(t, t + interval '5 minutes'), ((hashtext(b::text || t::text) %% 100 + 100) %% 100) / 200.0
+           FROM generate_series(0, 15) b, generate_series('2013-07-01'::timestamp, '2013-07-01'::timestamp
+                                                         + interval '%(days)s days' - interval '5 minutes', '5 minutes') t
+           WHERE hashtext(b::text || t::text) %% 4 = 0""",
+        "CREATE INDEX ON traffic (toid)",
+        "CREATE INDEX ON link_grid (toid)",
+        "CREATE INDEX ON rainfall (os_grid)",
+        "ANALYZE"
+    ]
+
+    settings = {"links": n_links, "streets": max(1, n_links // 20), "days": days,
+                "natures": "','".join(NATURES), "n_natures": len(NATURES)}
+
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            for statement in statements:
+                cur.execute(statement % settings if "%(" in statement else statement.replace("%%", "%"))
+
+            cur.execute("SELECT count(*) FROM traffic")
+            traffic_rows = cur.fetchone()[0]
+
+        conn.commit()
+
+    return traffic_rows
+
+def drop_benchmark_tables(pool):
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DROP SCHEMA IF EXISTS %s CASCADE" % BENCHMARK_SCHEMA)
+        conn.commit()
+
+def benchmark_extraction(args):
+    """
+    :return: dictionary of DataManager extraction results, or the reason they were skipped
+    """
+    try:
+        import psycopg2
+        from dataManager import DataManager, ConnectionPool, get_db_config
+        from linkIndex import LinkIndex
+    except ImportError, e:
+        return {"skipped": str(e)}
+
+    connect_kwargs = get_db_config()
+    connect_kwargs["options"] = "-c search_path=%s" % BENCHMARK_SCHEMA
+    pool = ConnectionPool(max_size=2, **connect_kwargs)
+
+    try:
+        traffic_rows = create_benchmark_tables(pool, args.links, args.days)
+    except psycopg2.Error, e:
+        return {"skipped": str(e).strip()}
+
+    index_directory = tempfile.mkdtemp(prefix="link_index_")
+
+    try:
+        dM = DataManager(pool=pool)
+        indexed_dM = DataManager(pool=pool, link_index=LinkIndex(os.path.join(index_directory, "link_index.npz")))
+        materialized_dM = DataManager(pool=pool, materialized_rainfall=True)
+        streets = sorted(dM.get_streets())
+        roads = [("street", street) for street in streets if street][:args.extract_roads]
+        hours = tuple(range(24))
+        days = tuple(range(7))
+
+        results = {"traffic_rows": traffic_rows, "links": args.links, "extract_roads": len(roads)}
+
+        # First call builds the link index
+        seconds, _ = time_repeated(lambda: indexed_dM.get_data(*(BENCHMARK_TABLES + (roads[:1], NATURES, hours, days))), 1)
+        results["link_index_build_ms"] = seconds * 1e3
+
+        # Full build, then the refresh of an unchanged table
+        seconds, _ = time_repeated(lambda: materialized_dM.materialize_rainfall(BENCHMARK_TABLES[1]), 1)
+        results["materialize_rainfall_ms"] = seconds * 1e3
+        seconds, _ = time_repeated(lambda: materialized_dM.materialize_rainfall(BENCHMARK_TABLES[1]), 1)
+        results["refresh_rainfall_ms"] = seconds * 1e3
+
+        for name, manager, compact in (("get_data", dM, False), ("get_data_compact", dM, True),
+                                       ("get_data_indexed", indexed_dM, False),
+                                       ("get_data_materialized", materialized_dM, False)):
+            seconds, data = time_repeated(lambda: manager.get_data(*(BENCHMARK_TABLES + (roads, NATURES, hours, days)),
+                                                                   compact=compact), args.repeat)
+            results[name] = {"rows": len(data), "seconds": seconds, "rows_per_second": len(data) / seconds}
+
+        for name, manager, compact in (("iter_data", dM, False), ("iter_data_compact", dM, True),
+                                       ("iter_data_indexed", indexed_dM, False),
+                                       ("iter_data_materialized", materialized_dM, False)):
+            seconds, rows = time_repeated(lambda: sum(len(chunk) for chunk in manager.iter_data(
+                *(BENCHMARK_TABLES + (roads, NATURES, hours, days)), chunk_size=args.chunk_size, compact=compact)),
+                args.repeat)
+            results[name] = {"rows": rows, "seconds": seconds, "rows_per_second": rows / seconds}
+
+        def extract_every_road():
+            return sum(len(frames[0]) for _, _, frames in dM.iter_road_data(
+                [BENCHMARK_TABLES], NATURES, hours, days, chunk_size=args.chunk_size))
+
+        seconds, rows = time_repeated(extract_every_road, args.repeat)
+        results["iter_road_data"] = {"rows": rows, "seconds": seconds, "rows_per_second": rows / seconds}
+    finally:
+        shutil.rmtree(index_directory)
+
+        if not args.keep_tables:
+            drop_benchmark_tables(pool)
+
+    return results
+
+def get_revision():
+    """
+    :return: git revision of the working tree, None outside a git checkout
+    """
+    try:
+        with open(os.devnull, "wb") as devnull:
+            return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=devnull,
+                                           cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def flatten(results, prefix=""):
+    """
+    :return: dictionary of dotted path -> value of every numeric result
+    """
+    flat = {}
+
+    for key, value in results.iteritems():
+        path = prefix + key
+
+        if isinstance(value, dict):
+            flat.update(flatten(value, path + "."))
+        elif isinstance(value, (int, long, float)) and not isinstance(value, bool):
+            flat[path] = value
+
+    return flat
+
+def compare(old_results, new_results, threshold):
+    """
+    Print the ratio of every median, 95th percentile, timing and throughput present in both results
+    :param threshold: ratio beyond which a slower result counts as a regression
+    :return: list of regressed result paths
+    """
+    old_flat = flatten(old_results)
+    new_flat = flatten(new_results)
+    regressions = []
+
+    for path in sorted(set(old_flat) & set(new_flat)):
+        old_value, new_value = old_flat[path], new_flat[path]
+
+        if path.endswith("_per_second"):
+            # Throughput, lower is slower
+            ratio = old_value / new_value if new_value else float("inf")
+        elif path.endswith(("median_us", "p95_us", "_ms", "seconds")):
+            ratio = new_value / old_value if old_value else float("inf")
+        else:
+            continue
+
+        regressed = ratio > threshold
+        if regressed:
+            regressions.append(path)
+
+        print "%-70s %12.4g %12.4g %7.2fx%s" % (path, old_value, new_value, ratio, " REGRESSION" if regressed else "")
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark rainbreaker predictions and DataManager extraction")
+    parser.add_argument("--output", default="benchmark_results.json", help="file to write the json results to")
+    parser.add_argument("--compare", help="json results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="slowdown ratio reported as a regression when comparing")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic models and calls")
+    parser.add_argument("--roads", type=int, default=2000, help="number of roads in the synthetic model directory")
+    parser.add_argument("--calls", type=int, default=2000, help="number of timed calls per prediction function")
+    parser.add_argument("--cold-calls", type=int, default=500, help="number of first calls to uncached roads")
+    parser.add_argument("--batch-rows", type=int, default=100000, help="number of rows per predict_speeds call")
+    parser.add_argument("--repeat", type=int, default=5, help="repeats of batch and extraction benchmarks")
+    parser.add_argument("--links", type=int, default=200, help="number of links in the synthetic database")
+    parser.add_argument("--days", type=int, default=7, help="days of synthetic traffic and rainfall")
+    parser.add_argument("--extract-roads", type=int, default=10, help="number of streets selected by get_data")
+    parser.add_argument("--chunk-size", type=int, default=50000, help="chunk size of streamed extractions")
+    parser.add_argument("--skip-db", action="store_true", help="skip the DataManager extraction benchmarks")
+    parser.add_argument("--keep-tables", action="store_true",
+                        help="keep the %s schema after the extraction benchmarks" % BENCHMARK_SCHEMA)
+    args = parser.parse_args()
+
+    random_state = np.random.RandomState(args.seed)
+    directory = tempfile.mkdtemp(prefix="rainbreaker_benchmark_")
+
+    try:
+        print "Prediction benchmarks over %i synthetic roads" % args.roads
+        predictions = benchmark_predictions(directory, args, random_state)
+    finally:
+        shutil.rmtree(directory)
+
+    if args.skip_db:
+        extraction = {"skipped": "--skip-db"}
+    else:
+        print "Extraction benchmarks over %i synthetic links" % args.links
+        extraction = benchmark_extraction(args)
+
+    if "skipped" in extraction:
+        print "Extraction benchmarks skipped: %s" % extraction["skipped"]
+
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "revision": get_revision(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "settings": vars(args),
+        "predictions": predictions,
+        "extraction": extraction
+    }
+
+    with open(args.output, "wb") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    print "Results written to %s" % args.output
+
+    if args.compare:
+        with open(args.compare) as f:
+            old_results = json.load(f)
+
+        regressions = compare({"predictions": old_results["predictions"], "extraction": old_results["extraction"]},
+                              {"predictions": predictions, "extraction": extraction}, args.threshold)
+
+        if regressions:
+            print "%i results regressed beyond %.2fx" % (len(regressions), args.threshold)
+            return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
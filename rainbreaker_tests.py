@@ -2,6 +2,7 @@ import rainbreaker as rb
 import os
 import numpy
 import pytest
+import contextlib
 
 class TestRainbreaker():
 
@@ -114,3 +115,966 @@ class TestRainbreaker():
     def test_throws_value_error_invalid_dow_string(self):
         with pytest.raises(ValueError):
             rb.get_speed_with_rainfall_kph("TEST_STREET5", "Single Carriageway", 0, "Yaladay", 0.3)
+
+    def test_road_model_loaded_once(self):
+        rb.invalidate_road()
+        rb.get_percentage_slowdown("TEST_STREET5", "Single Carriageway", 5, "Monday", 0.3)
+        rb.get_percentage_slowdown("TEST_STREET5", "Single Carriageway", 6, "Monday", 0.4)
+        assert rb.get_model_cache_stats()["roads"] == 1
+
+    def test_invalidate_road_drops_cached_model(self, monkeypatch):
+        load_road_model = getattr(rb, "__load_road_model")
+        loads = []
+        monkeypatch.setattr(rb, "__load_road_model",
+                            lambda road, file_name: loads.append(road) or load_road_model(road, file_name))
+
+        rb.invalidate_road()
+        rb.validate_road("TEST_STREET1")
+        rb.validate_road("TEST_STREET2")
+        assert loads == ["TEST_STREET1", "TEST_STREET2"]
+        assert rb.get_model_cache_stats()["roads"] == 2
+
+        rb.invalidate_road("test_street1")
+        assert rb.get_model_cache_stats()["roads"] == 1
+        rb.validate_road("TEST_STREET1")
+        rb.validate_road("TEST_STREET2")
+        assert loads == ["TEST_STREET1", "TEST_STREET2", "TEST_STREET1"]
+
+        rb.invalidate_road()
+        assert rb.get_model_cache_stats() == {"roads": 0, "bytes": 0, "max_bytes": rb._MODEL_CACHE_MAX_BYTES}
+
+    def test_model_cache_evicts_under_memory_limit(self):
+        rb.invalidate_road()
+        rb.validate_road("TEST_STREET1")
+        one_road_bytes = rb.get_model_cache_stats()["bytes"]
+
+        try:
+            rb.set_model_cache_limit(one_road_bytes)
+            rb.validate_road("TEST_STREET2")
+            rb.validate_road("TEST_STREET3")
+            stats = rb.get_model_cache_stats()
+            assert stats["bytes"] <= one_road_bytes
+            assert stats["roads"] == 1
+            assert rb.get_natures_for_road("TEST_STREET1")
+        finally:
+            rb.set_model_cache_limit(rb._MODEL_CACHE_MAX_BYTES)
+
+    def test_predict_speeds_matches_scalar_api(self):
+        rows = [("TEST_STREET5", "Single Carriageway", 5, "Monday", 0.3),
+                ("TEST_STREET3", "Single Carriageway", 5, 1, 0.1),
+                ("test_street3", "Dual Carriageway", 16, 0, 0.8),
+                ("TEST_STREET2", "Single Carriageway", 5, "Monday", 0.1),
+                ("TEST_STREET5", "Single Carriageway", 7, 6, 0.0)]
+        roads, natures, hours, dows, depths = zip(*rows)
+
+        expected = [rb.get_speed_with_rainfall_kph(*row) for row in rows]
+        speeds = rb.predict_speeds(roads, natures, list(hours), list(dows), depths, unit='kph')
+
+        assert numpy.allclose(speeds, expected)
+
+    def test_predict_speeds_accepts_dataframe(self):
+        import pandas as pd
+        frame = pd.DataFrame({'road': ["TEST_STREET3", "TEST_STREET3"], 'nature': ["Single Carriageway"] * 2,
+                              'hour': [5, 6], 'dow': [1, 2], 'depth': [0.1, 0.2]})
+        assert numpy.allclose(rb.predict_speeds(frame),
+                              [rb.get_speed_with_rainfall_mph("TEST_STREET3", "Single Carriageway", 5, 1, 0.1),
+                               rb.get_speed_with_rainfall_mph("TEST_STREET3", "Single Carriageway", 6, 2, 0.2)])
+
+    def test_predict_speeds_validates_input(self):
+        with pytest.raises(ValueError):
+            rb.predict_speeds(["TEST_STREET5"], ["Single Carriageway"], [24], [1], [0.3])
+        with pytest.raises(TypeError):
+            rb.predict_speeds(["TEST_STREET5"], ["Single Carriageway"], [5], [1.0], [0.3])
+        with pytest.raises(ValueError):
+            rb.predict_speeds(["UNEXISTENT ROAD"], ["Single Carriageway"], [5], [1], [0.3])
+        with pytest.raises(ValueError):
+            rb.predict_speeds(["TEST_STREET5"], ["Single Carriageway"], [5], [1], [0.3], unit='knots')
+
+    def test_model_store_matches_json_files(self):
+        rows = [("TEST_STREET1", "Dual Carriageway", 5, "Monday", 0.0),
+                ("TEST_STREET3", "Single Carriageway", 5, 1, 0.1),
+                ("TEST_STREET3", "Dual Carriageway", 16, 0, 0.8),
+                ("TEST_STREET5", "Slip Road", 7, 6, 0.3)]
+        roads = rb.get_available_roads()
+        natures = [rb.get_natures_for_road(road) for road in roads]
+        speeds = [rb.get_speed_with_rainfall_mph(*row) for row in rows]
+
+        store_file = rb.build_model_store()
+        try:
+            assert self.check_list_equal(rb.get_available_roads(), roads)
+            assert [sorted(rb.get_natures_for_road(road)) for road in roads] == [sorted(n) for n in natures]
+            assert [rb.get_speed_with_rainfall_mph(*row) for row in rows] == speeds
+            assert not rb.validate_road('UNEXISTENT ROAD')
+        finally:
+            os.remove(store_file)
+            rb.invalidate_road()
+
+    def test_invalidate_road_rereads_road_rewritten_after_store(self):
+        import json
+        import shutil
+        import tempfile
+
+        data_directory = rb._data_directory
+        temp_directory = tempfile.mkdtemp()
+        rb._data_directory = os.path.join(temp_directory, 'road_data')
+        shutil.copytree(data_directory, rb._data_directory)
+        rb.invalidate_road()
+
+        try:
+            store_file = rb.build_model_store()
+            assert numpy.isclose(rb.get_speed_with_rainfall_mph("TEST_STREET3", "Dual Carriageway", 5, "Monday", 0.1), 35.9989)
+
+            road_file = os.path.join(rb._data_directory, "TEST_STREET3.json")
+            with open(road_file) as f:
+                data = json.load(f)
+            data["nature_results"]["Dual Carriageway"]["avg_speed"] = 99
+            with open(road_file, "w") as f:
+                json.dump(data, f)
+            store_mtime = os.path.getmtime(store_file)
+            os.utime(road_file, (store_mtime + 1, store_mtime + 1))
+
+            rb.invalidate_road("TEST_STREET3")
+            assert rb.get_speed_with_rainfall_mph("TEST_STREET3", "Dual Carriageway", 5, "Monday", 0.1) == 99
+            assert numpy.isclose(rb.get_speed_with_rainfall_mph("TEST_STREET3", "Single Carriageway", 5, "Monday", 0.1), 11.709)
+        finally:
+            rb._data_directory = data_directory
+            shutil.rmtree(temp_directory)
+            rb.invalidate_road()
+
+    def test_road_rewritten_by_another_process_is_reloaded(self):
+        import json
+        import shutil
+        import tempfile
+
+        data_directory = rb._data_directory
+        temp_directory = tempfile.mkdtemp()
+        rb._data_directory = os.path.join(temp_directory, 'road_data')
+        shutil.copytree(data_directory, rb._data_directory)
+        rb.invalidate_road()
+
+        try:
+            assert numpy.isclose(rb.get_speed_with_rainfall_mph("TEST_STREET3", "Dual Carriageway", 5, "Monday", 0.1), 35.9989)
+
+            road_file = os.path.join(rb._data_directory, "TEST_STREET3.json")
+            with open(road_file) as f:
+                data = json.load(f)
+            data["nature_results"]["Dual Carriageway"]["avg_speed"] = 99
+            with open(road_file, "w") as f:
+                json.dump(data, f)
+            road_mtime = os.path.getmtime(road_file)
+            os.utime(road_file, (road_mtime + 1, road_mtime + 1))
+
+            # No invalidate_road, as in a process serving predictions while the fitter rewrites the road
+            assert rb.get_speed_with_rainfall_mph("TEST_STREET3", "Dual Carriageway", 5, "Monday", 0.1) == 99
+            assert rb.get_model_cache_stats()["roads"] == 1
+        finally:
+            rb._data_directory = data_directory
+            shutil.rmtree(temp_directory)
+            rb.invalidate_road()
+
+    def test_model_store_keeps_long_names(self):
+        import shutil
+        import tempfile
+
+        data_directory = rb._data_directory
+        temp_directory = tempfile.mkdtemp()
+        rb._data_directory = os.path.join(temp_directory, 'road_data')
+        shutil.copytree(data_directory, rb._data_directory)
+        long_road = "A VERY LONG ROAD NAME " * 6
+        shutil.copy(os.path.join(rb._data_directory, "TEST_STREET3.json"),
+                    os.path.join(rb._data_directory, long_road + ".json"))
+        rb.invalidate_road()
+
+        try:
+            rb.build_model_store()
+            assert long_road in rb.get_available_roads()
+            assert rb.validate_road(long_road)
+            assert sorted(rb.get_natures_for_road(long_road)) == sorted(rb.get_natures_for_road("TEST_STREET3"))
+        finally:
+            rb._data_directory = data_directory
+            shutil.rmtree(temp_directory)
+            rb.invalidate_road()
+
+    def test_nature_id_same_as_nature_name(self):
+        nature_id = rb.resolve_nature("SinGllle Carriagewway")
+        assert nature_id == rb.resolve_nature("Single Carriageway")
+        assert rb.get_speed_with_rainfall_mph("TEST_STREET5", nature_id, 5, "Monday", 0.3) == \
+            rb.get_speed_with_rainfall_mph("TEST_STREET5", "Single Carriageway", 5, "Monday", 0.3)
+        assert numpy.allclose(rb.predict_speeds(["TEST_STREET5"], [nature_id], [5], [1], [0.3]),
+                              [rb.get_speed_with_rainfall_mph("TEST_STREET5", "Single Carriageway", 5, "Monday", 0.3)])
+
+    def test_invalid_nature_id_or_name(self):
+        with pytest.raises(ValueError):
+            rb.resolve_nature("Footpath across the park")
+        with pytest.raises(ValueError):
+            rb.get_speed_with_rainfall_mph("TEST_STREET5", 6, 5, "Monday", 0.3)
+
+    def test_nature_cache_counts_exact_and_fuzzy_matches(self):
+        before = rb.get_nature_cache_stats()
+        rb.get_speed_with_rainfall_mph("TEST_STREET5", "Single Carriageway", 5, "Monday", 0.3)
+        rb.get_speed_with_rainfall_mph("TEST_STREET5", "Single Carriageway ", 5, "Monday", 0.3)
+        rb.get_speed_with_rainfall_mph("TEST_STREET5", "Single Carriageway ", 5, "Monday", 0.3)
+        after = rb.get_nature_cache_stats()
+
+        assert after["exact"] - before["exact"] == 2
+        assert after["misses"] - before["misses"] == 1
+        assert after["hits"] - before["hits"] == 3
+
+    def test_model_family_jacobians_match_finite_differences(self):
+        import model_families
+        depths = numpy.array([0.0, 0.1, 0.4, 1.2])
+        days = numpy.array([0.0, 1.0, 1.0, 0.0])
+        hours = numpy.array([0.0, 5.0, 12.0, 23.0])
+        speeds = numpy.array([30.0, 25.0, 40.0, 35.0])
+
+        for family in model_families.get_families():
+            params = numpy.linspace(0.5, 1.0, family.n_parameters) * 0.1
+            jacobian = family.jacobian(params, speeds, depths, days, hours)
+            assert jacobian.shape == (family.n_parameters, len(depths))
+
+            for i in range(family.n_parameters):
+                step = numpy.zeros(family.n_parameters)
+                step[i] = 1e-6
+                numeric = (family.residual(params + step, speeds, depths, days, hours) -
+                           family.residual(params - step, speeds, depths, days, hours)) / 2e-6
+                assert numpy.allclose(jacobian[i], numeric, rtol=1e-4, atol=1e-4)
+
+    def test_instrumentation_records_predictions_only_when_enabled(self):
+        import instrumentation
+        instrumentation.reset()
+        rb.get_speed_with_rainfall_mph("TEST_STREET5", "Single Carriageway", 5, "Monday", 0.3)
+        assert instrumentation.get_report()["counters"] == {}
+
+        instrumentation.enable()
+        try:
+            rb.predict_speeds(["TEST_STREET5"] * 3, ["Single Carriageway"] * 3, [5, 6, 7], [1, 1, 1], [0.3, 0.3, 0.3])
+            rb.get_speed_with_rainfall_mph("TEST_STREET5", "Single Carriageway", 5, "Monday", 0.3)
+        finally:
+            instrumentation.disable()
+
+        report = instrumentation.get_report()
+        instrumentation.reset()
+
+        assert report["counters"]["rainbreaker.batch_rows"] == 3
+        assert report["counters"]["rainbreaker.predictions"] == 2
+        assert report["timers"]["rainbreaker.predict_speeds"]["calls"] == 1
+
+class FakeConnection(object):
+    """
+    psycopg2 connection stand-in recording every statement. Cursors return the rows of the first results
+    entry whose text, or every text of a tuple, is in the query executed or the statement it executes,
+    else rows, and fetchmany returns chunks when no results entry matches
+    """
+
+    def __init__(self, rows=(), chunks=(), results=()):
+        self.closed = False
+        self.status = 1
+        self.statements = []
+        self.rows = list(rows)
+        self.chunks = list(chunks)
+        self.results = list(results)
+        self.prepared = {}
+
+    def cursor(self, name=None):
+        return FakeCursor(self)
+
+    def rollback(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+class FakeCursor(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.query = None
+        self.position = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def execute(self, query, params=None):
+        self.connection.statements.append((query, params))
+
+        if query.startswith("PREPARE "):
+            name, text = query[len("PREPARE "):].split(" AS ", 1)
+            self.connection.prepared[name] = text
+
+        self.query = self.connection.prepared.get(query.split(" ")[1], query) if query.startswith("EXECUTE ") else query
+        self.position = 0
+
+    def matching_rows(self):
+        for texts, rows in self.connection.results:
+            texts = (texts,) if isinstance(texts, str) else texts
+            if self.query is not None and all(text in self.query for text in texts):
+                return list(rows)
+        return None
+
+    def fetchall(self):
+        rows = self.matching_rows()
+        return list(self.connection.rows) if rows is None else rows
+
+    def fetchone(self):
+        rows = self.fetchall()
+        return rows[0] if rows else None
+
+    def fetchmany(self, size):
+        rows = self.matching_rows()
+
+        if rows is None:
+            return self.connection.chunks.pop(0) if self.connection.chunks else []
+
+        self.position += size
+        return rows[self.position - size:self.position]
+
+    def close(self):
+        pass
+
+class FakePool(object):
+
+    def __init__(self, connection):
+        self.fake_connection = connection
+
+    @contextlib.contextmanager
+    def connection(self):
+        yield self.fake_connection
+
+class TestDataManager():
+
+    def test_pool_keeps_connections_inherited_across_fork(self, monkeypatch):
+        import gc
+        import weakref
+        import dataManager
+
+        opened = []
+        monkeypatch.setattr(dataManager.psycopg2, "connect", lambda **kwargs: opened.append(FakeConnection()) or opened[-1])
+        pool = dataManager.ConnectionPool(max_size=1, database="tfl")
+
+        with pool.connection():
+            pass
+        inherited = weakref.ref(opened.pop())
+
+        parent_pid = os.getpid()
+        monkeypatch.setattr(dataManager.os, "getpid", lambda: parent_pid + 1)
+        gc.collect()
+
+        with pool.connection() as conn:
+            assert conn is opened[-1]
+        gc.collect()
+
+        assert inherited() is not None
+        assert not inherited().closed
+
+    def test_compact_chunks_share_categories(self):
+        import pandas as pd
+        import dataManager
+
+        conn = FakeConnection(rows=[("Single Carriageway", "A ROAD"), ("Slip Road", "A ROAD"), ("Slip Road", "B ROAD")],
+                              chunks=[[(30.0, 0.0, "Single Carriageway", "A ROAD", 8, 1)],
+                                      [(20.0, 0.5, "Slip Road", "B ROAD", 9, 1)]])
+        dm = dataManager.DataManager(pool=FakePool(conn))
+
+        chunks = list(dm.iter_data("traffic", "rainfall", [("street", "A ROAD"), ("street", "B ROAD")],
+                                   ["Single Carriageway", "Slip Road"], (8, 9), (1,), chunk_size=1, compact=True))
+        data = pd.concat(chunks, ignore_index=True)
+
+        assert len(chunks) == 2
+        for column, categories in (("nature", ["Single Carriageway", "Slip Road"]), ("identifier", ["A ROAD", "B ROAD"])):
+            assert str(data[column].dtype) == "category"
+            assert list(data[column].cat.categories) == categories
+        assert list(data.identifier) == ["A ROAD", "B ROAD"]
+
+    def test_selections_run_as_statements_prepared_once_per_connection(self):
+        import re
+        import dataManager
+
+        def get_data(conn):
+            dm = dataManager.DataManager(pool=FakePool(conn))
+            dm.get_data("traffic", "rainfall", [("street", "A ROAD"), ("street", "B ROAD")], ["Slip Road"], (8, 9), (1,))
+            return [statement for statement in conn.statements if statement[0].startswith(("PREPARE", "EXECUTE"))]
+
+        first = FakeConnection()
+        statements = get_data(first)
+        prepares = [query for query, params in statements if query.startswith("PREPARE")]
+        executes = [(query, params) for query, params in statements if query.startswith("EXECUTE")]
+
+        # Toid lookup then traffic and rainfall, every value list bound as one array parameter
+        assert len(prepares) == len(executes) == 2
+        assert "street = ANY($1)" in prepares[0] and "nature = ANY($2)" in prepares[0]
+        for prepare, (execute, params) in zip(prepares, executes):
+            name = re.match(r"PREPARE (tfl_[0-9a-f]{32}) AS ", prepare).group(1)
+            assert execute == "EXECUTE %s (%s)" % (name, ", ".join(["%s"] * len(params)))
+            assert "%s" not in prepare and "$%i" % len(params) in prepare
+            assert all(isinstance(param, list) for param in params)
+        assert executes[0][1] == [["A ROAD", "B ROAD"], ["Slip Road"]]
+
+        # The same connection reuses its statements, a new one prepares them again
+        assert [query for query, params in get_data(first)[len(statements):]] == [query for query, params in executes]
+        assert [query for query, params in get_data(FakeConnection()) if query.startswith("PREPARE")] == prepares
+
+    def test_iter_data_chunks_match_get_data(self):
+        import decimal
+        import pandas as pd
+        import dataManager
+
+        links = [("T1", 100.0, "Single Carriageway", "A ROAD", "A ROAD"), ("T2", 50.0, "Slip Road", None, "B ROAD")]
+        time_depth = [("T1", 1200, decimal.Decimal("0.0"), 8, 1), ("T2", 900, decimal.Decimal("1.25"), 8, 1),
+                      ("T1", 1500, decimal.Decimal("0.5"), 9, 1), ("T2", 600, decimal.Decimal("0.0"), 9, 2),
+                      ("T1", 1000, decimal.Decimal("2.0"), 8, 2), ("T1", 800, decimal.Decimal("0.1"), 9, 2),
+                      ("T2", 750, decimal.Decimal("0.3"), 9, 1)]
+        conn = FakeConnection(results=[("FROM itn_link", links), ("SUM(COALESCE(rainfall.depth, 0))", time_depth)])
+        dm = dataManager.DataManager(pool=FakePool(conn))
+        selection = ("traffic", "rainfall", [("street", "A ROAD"), ("classification", "B ROAD")],
+                     ["Single Carriageway", "Slip Road"], (8, 9), (1, 2))
+
+        chunks = list(dm.iter_data(*selection, chunk_size=3))
+        data = dm.get_data(*selection)
+
+        assert [len(chunk) for chunk in chunks] == [3, 3, 1]
+        pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), data)
+
+        lengths = {"T1": 100.0, "T2": 50.0}
+        expected_speeds = [2.23694 * lengths[row[0]] / (row[1] / 100.0) for row in time_depth]
+        assert numpy.allclose(data.speed, expected_speeds)
+        assert list(data.depth) == [float(row[2]) for row in time_depth]
+        assert list(data.identifier[:2]) == ["A ROAD", "B ROAD"]
+
+    def test_road_streams_match_per_road_queries(self):
+        import decimal
+        import pandas as pd
+        import dataManager
+
+        links = {"T1": (100.0, "Single Carriageway", "BAKER STREET", "A41"), "T2": (50.0, "Slip Road", "BAKER STREET", "A41"),
+                 "T3": (80.0, "Single Carriageway", "OXFORD STREET", "A40"), "T4": (60.0, "Slip Road", "REGENT STREET", "A4"),
+                 "M1": (500.0, "Dual Carriageway", None, "M1"), "M2": (400.0, "Slip Road", None, "M1")}
+        # BAKER STREET only has traffic in the first table pair and REGENT STREET only in the second
+        traffic = {"traffic": [("T1", 1200, 8, 1), ("T2", 900, 8, 1), ("T1", 1500, 9, 1), ("T3", 600, 9, 2),
+                               ("T2", 1000, 8, 2), ("M1", 3000, 8, 1), ("T3", 700, 8, 1), ("M2", 2500, 9, 2),
+                               ("M1", 3300, 9, 1)],
+                   "traffic_aug13": [("T3", 650, 8, 1), ("T4", 500, 9, 1), ("M2", 2400, 8, 2), ("T4", 450, 8, 2)]}
+        natures = ["Single Carriageway", "Slip Road", "Dual Carriageway"]
+
+        def time_depth(toid, journey_time, hour, dow):
+            return toid, journey_time, decimal.Decimal(journey_time % 7) / 4, hour, dow
+
+        def road_rows(traffic_table, column):
+            # Rows of the partition query, ordered by road
+            position = {"street": 2, "classification": 3}[column]
+            rows = [(links[row[0]][position],) + time_depth(*row)[:5] + links[row[0]] for row in traffic[traffic_table]
+                    if links[row[0]][position] is not None and (column == "street" or row[0].startswith("M"))]
+            return sorted(rows, key=lambda row: row[0])
+
+        results = [(("itn_link.%s as road" % column, "%s as traffic" % traffic_table), road_rows(traffic_table, column))
+                   for column in ("street", "classification") for traffic_table in ("traffic_aug13", "traffic")]
+        streams = FakeConnection(results=results)
+        dm = dataManager.DataManager(pool=FakePool(streams))
+
+        roads = list(dm.iter_road_data([("traffic", "rainfall"), ("traffic_aug13", "rainfall_aug13")], natures,
+                                       (8, 9), (1, 2), chunk_size=2))
+
+        assert [(column, road) for column, road, frames in roads] == [
+            ("street", "BAKER STREET"), ("street", "OXFORD STREET"), ("street", "REGENT STREET"), ("classification", "M1")]
+
+        for column, road, frames in roads:
+            position = {"street": 2, "classification": 3}[column]
+            road_links = [(toid,) + link for toid, link in sorted(links.items()) if link[position] == road]
+
+            for traffic_table, frame in zip(("traffic", "traffic_aug13"), frames):
+                rows = [time_depth(*row) for row in traffic[traffic_table] if links[row[0]][position] == road]
+
+                if not rows:
+                    assert len(frame) == 0
+                    continue
+
+                # The road as queried on its own before bulk extraction
+                conn = FakeConnection(results=[("FROM itn_link", road_links), ("SUM(COALESCE", rows)])
+                expected = dataManager.DataManager(pool=FakePool(conn)).get_data(
+                    traffic_table, "rainfall", [(column, road)], natures, (8, 9), (1, 2))
+
+                pd.testing.assert_frame_equal(frame[expected.columns], expected)
+
+        # Motorway roads hold every link of the classification of a motorway link, not only its motorway links
+        motorway_queries = [query for query, params in streams.statements if "itn_link.classification as road" in query]
+        assert len(motorway_queries) == 2
+        for query in motorway_queries:
+            assert "itn_link.classification IN (SELECT classification FROM itn_link WHERE description = 'Motorway')" in query
+
+    def test_indexed_rainfall_restricted_to_selected_hours_and_days(self, tmpdir):
+        import dataManager
+        import linkIndex
+
+        conn = FakeConnection(results=[
+            ("SELECT (SELECT COUNT(*)", [(1, 2)]),
+            ("FROM itn_link", [("T1", 100.0, "Slip Road", "A ROAD", "A1")]),
+            ("FROM link_grid", [("T1", "B1"), ("T1", "B2")]),
+            ("rainfall.os_grid", [("B1", 3600 * 8, 3600 * 8 + 300, 250000), ("B2", 3600 * 8 + 600, 3600 * 8 + 900, 500000)]),
+            ("traffic.journey_time", [("T1", 1000, 3600 * 8, 3600 * 8 + 900, 8, 1, 1)])])
+        dm = dataManager.DataManager(pool=FakePool(conn), link_index=linkIndex.LinkIndex(str(tmpdir.join("index.npz"))))
+
+        data = dm.get_data("traffic", "rainfall", [("street", "A ROAD")], ["Slip Road"], (8, 9), (1,))
+
+        assert list(data.depth) == [0.75]
+        executed = [(conn.prepared[query.split(" ")[1]], params) for query, params in conn.statements
+                    if query.startswith("EXECUTE")]
+        rainfall_queries = [(query, params) for query, params in executed if "rainfall.os_grid" in query]
+        assert len(rainfall_queries) == 1
+        assert "EXTRACT(HOUR FROM lower(rainfall.period)) = ANY($2)" in rainfall_queries[0][0]
+        assert "EXTRACT(DOW FROM lower(rainfall.period)) = ANY($3)" in rainfall_queries[0][0]
+        assert rainfall_queries[0][1] == [["B1", "B2"], [8, 9], [1]]
+
+    def materialization_results(self, state=None, exists=False, rows_before=100):
+        import datetime
+
+        return [("SELECT watermark, rows_before, period_minutes", [state] if state else []),
+                ("to_regclass", [("rainfall_by_period" if exists else None,)]),
+                ("SELECT COUNT(*) FROM rainfall WHERE", [(rows_before,)]),
+                ("SELECT MAX(", [(datetime.datetime(2013, 7, 7, 23, 45),)])]
+
+    def materialize(self, state, exists=True, rows_before=100):
+        import dataManager
+
+        conn = FakeConnection(results=self.materialization_results(state, exists, rows_before))
+
+        assert dataManager.DataManager(pool=FakePool(conn)).materialize_rainfall("rainfall") == "rainfall_by_period"
+        assert conn.statements[0] == ("SELECT pg_advisory_xact_lock(hashtext(%s))", ("rainfall_by_period",))
+
+        return conn.statements
+
+    def assert_rebuilt(self, statements):
+        queries = [query for query, params in statements]
+        assert "DROP TABLE IF EXISTS rainfall_by_period" in queries
+        assert [query for query in queries if query.startswith("CREATE TABLE rainfall_by_period AS")]
+        assert not [query for query in queries if query.startswith(("INSERT INTO rainfall_by_period",
+                                                                    "DELETE FROM rainfall_by_period"))]
+
+    def test_materialize_rainfall_builds_then_refreshes_incrementally(self):
+        import datetime
+
+        watermark = datetime.datetime(2013, 7, 1, 12, 0)
+        state_update = ("INSERT INTO rainfall_materializations VALUES (%s, %s, %s, %s)",
+                        ("rainfall", datetime.datetime(2013, 7, 7, 23, 45), 100, 15))
+
+        # First build, no state and no materialized table
+        statements = self.materialize(None, exists=False)
+        self.assert_rebuilt(statements)
+        assert ("ANALYZE rainfall_by_period", None) in statements
+        assert statements[-2] == state_update
+
+        # Rows before the watermark unchanged, only traffic periods from the watermark are summed again
+        statements = self.materialize((watermark, 100, 15))
+        queries = [query for query, params in statements]
+        assert ("DELETE FROM rainfall_by_period WHERE lower(period) >= %s", (watermark,)) in statements
+        inserts = [(query, params) for query, params in statements if query.startswith("INSERT INTO rainfall_by_period")]
+        assert len(inserts) == 1 and inserts[0][1] == (watermark,)
+        assert "lower(rainfall.period) >= %s" in inserts[0][0]
+        assert not [query for query in queries if "CREATE TABLE rainfall_by_period" in query or query.startswith("DROP")]
+        assert statements[-1] == state_update
+
+    def test_materialize_rainfall_rebuilds_when_source_or_periods_change(self):
+        import datetime
+
+        watermark = datetime.datetime(2013, 7, 1, 12, 0)
+
+        # Rows removed before the watermark
+        self.assert_rebuilt(self.materialize((watermark, 120, 15), rows_before=100))
+        # Materialized with other traffic periods
+        self.assert_rebuilt(self.materialize((watermark, 100, 30)))
+        # State left without its table
+        self.assert_rebuilt(self.materialize((watermark, 100, 15), exists=False))
+
+    def test_materialized_rainfall_joined_on_period_equality(self, monkeypatch):
+        import psycopg2
+        import dataManager
+
+        def time_depth_query(dm, conn):
+            dm.get_data("traffic", "rainfall", [("street", "A ROAD")], ["Slip Road"], (8,), (1,))
+            return [text for text in conn.prepared.values() if "SUM(COALESCE(rainfall.depth, 0))" in text][0]
+
+        conn = FakeConnection(results=self.materialization_results())
+        query = time_depth_query(dataManager.DataManager(pool=FakePool(conn), materialized_rainfall=True), conn)
+        assert "LEFT JOIN rainfall_by_period as rainfall" in query
+        assert "rainfall.period = traffic.period" in query and "@>" not in query
+
+        def deny(rainfall_table):
+            raise psycopg2.ProgrammingError("permission denied for schema public")
+
+        # Without the privilege to create the materialization, the rainfall table is range joined
+        conn = FakeConnection()
+        dm = dataManager.DataManager(pool=FakePool(conn), materialized_rainfall=True)
+        monkeypatch.setattr(dm, "materialize_rainfall", deny)
+        query = time_depth_query(dm, conn)
+        assert "LEFT JOIN rainfall as rainfall" in query and "traffic.period @> rainfall.period" in query
+
+class TestExtractCache():
+
+    def setup_method(self, method):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+
+    def teardown_method(self, method):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def age_extracts(self, seconds):
+        # Last used times are meta file modification times
+        for key in os.listdir(self.directory):
+            meta_file = os.path.join(self.directory, key, "meta.json")
+            used = os.path.getmtime(meta_file) - seconds
+            os.utime(meta_file, (used, used))
+
+    def test_put_skips_cache_on_write_failure(self, monkeypatch):
+        import pandas as pd
+        import extractCache
+
+        def fail(*args, **kwargs):
+            raise IOError(28, "No space left on device")
+
+        cache = extractCache.ExtractCache(self.directory)
+        monkeypatch.setattr(extractCache.np, "save", fail)
+        cache.put(("traffic", "rainfall"), [("street", "A ROAD")], ["Slip Road"], (8,), (1,), pd.DataFrame({'depth': [0.1]}))
+
+        assert cache.get(("traffic", "rainfall"), [("street", "A ROAD")], ["Slip Road"], (8,), (1,)) is None
+        assert os.listdir(self.directory) == []
+
+    def test_round_trip_keeps_values_and_types(self):
+        import pandas as pd
+        import extractCache
+
+        data = pd.DataFrame({
+            'depth': [0.0, 0.5, 1.25],
+            'hour': numpy.array([8, 9, 23], dtype=numpy.int8),
+            'nature': pd.Categorical(["Slip Road", None, "Single Carriageway"]),
+            'identifier': ["A ROAD", None, "B ROAD"],
+            'period': pd.to_datetime(["2013-07-01 08:00", "2013-07-01 09:15", "2013-08-31 23:45"])
+        }, columns=['depth', 'hour', 'nature', 'identifier', 'period'])
+
+        cache = extractCache.ExtractCache(self.directory)
+        selection = (("traffic", "rainfall"), [("street", "A ROAD")], ["Slip Road"], (8, 9), (1,))
+        cache.put(*(selection + (data,)))
+
+        pd.testing.assert_frame_equal(cache.get(*selection), data, check_exact=True)
+        assert cache.get(("traffic", "rainfall"), [("street", "A ROAD")], ["Slip Road"], (8,), (1,)) is None
+
+    def test_evicts_least_recently_used_extracts(self):
+        import pandas as pd
+        import extractCache
+
+        data = pd.DataFrame({'depth': numpy.arange(1000, dtype=numpy.float64)})
+        cache = extractCache.ExtractCache(self.directory, max_bytes=10 ** 9)
+        selections = [(("traffic", "rainfall"), [("street", road)], ["Slip Road"], (8,), (1,)) for road in "ABC"]
+
+        cache.put(*(selections[0] + (data,)))
+        # Room for two extracts but not three
+        cache.max_bytes = 2 * cache.size() + 1024
+        self.age_extracts(10)
+        cache.put(*(selections[1] + (data,)))
+        self.age_extracts(10)
+
+        # Reading A makes B the least recently used
+        assert cache.get(*selections[0]) is not None
+        cache.put(*(selections[2] + (data,)))
+
+        assert cache.size() <= cache.max_bytes
+        assert cache.get(*selections[1]) is None
+        assert cache.get(*selections[0]) is not None
+        assert cache.get(*selections[2]) is not None
+
+    def test_invalidate_drops_extracts_of_a_table(self):
+        import pandas as pd
+        import extractCache
+
+        data = pd.DataFrame({'depth': [0.1, 0.2]})
+        cache = extractCache.ExtractCache(self.directory)
+        july = (("traffic", "rainfall"), [("street", "A ROAD")], ["Slip Road"], (8,), (1,))
+        august = (("traffic_aug13", "rainfall_aug13"), [("street", "A ROAD")], ["Slip Road"], (8,), (1,))
+        cache.put(*(july + (data,)))
+        cache.put(*(august + (data,)))
+
+        cache.invalidate("rainfall_aug13")
+        assert cache.get(*august) is None
+        assert cache.get(*july) is not None
+
+        cache.invalidate()
+        assert cache.get(*july) is None
+        assert cache.size() == 0
+
+class TestFitting():
+
+    def road_frame(self, natures, rows=4):
+        import pandas as pd
+        return pd.DataFrame({'depth': [0.1] * rows * len(natures), 'speed': [30.0] * rows * len(natures),
+                             'nature': [nature for nature in natures for _ in range(rows)],
+                             'identifier': ["ROAD"] * rows * len(natures), 'hour': [8.0] * rows * len(natures),
+                             'dow': [1.0] * rows * len(natures)})
+
+    def test_journal_resumes_and_refits_changed_roads(self, tmpdir, monkeypatch):
+        import json
+        import multivariate_model_fitting as mmf
+
+        monkeypatch.chdir(tmpdir)
+        natures = ["Single Carriageway", "Slip Road"]
+        fit = lambda nature: (nature, {"avg_speed": 30.0}, -1, None, None)
+
+        # Interrupted run: A complete, B with one of its natures fitted, then a torn record
+        journal = mmf.FitJournal("journal.jsonl")
+        journal.record_fit("A", fit("Single Carriageway"))
+        journal.record_fit("A", fit("Slip Road"))
+        journal.record_road("A")
+        journal.record_fit("B", fit("Single Carriageway"))
+        journal.close()
+        with open("journal.jsonl", "ab") as f:
+            f.write('{"road": "B", "nat')
+
+        # C is unchanged since the previous run and D has new traffic data, both have road files
+        tmpdir.mkdir("road_data")
+        for road in ("C", "D"):
+            with open("road_data/%s.json" % road, "w") as f:
+                json.dump({"nature_results": {"Slip Road": {"best_function": 0, "parameters": [1.0] * 7,
+                                                            "mse": 2.0, "mae": 1.0}}}, f)
+
+        journal = mmf.FitJournal("journal.jsonl")
+        assert journal.is_complete("A") and not journal.is_complete("B")
+        assert journal.has_fit("B", "Single Carriageway") and not journal.has_fit("B", "Slip Road")
+
+        mmf.journal_unchanged_roads(journal, {"A": [8, "t1"], "B": [8, "t1"], "C": [5, "t1"], "D": [9, "t2"]},
+                                    {"A": [8, "t1"], "B": [8, "t1"], "C": [5, "t1"], "D": [7, "t1"]})
+        assert journal.is_complete("C") and not journal.is_complete("D")
+        assert [f[2] for f in journal.get_fits("C")] == [0]
+
+        fitted = []
+        monkeypatch.setattr(mmf, "fit_nature", lambda job: fitted.append((job[0], job[1])) or fit(job[1]))
+        road_data = [("street", road, (self.road_frame(natures), self.road_frame(natures))) for road in "ABCD"]
+
+        results = dict(mmf.iter_road_fits(road_data, 4, journal=journal))
+        journal.close()
+
+        assert sorted(results) == ["B", "D"]
+        assert sorted(fitted) == [("B", "Slip Road"), ("D", "Single Carriageway"), ("D", "Slip Road")]
+
+    def test_get_statistics_matches_row_loop(self):
+        import pandas as pd
+        import model_families
+        import multivariate_model_fitting as mmf
+
+        # Validation frame with a shuffled index, as the nature groups of prepare_road have
+        frame = pd.DataFrame({'depth': [0.0, 0.1, 0.35, 1.2, 0.0, 2.5], 'dow': [0, 1, 1, 0, 1, 1],
+                              'hour': [0, 5, 8, 12, 17, 23], 'speed': [31.0, 28.5, 22.0, 35.5, 18.0, 40.0]},
+                             index=[7, 3, 11, 0, 5, 2])
+
+        def loop_statistics(params, plot_func, depth, day, hour, speed):
+            # The row by row implementation get_statistics replaced
+            preds = []
+            total_sq_error = 0
+            total_error = 0
+
+            for v, d in enumerate(depth):
+                preds.append(plot_func(params, d, day.iloc[v], hour.iloc[v]))
+                diff = preds[v] - speed.iloc[v]
+                total_sq_error += diff ** 2
+                total_error += numpy.absolute(diff)
+
+            return preds, total_sq_error / len(depth), total_error / len(depth)
+
+        for family in model_families.get_families():
+            params = numpy.linspace(0.05, 0.4, family.n_parameters)
+            params[-1] = 25.0
+
+            expected = loop_statistics(params, family.predict, frame.depth, frame.dow, frame.hour, frame.speed)
+            preds, mse, mae = mmf.get_statistics(params, family.predict, frame.depth, frame.dow, frame.hour, frame.speed)
+
+            assert numpy.allclose(preds, expected[0], rtol=1e-12, atol=0)
+            assert numpy.isclose(mse, expected[1], rtol=1e-12, atol=0)
+            assert numpy.isclose(mae, expected[2], rtol=1e-12, atol=0)
+
+    def test_bounded_fit_stays_within_family_bounds(self):
+        import pandas as pd
+        import model_families
+        import multivariate_model_fitting as mmf
+
+        with pytest.raises(ValueError):
+            mmf.new_fit_options(backend="leastsq", bounded=True)
+
+        rng = numpy.random.RandomState(3)
+        depth = numpy.where(rng.rand(200) < 0.5, 0.0, rng.exponential(1.0, 200))
+        dow = rng.randint(0, 2, 200).astype(numpy.float64)
+        hour = rng.randint(0, 24, 200).astype(numpy.float64)
+        frame = pd.DataFrame({'depth': depth, 'dow': dow, 'hour': hour,
+                              'speed': 30.0 - 4.0 * numpy.sqrt(depth) + 2.0 * dow + rng.normal(0, 1.0, 200)})
+        fit_options = mmf.new_fit_options(backend="least_squares", bounded=True)
+
+        for index, family in enumerate(model_families.get_families()):
+            # A warm start with negative exponents, as an unbounded fit may leave, is moved into the bounds
+            initial = numpy.where(numpy.isfinite(family.bounds[0]), -0.5, family.initial)
+            fit = mmf.fit_family("ROAD", index, family, frame, frame, initial, fit_options)
+
+            assert fit is not None
+            assert numpy.all(fit[0] >= family.bounds[0]) and numpy.all(fit[0] <= family.bounds[1])
+            assert numpy.all(numpy.isfinite(fit[1]))
+
+    def test_pruned_search_fits_unpruned_families_as_exhaustive_search(self):
+        import pandas as pd
+        import multivariate_model_fitting as mmf
+
+        rng = numpy.random.RandomState(5)
+        depth = numpy.where(rng.rand(400) < 0.5, 0.0, rng.exponential(1.0, 400))
+        dow = rng.randint(0, 2, 400).astype(numpy.float64)
+        hour = rng.randint(0, 24, 400).astype(numpy.float64)
+        frame = pd.DataFrame({'depth': depth, 'dow': dow, 'hour': hour,
+                              'speed': 30.0 - 4.0 * numpy.sqrt(depth) + 2.0 * dow + rng.normal(0, 1.0, 400)})
+
+        exhaustive = mmf.exhaustive_search("ROAD", frame, frame, {}, mmf.new_fit_options())
+        # Nothing is pruned with a huge margin, so every family is fitted in full
+        fits, pruned = mmf.pruned_search("ROAD", frame, frame, {},
+                                         mmf.new_fit_options(search="pruned", prune_margin=1e9, subsample=0.25))
+
+        assert pruned == []
+        assert sorted(fits) == sorted(exhaustive)
+        for i in fits:
+            assert numpy.array_equal(fits[i][0], exhaustive[i][0])
+            assert fits[i][2] == exhaustive[i][2]
+
+class TestLinkIndex():
+
+    def brute_force_depths(self, rainfall, rows, n_rows, box_codes, lowers, uppers, repeats):
+        # Depths of the rainfall periods of a box contained in every traffic period, as the range join sums them
+        depths = numpy.zeros(n_rows)
+        for row, box, lower, upper in zip(rows, box_codes, lowers, uppers):
+            for rain_box, rain_lower, rain_upper, depth in rainfall:
+                if rain_box == box and lower <= rain_lower and rain_upper <= upper:
+                    depths[row] += depth * repeats
+        return depths / 1000000.0
+
+    def test_box_rainfall_matches_brute_force(self):
+        import linkIndex
+
+        rng = numpy.random.RandomState(7)
+        rainfall = []
+        # Box 3 has no rainfall, the periods of a box do not overlap but vary in length
+        for box in (0, 1, 2, 4):
+            lower = rng.randint(0, 600)
+            for _ in range(rng.randint(1, 30)):
+                upper = lower + rng.choice([300, 900, 1800])
+                rainfall.append((box, lower, upper, rng.randint(0, 5000)))
+                lower = upper + rng.choice([0, 0, 300])
+        rng.shuffle(rainfall)
+        box_rainfall = linkIndex.BoxRainfall(*zip(*rainfall))
+
+        n_pairs = 500
+        rows = rng.randint(0, 60, n_pairs)
+        box_codes = rng.randint(0, 6, n_pairs)
+        lowers = rng.randint(-1000, 30000, n_pairs)
+        uppers = lowers + rng.choice([0, 300, 900, 3600, 7200], n_pairs)
+
+        # Traffic periods starting and ending exactly on rainfall period edges
+        edges = rng.randint(0, len(rainfall), 50)
+        box_codes[:50] = [rainfall[i][0] for i in edges]
+        lowers[:50] = [rainfall[i][1] for i in edges]
+        uppers[:50] = [rainfall[i][2] for i in edges]
+        uppers[50:100] = lowers[50:100] + 1
+
+        for repeats in (1, 3):
+            depths = box_rainfall.get_depths(rows, 64, box_codes, lowers, uppers, repeats)
+            expected = self.brute_force_depths(rainfall, rows, 64, box_codes, lowers, uppers, repeats)
+
+            assert numpy.allclose(depths, expected, rtol=1e-12, atol=0)
+
+        assert numpy.array_equal(box_rainfall.get_depths([], 4, [], [], []), numpy.zeros(4))
+        assert numpy.array_equal(linkIndex.BoxRainfall([], [], [], []).get_depths(rows, 64, box_codes, lowers, uppers),
+                                 numpy.zeros(64))
+
+        with pytest.raises(linkIndex.OverlappingPeriods):
+            linkIndex.BoxRainfall([1, 1], [0, 600], [900, 1200], [1, 1])
+
+    def test_expand_boxes_matches_brute_force(self):
+        import linkIndex
+
+        box_codes = numpy.array([4, 0, 2, 2, 1, 3, 5])
+        box_starts = numpy.array([0, 3, 3, 6, 1, 0])
+        box_counts = numpy.array([3, 0, 2, 1, 0, 1])
+
+        rows, codes = linkIndex.expand_boxes(box_starts, box_counts, box_codes)
+
+        expected = [(row, box_codes[start + i]) for row, (start, count) in enumerate(zip(box_starts, box_counts))
+                    for i in range(count)]
+        assert zip(rows, codes) == expected
+
+        rows, codes = linkIndex.expand_boxes(numpy.array([0, 2]), numpy.array([0, 0]), box_codes)
+        assert len(rows) == 0 and len(codes) == 0
+
+    def test_select_matches_brute_force(self, tmpdir):
+        import linkIndex
+
+        links = [("T3", 10.0, "Single Carriageway", "OXFORD STREET", "A ROAD"),
+                 ("T1", 20.0, "Slip Road", None, "A ROAD"),
+                 ("T2", 30.0, "Single Carriageway", "OXFORD STREET", "A ROAD"),
+                 ("T10", 40.0, "Single Carriageway", "REGENT STREET", "B ROAD"),
+                 ("T4", 50.0, "Slip Road", None, None)]
+        # T2 has no boxes, T1 a repeated box and T9 is not a link
+        grid = [("T3", "B2"), ("T1", "B1"), ("T9", "B7"), ("T3", "B1"), ("T10", "B3"), ("T1", "B1"), ("T4", "B2")]
+
+        class LinkCursor(FakeCursor):
+
+            def fetchone(self):
+                return (len(links), len(grid))
+
+            def fetchall(self):
+                return list(links if "itn_link" in self.connection.statements[-1][0] else grid)
+
+        cur = LinkCursor(FakeConnection())
+        file_name = str(tmpdir.join("link_index.npz"))
+
+        for index in (linkIndex.LinkIndex(file_name), linkIndex.LinkIndex(file_name)):
+            for filters, natures in (([("street", "OXFORD STREET"), ("classification", "A ROAD")], ["Single Carriageway", "Slip Road"]),
+                                     ([("toid", "T4"), ("toid", "T10")], ["Slip Road"]),
+                                     ([("street", "UNKNOWN")], ["Slip Road"])):
+                selection = index.select(cur, filters, natures)
+
+                expected = [link for link in sorted(links)
+                            if link[2] in natures and any(link[["toid", "length", "nature", "street", "classification"]
+                                                                .index(column)] == value for column, value in filters)]
+                assert list(selection.frame.index) == [link[0] for link in expected]
+                assert list(selection.frame.length) == [link[1] for link in expected]
+                assert list(selection.frame.nature) == [link[2] for link in expected]
+                assert list(selection.frame.identifier) == [link[3] or link[4] for link in expected]
+
+                rows, codes = linkIndex.expand_boxes(selection.box_starts, selection.box_counts, selection.box_codes)
+                boxes = [(expected[row][0], selection.boxes[code]) for row, code in zip(rows, codes)]
+                assert boxes == [(link[0], box) for link in expected for toid, box in grid if toid == link[0]]
+
+            assert index.select(cur, [("length", 10.0)], ["Slip Road"]) is None
+
+        # The second index is loaded from the file of the first
+        assert sum("FROM link_grid" in query for query, params in cur.connection.statements
+                   if not query.startswith("SELECT (")) == 1
+
+    def test_pruned_search_fits_families_failing_screening_in_full(self, monkeypatch):
+        import pandas as pd
+        import multivariate_model_fitting as mmf
+
+        frame = pd.DataFrame({'depth': numpy.linspace(0, 2, 400), 'dow': [0.0, 1.0] * 200,
+                              'hour': numpy.arange(400) % 24.0, 'speed': numpy.linspace(20, 30, 400)})
+        fitted = []
+
+        def fit_family(street, index, family, training, validation, initial, fit_options):
+            fitted.append((index, len(training)))
+            if len(training) < len(frame):
+                # Screening: family 0 fails, family 1 has no finite mse and family 2 is far worse than family 3
+                return [None, (initial, None, numpy.nan, numpy.nan), (initial, None, 10.0, 1.0),
+                        (initial, None, 1.0, 1.0)][index]
+            return initial, None, float(index), 1.0
+
+        monkeypatch.setattr(mmf, "fit_family", fit_family)
+        monkeypatch.setattr(mmf.model_families, "get_families", lambda: [mmf.model_families.get_family(0)] * 4)
+
+        fits, pruned = mmf.pruned_search("ROAD", frame, frame, {}, mmf.new_fit_options(search="pruned", subsample=0.25))
+
+        assert pruned == [2]
+        assert sorted(fits) == [0, 1, 3]
+        assert [index for index, rows in fitted if rows == len(frame)] == [0, 1, 3]